@@ -17,6 +17,9 @@ from contextlib import contextmanager
 from collections import namedtuple
 import logging
 import os
+import resource
+import sys
+import threading
 import time
 
 
@@ -59,14 +62,17 @@ def logginglevel(name, new_level):
         logger.setLevel(prev_level)
 
 
-def use_headless():
+def use_headless(display=None):
+    """Whether there is no X display, `display` defaults to $DISPLAY"""
     log = logging.getLogger('quibble.use_headless')
-    log.info("Display: %s", os.environ.get('DISPLAY', '<None>'))
+    display = display or os.environ.get('DISPLAY')
+    log.info("Display: %s", display or '<None>')
 
-    return not bool(os.environ.get('DISPLAY'))
+    return not bool(display)
 
 
-def chromium_flags():
+def chromium_flags(display=None):
+    """Flags for Chromium showing on `display`, defaults to $DISPLAY"""
     args = []
 
     flags_from_env = os.environ.get('CHROMIUM_FLAGS', None)
@@ -84,7 +90,7 @@ def chromium_flags():
 
     if is_in_docker():
         args.append('--no-sandbox')
-    if use_headless():
+    if use_headless(display):
         args.extend(
             [
                 '--headless',
@@ -111,33 +117,106 @@ def get_npm_command():
 
 # Keep track of Chronometer usage
 DURATIONS = []
+# Per thread Chronometer being measured, the innermost last
+_chronometers = threading.local()
 
 # fmt: off
-CommandTiming = namedtuple('Timing', [
+CommandTiming = namedtuple('CommandTiming', [
     'seconds',
     'command',
-])
+    'start',
+    'end',
+    'pid',
+    'parent',
+    'tid',
+    'rusage',
+], defaults=[None, None, None, None, None, None])
 # fmt: on
 
 
+def _chronometer_stack():
+    if not hasattr(_chronometers, 'stack'):
+        _chronometers.stack = []
+    return _chronometers.stack
+
+
+def current_chronometer():
+    """Name of the innermost Chronometer of the current thread, if any.
+
+    Threads do not inherit the Chronometer of the thread starting them, this
+    can be passed to Chronometer(parent=...) to attach them.
+    """
+    stack = _chronometer_stack()
+    return stack[-1]['name'] if stack else None
+
+
+def _max_rss_kb(rusage):
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def record_child_rusage(rusage):
+    """Account the resource usage of a child process to the Chronometers.
+
+    The resource usage of all children is accumulated by the system, the
+    peak memory of a given child is thus lost unless it has been waited for
+    with os.wait4() which returns it.
+    """
+    for chronometer in _chronometer_stack():
+        chronometer['max_rss'] = max(
+            chronometer['max_rss'], _max_rss_kb(rusage)
+        )
+
+
+def _rusage_delta(before, after, max_rss):
+    return {
+        'user_cpu': after.ru_utime - before.ru_utime,
+        'system_cpu': after.ru_stime - before.ru_stime,
+        'max_rss': max_rss,
+        'block_input': after.ru_inblock - before.ru_inblock,
+        'block_output': after.ru_oublock - before.ru_oublock,
+        'voluntary_context_switches': after.ru_nvcsw - before.ru_nvcsw,
+        'involuntary_context_switches': after.ru_nivcsw - before.ru_nivcsw,
+    }
+
+
 @contextmanager
-def Chronometer(name, logger):
+def Chronometer(name, logger, parent=None):
     """Context wrapper to log duration
 
     Arguments:
      - name -- string identifying the command
      - logger - logging function to report beginning and completion of the
        command. The total duration is reported in seconds.
+     - parent - name of the enclosing command. Default: the innermost
+       Chronometer of the current thread.
 
     Durations are globally tracked in the global list quibble.DURATIONS. Each
-    entry is a `CommandTiming` tuple made of the elapsed time in second and the
-    command description.
+    entry is a `CommandTiming` tuple made of the elapsed time in second, the
+    command description, the start and end timestamps, the ids of the process
+    and thread which ran the command, the name of the enclosing Chronometer
+    if any and the resource usage of the child processes terminated while
+    measuring.
+
+    The resource usage is a dict of CPU seconds (`user_cpu`, `system_cpu`),
+    peak resident memory in kilobytes of the largest child (`max_rss`),
+    blocks read and written (`block_input`, `block_output`) and context
+    switches (`voluntary_context_switches`, `involuntary_context_switches`).
+    It covers all children of the process, including the ones of commands
+    running concurrently in other threads.
 
     On success the command reports `<<< Finish: ...`. When the wrapped block
     raises, it reports `<<< Failed: ...` instead, so the outcome of each
     command is machine readable and not only its duration.
     """
     start = time.time()
+    rusage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if parent is None:
+        parent = current_chronometer()
+    chronometer = {'name': name, 'max_rss': 0}
+    _chronometer_stack().append(chronometer)
     logger('>>> Start: %s' % name)
     failed = False
     try:
@@ -146,8 +225,26 @@ def Chronometer(name, logger):
         failed = True
         raise
     finally:
-        duration = time.time() - start
+        _chronometer_stack().pop()
+        end = time.time()
+        rusage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        max_rss = chronometer['max_rss']
+        if rusage_end.ru_maxrss > rusage_start.ru_maxrss:
+            # A child got bigger than any previous one
+            max_rss = max(max_rss, _max_rss_kb(rusage_end))
+        duration = end - start
         outcome = 'Failed' if failed else 'Finish'
         logger('<<< %s: %s, in %.03f s' % (outcome, name, duration))
 
-        DURATIONS.append(CommandTiming(command=name, seconds=duration))
+        DURATIONS.append(
+            CommandTiming(
+                command=name,
+                seconds=duration,
+                start=start,
+                end=end,
+                pid=os.getpid(),
+                parent=parent,
+                tid=threading.get_native_id(),
+                rusage=_rusage_delta(rusage_start, rusage_end, max_rss),
+            )
+        )
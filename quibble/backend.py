@@ -13,45 +13,114 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
-import json
+import hashlib
+import glob
 import logging
 import os
 import pwd
-import signal
+import re
+import shutil
+import shlex
 import socket
 import subprocess
 import tempfile
-import threading
 import time
-import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
 
 import quibble
+import quibble.util
 
+log = logging.getLogger(__name__)
 backend_registry = {}
 
 
-def _tcp_wait(host, port, timeout=3):
-    step = 0
-    delay = 0.1  # seconds
-    socket_timeout = 1  # seconds
-    connected = False
-    while step < timeout:
+def _unix_socket_ready(path):
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(path)
+    return True
+
+
+def _tcp_ready(host, port):
+    with socket.create_connection((host, int(port)), timeout=1):
+        return True
+
+
+# Probes local servers, proxies from the environment must not be used
+_direct_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def _http_ready(url, status=200):
+    try:
+        with _direct_opener.open(url, timeout=1) as resp:
+            return resp.status == status
+    except urllib.error.HTTPError as e:
+        return e.code == status
+
+
+def _x_display_ready(display):
+    """Whether the X server of a display accepts connections.
+
+    Xvfb is started with `-nolisten unix`, it then only listens on the Linux
+    abstract socket namespace.
+    """
+    number = display.lstrip(':').partition('.')[0]
+    path = '/tmp/.X11-unix/X%s' % number
+    try:
+        return _unix_socket_ready('\0' + path)
+    except OSError:
+        return _unix_socket_ready(path)
+
+
+def _wait_for(probe, what, timeout, process=None, errorlog=None):
+    """Wait until probe() returns a true value.
+
+    The probe is first retried after 10 ms, the delay doubling on each
+    attempt up to half a second. An OSError raised by the probe counts as not
+    being ready yet.
+
+    Arguments:
+     - probe -- callable taking no arguments
+     - what -- description of what is awaited, for logs and errors
+     - timeout -- seconds to wait for before raising a TimeoutError
+     - process -- the Popen that is expected to become ready. An Exception is
+       raised as soon as it dies.
+     - errorlog -- file dumped to stdout when the wait fails.
+    """
+    delay = 0.01
+    deadline = time.monotonic() + timeout
+    with quibble.Chronometer('Wait for %s' % what, log.debug):
         try:
-            s = socket.socket()
-            s.settimeout(socket_timeout)
-            s.connect((host, int(port)))
-            connected = True
-            break
-        except (ConnectionAbortedError, ConnectionRefusedError):
-            step = step + delay
-            time.sleep(delay)
-        finally:
-            s.close()
+            while True:
+                try:
+                    if probe():
+                        return
+                except OSError:
+                    pass
+                if process is not None and process.poll() is not None:
+                    raise Exception(
+                        '%s died during startup (%s)'
+                        % (what, process.returncode)
+                    )
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        '%s not ready after %s seconds' % (what, timeout)
+                    )
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.5)
+        except Exception:
+            if errorlog is not None and os.path.exists(errorlog):
+                with open(errorlog) as f:
+                    print(f.read())
+            raise
 
-    if not connected:
-        raise TimeoutError(
-            'Could not connect to port %s after %s seconds' % (port, timeout)
-        )
+
+def _tcp_wait(host, port, timeout=3):
+    _wait_for(
+        lambda: _tcp_ready(host, port), 'port %s' % port, timeout=timeout
+    )
 
 
 def backend(interface, key):
@@ -91,11 +160,19 @@ def db_backend(key):
     return backend(DatabaseServer, key)
 
 
-def getDatabase(engine, db_dir, dump_dir, log_dir):
+def getDatabase(
+    engine, db_dir, dump_dir, log_dir, template_dir=None, profile='default'
+):
     '''Set up a database backend, without starting it.'''
     dbclass = get_backend(DatabaseServer, engine)
-    db = dbclass(base_dir=db_dir, dump_dir=dump_dir, log_dir=log_dir)
+    db = dbclass(
+        base_dir=db_dir,
+        dump_dir=dump_dir,
+        log_dir=log_dir,
+        template_dir=template_dir,
+    )
     db.type = engine
+    db.profile = profile
     return db
 
 
@@ -105,33 +182,66 @@ def getWebserver(engine, mw_install_path, web_url, kwargs={}):
     return backend
 
 
+# Directory where the relayed backend streams are written instead of being
+# logged, see relay_to_files()
+_relay_log_dir = None
+
+
+def relay_to_files(log_dir):
+    """Write the streams relayed from backends to files in log_dir
+
+    Each backend process gets a backend-<program>.log file.
+    """
+    global _relay_log_dir
+    _relay_log_dir = log_dir
+
+
 def _stream_relay(process, stream, log_function):
-    thread = threading.Thread(
-        target=_stream_to_log, args=(process, stream, log_function)
-    )
-    thread.start()
-    return thread
+    """Log each line of a process stream, see quibble.util.OutputPump"""
+
+    if _relay_log_dir is not None:
+        args = process.args
+        program = args if isinstance(args, str) else args[0]
+        os.makedirs(_relay_log_dir, exist_ok=True)
+        relay_log = open(
+            os.path.join(
+                _relay_log_dir,
+                'backend-%s.log' % os.path.basename(program.split(' ')[0]),
+            ),
+            'ab',
+        )
+        quibble.util.output_pump.register(
+            stream, relay_log.write, on_close=relay_log.close
+        )
+        return
 
+    def log_lines(chunk):
+        for line in chunk.decode(errors='backslashreplace').splitlines():
+            log_function(line.rstrip())
 
-def _stream_to_log(process, stream, log_function):
-    while True:
-        line = stream.readline()
-        if not line:
-            break
-        log_function(line.rstrip())
+    quibble.util.output_pump.register(stream, log_lines)
 
 
 class BackendServer:
     server = None
+    # Resources for the execution graph, see quibble.scheduler
+    requires = frozenset()
+    provides = frozenset()
 
     def __init__(self):
         self.log = logging.getLogger('backend.%s' % self.__class__.__name__)
 
     def __enter__(self):
-        self.start()
+        with quibble.Chronometer(
+            'Start backend %s' % self.__class__.__name__, self.log.debug
+        ):
+            self.start()
 
     def __exit__(self, *args):
-        self.stop()
+        with quibble.Chronometer(
+            'Stop backend %s' % self.__class__.__name__, self.log.debug
+        ):
+            self.stop()
 
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -150,6 +260,7 @@ class BackendServer:
                 self.server.wait(2)
             except subprocess.TimeoutExpired:
                 self.server.kill()  # SIGKILL
+                self.server.wait()
             finally:
                 self.server = None
 
@@ -157,17 +268,35 @@ class BackendServer:
 class DatabaseServer(BackendServer):
     dump_dir = None
     log_dir = None
+    provides = frozenset({'database'})
+    # "ephemeral" trades durability for speed, for throwaway databases
+    profile = 'default'
+    # Seconds given to dump() on shutdown
+    dump_timeout = 60
+    # Where ephemeral databases are held when no base_dir is given
+    ephemeral_dir = '/dev/shm'
 
-    def __init__(self, base_dir=None, dump_dir=None, log_dir=None):
+    def __init__(
+        self, base_dir=None, dump_dir=None, log_dir=None, template_dir=None
+    ):
         super(DatabaseServer, self).__init__()
         self.base_dir = base_dir
         self.dump_dir = dump_dir
         self.log_dir = log_dir
+        # Cache of pre-initialized database files, kept between runs
+        self.template_dir = template_dir
 
     def _init_rootdir(self, base_dir):
         # Create a temporary data directory
         prefix = 'quibble-%s-' % self.__class__.__name__.lower()
 
+        if (
+            base_dir is None
+            and self.profile == 'ephemeral'
+            and os.path.isdir(self.ephemeral_dir)
+        ):
+            base_dir = self.ephemeral_dir
+
         if base_dir is not None:
             base_dir = os.path.abspath(base_dir)
             os.makedirs(base_dir, exist_ok=True)
@@ -190,68 +319,308 @@ class DatabaseServer(BackendServer):
             '%s does not support dumping database', self.__class__.__name__
         )
 
+    def _template_path(self, key_data):
+        h = hashlib.new('sha256')
+        for key in key_data:
+            h.update(key.encode('utf8') + b"\x00")
+        return os.path.join(
+            self.template_dir,
+            '%s-%s' % (self.__class__.__name__.lower(), h.hexdigest()),
+        )
+
+    def _copy_template(self, key_data, create, datadir):
+        """Copy to `datadir` a data directory created by `create(path)`.
+
+        The data directory is created once and kept in template_dir, named
+        after the server and a hash of `key_data` which should hold the
+        server version and the options used to create it.
+        """
+        template = self._template_path(key_data)
+        if not os.path.isdir(template):
+            self.log.info('Initializing data directory template %s', template)
+            os.makedirs(self.template_dir, exist_ok=True)
+            staging = tempfile.mkdtemp(
+                dir=self.template_dir,
+                prefix='.%s-' % self.__class__.__name__.lower(),
+            )
+            try:
+                create(staging)
+                try:
+                    os.rename(staging, template)
+                except OSError:
+                    # Unless a concurrent run created it first
+                    if not os.path.isdir(template):
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        # Database servers write to their files in place, they are thus
+        # never hardlinked to the template.
+        self.log.info('Copying data directory from %s', template)
+        quibble.util.clone_tree(template, datadir)
+
+    def clone_names(self, count):
+        return ['%s_%s' % (self.dbname, i) for i in range(1, count + 1)]
+
+    def clone_databases(self, count):
+        """Copy the wiki database, schema and data, to `count` databases
+        named after it with a _1 .. _N suffix. Any previous copies are
+        replaced.
+
+        Returns the names of the copies, None when not supported.
+        """
+        self.log.warning(
+            '%s does not support cloning databases', self.__class__.__name__
+        )
+        return None
+
+    def snapshot(self, path):
+        """Save the wiki database to the existing directory `path`
+
+        Returns whether snapshots are supported.
+        """
+        self.log.warning(
+            '%s does not support snapshots', self.__class__.__name__
+        )
+        return False
+
+    def restore(self, path):
+        """Restore the wiki database from a snapshot() directory
+
+        Returns whether snapshots are supported.
+        """
+        self.log.warning(
+            '%s does not support snapshots', self.__class__.__name__
+        )
+        return False
+
     def __str__(self):
         return "<%s>" % self.__class__.__name__
 
 
 @db_backend('postgres')
 class Postgres(DatabaseServer):
-    def __init__(self, base_dir=None, dump_dir=None, log_dir=None):
-        super(Postgres, self).__init__(base_dir, dump_dir, log_dir)
+    # Settings of the ephemeral profile
+    EPHEMERAL_SETTINGS = [
+        'fsync=off',
+        'synchronous_commit=off',
+        'full_page_writes=off',
+    ]
+
+    def __init__(
+        self,
+        base_dir=None,
+        dump_dir=None,
+        log_dir=None,
+        user='wikiuser',
+        password='secret',
+        dbname='wikidb',
+        template_dir=None,
+    ):
+        super(Postgres, self).__init__(
+            base_dir, dump_dir, log_dir, template_dir
+        )
+
+        self.user = user
+        # Unused, local connections are trusted
+        self.password = password
+        self.dbname = dbname
+        self.socket = None
+        self.port = None
+
+    @staticmethod
+    def _pg_command(name):
+        """Path to a PostgreSQL server program. Debian does not provide them
+        in PATH, the most recent version is then used."""
+        if shutil.which(name):
+            return name
+        candidates = sorted(
+            glob.glob('/usr/lib/postgresql/*/bin/%s' % name),
+            key=lambda path: [int(n) for n in re.findall(r'\d+', path)],
+        )
+        if not candidates:
+            raise Exception('PostgreSQL %s command not found' % name)
+        return candidates[-1]
+
+    def _initdb_options(self):
+        return [
+            '--username=%s' % self.user,
+            '--auth=trust',
+            '--encoding=UTF8',
+            '--locale=C',
+        ]
+
+    def _run_initdb(self, datadir):
+        p = subprocess.Popen(
+            [self._pg_command('initdb'), '--pgdata=%s' % datadir]
+            + self._initdb_options(),
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        outs, errs = p.communicate()
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+
+    def _init_datadir(self):
+        if self.template_dir is None:
+            self.log.info('Initializing Postgres data directory')
+            self._run_initdb(self.datadir)
+            return
+
+        version = subprocess.check_output(
+            [self._pg_command('initdb'), '--version']
+        )
+        self._copy_template(
+            [version.decode().strip()] + self._initdb_options(),
+            self._run_initdb,
+            self.datadir,
+        )
+
+    def _server_options(self):
+        options = [
+            # Only listen on the unix socket
+            '-c',
+            "listen_addresses=''",
+            '-k',
+            self.socket,
+        ]
+        if self.profile == 'ephemeral':
+            for setting in self.EPHEMERAL_SETTINGS:
+                options.extend(['-c', setting])
+        return options
+
+    def _ready(self):
+        """Whether the server accepts connections on its socket.
+
+        The postmaster creates its socket before it is done starting up, it
+        then reports its status in the last line of postmaster.pid.
+        """
+        with open(os.path.join(self.datadir, 'postmaster.pid')) as f:
+            if f.read().split('\n')[7:8] != ['ready   ']:
+                return False
+        return _unix_socket_ready(os.path.join(self.socket, '.s.PGSQL.5432'))
+
+    def _wait_ready(self, timeout=30):
+        _wait_for(self._ready, 'Postgres', timeout, errorlog=self.errorlog)
 
     def start(self):
+        self.log.info('Starting Postgres')
         super(Postgres, self).start()
 
-        self.conffile = os.path.join(self.rootdir, 'conf')
+        self.datadir = os.path.join(self.rootdir, 'data')
         self.socket = os.path.join(self.rootdir, 'socket')
+        os.mkdir(self.socket)
+        self.dbserver = self.socket
 
-        # Start pg_virtualenv with TMPDIR set to rootdir so its working
-        # directory (and the Postgres data dir inside it) lives under
-        # --db-dir.
-        # https://github.com/credativ/postgresql-common/blob/master/pg_virtualenv
-        self.server = subprocess.Popen(
+        if self.log_dir is None:
+            self.errorlog = os.path.join(self.rootdir, 'postgres.log')
+        else:
+            self.errorlog = os.path.join(self.log_dir, 'postgres.log')
+
+        self._init_datadir()
+
+        subprocess.check_call(
             [
-                # fmt: off
-                'pg_virtualenv',
-                # Option for pg_createcluster
-                '-c',
-                '--socketdir=%s' % self.socket,
-                'python3',
-                '-m', 'quibble.pg_virtualenv_hook'
-                # fmt: on
-            ],
-            env={
-                'QUIBBLE_TMPFILE': self.conffile,
-                'TMPDIR': self.rootdir,
-            },
+                self._pg_command('pg_ctl'),
+                'start',
+                '--pgdata=%s' % self.datadir,
+                '--log=%s' % self.errorlog,
+                '--no-wait',
+                '--silent',
+                '--options=%s' % shlex.join(self._server_options()),
+            ]
         )
+        self._wait_ready()
 
-        while not os.path.exists(self.conffile):
-            if self.server.poll() is not None:
-                raise Exception(
-                    'Postgres failed during startup (%s)'
-                    % self.server.returncode
-                )
-            time.sleep(1)
+        self._pg_run(
+            ['psql', '--no-psqlrc', '--quiet', '--set=ON_ERROR_STOP=1'],
+            'postgres',
+            'CREATE DATABASE "%s";\n' % self.dbname,
+        )
+        self.log.info('Postgres is ready')
 
-        with open(self.conffile) as f:
-            conf = json.load(f)
+    def _pg_run(self, cmd, dbname, sql=None):
+        env = {
+            'PATH': os.environ.get('PATH', os.defpath),
+            'PGHOST': self.socket,
+            'PGUSER': self.user,
+            'PGPASSWORD': self.password,
+            'PGDATABASE': dbname,
+        }
+        if self.port:
+            env['PGPORT'] = str(self.port)
 
-        self.user = conf['PGUSER']
-        self.password = conf['PGPASSWORD']
-        self.dbname = conf['PGDATABASE']
-        self.dbserver = self.socket
-        self.hook_pid = conf['PID']
-        self.log.info('Postgres is ready')
+        p = subprocess.Popen(
+            cmd,
+            env=env,
+            text=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        outs, errs = p.communicate(input=sql)
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+
+    def clone_databases(self, count):
+        names = self.clone_names(count)
+        self.log.info('Cloning database %s to %s', self.dbname, names)
+
+        sql = ''.join(
+            'DROP DATABASE IF EXISTS "%s";'
+            'CREATE DATABASE "%s" TEMPLATE "%s";\n' % (name, name, self.dbname)
+            for name in names
+        )
+        # The template must not have any other connection
+        self._pg_run(
+            ['psql', '--no-psqlrc', '--quiet', '--set=ON_ERROR_STOP=1'],
+            'postgres',
+            sql,
+        )
+        return names
+
+    def snapshot(self, path):
+        self._pg_run(
+            [
+                'pg_dump',
+                '--no-owner',
+                '--file=%s' % os.path.join(path, 'postgres.sql'),
+            ],
+            self.dbname,
+        )
+        return True
+
+    def restore(self, path):
+        self._pg_run(
+            [
+                'psql',
+                '--no-psqlrc',
+                '--quiet',
+                '--set=ON_ERROR_STOP=1',
+                '--file=%s' % os.path.join(path, 'postgres.sql'),
+            ],
+            self.dbname,
+        )
+        return True
 
     def stop(self):
-        # Send a signal to the hook since it's waiting on one
-        os.kill(self.hook_pid, signal.SIGUSR1)
         super(Postgres, self).stop()
+        subprocess.call(
+            [
+                self._pg_command('pg_ctl'),
+                'stop',
+                '--pgdata=%s' % self.datadir,
+                '--mode=fast',
+                '--silent',
+            ]
+        )
 
 
 @db_backend('mysql')
 class MySQL(DatabaseServer):
+    mysqld = '/usr/sbin/mysqld'  # fixme drop path
+
     def __init__(
         self,
         base_dir=None,
@@ -261,8 +630,9 @@ class MySQL(DatabaseServer):
         password='secret',
         dbname='wikidb',
         dbserver='localhost',
+        template_dir=None,
     ):
-        super(MySQL, self).__init__(base_dir, dump_dir, log_dir)
+        super(MySQL, self).__init__(base_dir, dump_dir, log_dir, template_dir)
 
         self.user = user
         self.password = password
@@ -271,16 +641,39 @@ class MySQL(DatabaseServer):
         self.dbserver = dbserver
         self.log_dir = log_dir
 
-    def _install_db(self):
-        self.log.info('Initializing MySQL data directory')
+    # Options of the ephemeral profile
+    EPHEMERAL_OPTIONS = [
+        '--skip-log-bin',
+        '--innodb-flush-log-at-trx-commit=0',
+        '--innodb-doublewrite=0',
+        '--performance-schema=OFF',
+    ]
+
+    def _mysqld_command(self):
+        cmd = [
+            self.mysqld,
+            '--skip-networking',
+            '--innodb-print-all-deadlocks',
+            '--datadir=%s' % self.rootdir,
+            '--log-error=%s' % self.errorlog,
+            '--pid-file=%s' % self.pidfile,
+            '--socket=%s' % self.socket,
+        ]
+        if self.profile == 'ephemeral':
+            cmd.extend(self.EPHEMERAL_OPTIONS)
+        return cmd
+
+    def _install_options(self):
+        return [
+            # Legacy system with a passwordless root user
+            '--auth-root-authentication-method=normal',
+            '--user=%s' % pwd.getpwuid(os.getuid())[0],
+        ]
+
+    def _run_install_db(self, datadir):
         p = subprocess.Popen(
-            [
-                'mysql_install_db',
-                # Legacy system with a passwordless root user
-                '--auth-root-authentication-method=normal',
-                '--datadir=%s' % self.rootdir,
-                '--user=%s' % pwd.getpwuid(os.getuid())[0],
-            ],
+            ['mysql_install_db', '--datadir=%s' % datadir]
+            + self._install_options(),
             text=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
@@ -289,11 +682,23 @@ class MySQL(DatabaseServer):
         if p.returncode != 0:
             raise Exception("FAILED (%s): %s" % (p.returncode, outs))
 
-    def _createwikidb(self):
-        """Create a database and necessary grants.
-        Will drop existing database if it already exists."""
-        self.log.info('Creating the wiki database and grant')
-        mysql_cmd = ['mysql', '--user=root']
+    def _template_key(self):
+        version = subprocess.check_output([self.mysqld, '--version'])
+        return [version.decode().strip()] + self._install_options()
+
+    def _install_db(self):
+        if self.template_dir is None:
+            self.log.info('Initializing MySQL data directory')
+            self._run_install_db(self.rootdir)
+            return
+
+        self._copy_template(
+            self._template_key(), self._run_install_db, self.rootdir
+        )
+
+    def _mysql(self, sql):
+        """Run SQL statements as root, returns the tab separated output"""
+        mysql_cmd = ['mysql', '--user=root', '--batch', '--skip-column-names']
         if self.socket:
             mysql_cmd.append('--socket=%s' % self.socket)
         p = subprocess.Popen(
@@ -303,16 +708,73 @@ class MySQL(DatabaseServer):
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
-        grant = (
+        outs, errs = p.communicate(input=sql)
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+        return outs
+
+    def _createdb_sql(self, dbname):
+        return (
             "DROP DATABASE IF EXISTS %s;"
             "CREATE DATABASE %s;"
             "GRANT ALL ON %s.* TO '%s'@'localhost'"
             "IDENTIFIED BY '%s';\n"
-            % (self.dbname, self.dbname, self.dbname, self.user, self.password)
+            % (dbname, dbname, dbname, self.user, self.password)
         )
-        outs, errs = p.communicate(input=grant)
+
+    def _createwikidb(self):
+        """Create a database and necessary grants.
+        Will drop existing database if it already exists."""
+        self.log.info('Creating the wiki database and grant')
+        self._mysql(self._createdb_sql(self.dbname))
+
+    def clone_databases(self, count):
+        names = self.clone_names(count)
+        self.log.info('Cloning database %s to %s', self.dbname, names)
+
+        tables = self._mysql(
+            "SELECT table_name FROM information_schema.tables"
+            " WHERE table_schema = '%s' AND table_type = 'BASE TABLE';\n"
+            % self.dbname
+        ).split()
+
+        # Copy table by table within the server, saving a dump and reload
+        sql = ['SET SESSION foreign_key_checks = 0;\n']
+        for name in names:
+            sql.append(self._createdb_sql(name))
+            for table in tables:
+                sql.append(
+                    "CREATE TABLE `%s`.`%s` LIKE `%s`.`%s`;"
+                    "INSERT INTO `%s`.`%s` SELECT * FROM `%s`.`%s`;\n"
+                    % ((name, table, self.dbname, table) * 2)
+                )
+        self._mysql(''.join(sql))
+        return names
+
+    def snapshot(self, path):
+        with open(os.path.join(path, 'mysql.sql'), 'w') as f:
+            p = subprocess.Popen(
+                [
+                    'mysqldump',
+                    '--socket=%s' % self.socket,
+                    '--user=root',
+                    '--single-transaction',
+                    '--skip-dump-date',
+                    self.dbname,
+                ],
+                text=True,
+                stdout=f,
+                stderr=subprocess.PIPE,
+            )
+            outs, errs = p.communicate()
         if p.returncode != 0:
-            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+            raise Exception("FAILED (%s): %s" % (p.returncode, errs))
+        return True
+
+    def restore(self, path):
+        with open(os.path.join(path, 'mysql.sql')) as f:
+            self._mysql('USE %s;\n%s' % (self.dbname, f.read()))
+        return True
 
     def start(self):
         self.log.info('Starting MySQL')
@@ -330,28 +792,19 @@ class MySQL(DatabaseServer):
         self._install_db()
 
         self.server = subprocess.Popen(
-            [
-                '/usr/sbin/mysqld',  # fixme drop path
-                '--skip-networking',
-                '--innodb-print-all-deadlocks',
-                '--datadir=%s' % self.rootdir,
-                '--log-error=%s' % self.errorlog,
-                '--pid-file=%s' % self.pidfile,
-                '--socket=%s' % self.socket,
-            ],
+            self._mysqld_command(),
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         )
 
-        while not os.path.exists(self.socket):
-            if self.server.poll() is not None:
-                with open(self.errorlog) as errlog:
-                    print(errlog.read())
-                raise Exception(
-                    "MySQL died during startup (%s)" % self.server.returncode
-                )
-            self.log.info("Waiting for MySQL socket")
-            time.sleep(1)
+        self.log.info('Waiting for MySQL socket')
+        _wait_for(
+            lambda: _unix_socket_ready(self.socket),
+            'MySQL',
+            timeout=60,
+            process=self.server,
+            errorlog=self.errorlog,
+        )
 
         self._createwikidb()
         self.log.info('MySQL is ready')
@@ -360,18 +813,25 @@ class MySQL(DatabaseServer):
         dumpfile = os.path.join(self.dump_dir, 'mysqldump.sql')
         self.log.info('Dumping database to %s', dumpfile)
 
-        mysqldump = open(dumpfile, 'wb')
-        subprocess.Popen(
-            [
-                'mysqldump',
-                '--socket=%s' % self.socket,
-                '--user=root',
-                '--all-databases',
-            ],
-            stdin=subprocess.PIPE,
-            stdout=mysqldump,
-            stderr=subprocess.STDOUT,
-        ).wait()
+        with open(dumpfile, 'wb') as mysqldump:
+            try:
+                subprocess.run(
+                    [
+                        'mysqldump',
+                        '--socket=%s' % self.socket,
+                        '--user=root',
+                        '--all-databases',
+                    ],
+                    stdin=subprocess.DEVNULL,
+                    stdout=mysqldump,
+                    stderr=subprocess.STDOUT,
+                    timeout=self.dump_timeout,
+                )
+            except subprocess.TimeoutExpired:
+                self.log.warning(
+                    'Database dump timed out after %s seconds',
+                    self.dump_timeout,
+                )
 
     def __str__(self):
         return "<{} {}>".format(
@@ -383,14 +843,64 @@ class MySQL(DatabaseServer):
 @db_backend('sqlite')
 class SQLite(DatabaseServer):
     def __init__(
-        self, base_dir=None, dump_dir=None, log_dir=None, dbname='wikidb'
+        self,
+        base_dir=None,
+        dump_dir=None,
+        log_dir=None,
+        dbname='wikidb',
+        template_dir=None,
     ):
-        super(SQLite, self).__init__(base_dir, dump_dir, log_dir)
+        super(SQLite, self).__init__(base_dir, dump_dir, log_dir, template_dir)
 
         self.dbname = dbname
 
+    def clone_databases(self, count):
+        # One file per database avoids contention on the SQLite file lock.
+        # The copies share their blocks with the original on copy-on-write
+        # filesystems, else are plain copies which are cheap when the
+        # database dir (--db-dir) is on a tmpfs.
+        #
+        # The installer creates more databases next to the wiki one: the job
+        # queue and localisation cache named after it, and the object cache
+        # "wikicache". The shards get their own copy of each, the
+        # LocalSettings.php template points MW_DB at them.
+        names = self.clone_names(count)
+        self.log.info('Cloning database %s to %s', self.dbname, names)
+
+        derived = {
+            '%s.sqlite' % self.dbname: '%s.sqlite',
+            '%s_jobqueue.sqlite' % self.dbname: '%s_jobqueue.sqlite',
+            '%s_l10n_cache.sqlite' % self.dbname: '%s_l10n_cache.sqlite',
+            'wikicache.sqlite': '%s_wikicache.sqlite',
+        }
+        for source, target in derived.items():
+            source = os.path.join(self.rootdir, source)
+            if not os.path.exists(source):
+                continue
+            for name in names:
+                quibble.util.clone_file(
+                    source, os.path.join(self.rootdir, target % name)
+                )
+        return names
+
+    def snapshot(self, path):
+        # The installer creates other database files next to the wiki one
+        for name in os.listdir(self.rootdir):
+            if name.endswith('.sqlite'):
+                quibble.util.clone_file(
+                    os.path.join(self.rootdir, name), os.path.join(path, name)
+                )
+        return True
+
+    def restore(self, path):
+        quibble.util.clone_tree(path, self.rootdir)
+        return True
+
 
 class ChromeWebDriver(BackendServer):
+    requires = frozenset({'display'})
+    provides = frozenset({'webdriver'})
+
     def __init__(self, display=None, port=4444, url_base='/wd/hub'):
         super(ChromeWebDriver, self).__init__()
 
@@ -400,39 +910,39 @@ class ChromeWebDriver(BackendServer):
 
     def start(self):
         self.log.info('Starting Chromedriver')
-        try:
-            prev_display = os.environ.get('DISPLAY', None)
-            if self.display:
-                # We need DISPLAY in the env for chromium_flags()
-                os.environ.update({'DISPLAY': self.display})
-            env = {
-                'CHROMIUM_FLAGS': quibble.chromium_flags(),
-                'PATH': os.environ.get('PATH'),
-            }
+        # Backends start concurrently, the process environment must not be
+        # altered.
+        env = {
+            'CHROMIUM_FLAGS': quibble.chromium_flags(self.display),
+            'PATH': os.environ.get('PATH'),
+        }
 
-            if self.display is not None:
-                # Pass it to chromedriver
-                env.update({'DISPLAY': self.display})
+        if self.display is not None:
+            # Pass it to chromedriver
+            env.update({'DISPLAY': self.display})
 
-            self.server = subprocess.Popen(
-                [
-                    'chromedriver',
-                    '--port=%s' % self.port,
-                    '--url-base=%s' % self.url_base,
-                ],
-                env=env,
-                text=True,
-                bufsize=1,  # line buffered
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-            )
-            _stream_relay(self.server, self.server.stderr, self.log.warning)
-
-        finally:
-            if prev_display:
-                os.environ.update({'DISPLAY': prev_display})
-            elif prev_display is None and self.display:
-                del os.environ['DISPLAY']
+        self.server = subprocess.Popen(
+            [
+                'chromedriver',
+                '--port=%s' % self.port,
+                '--url-base=%s' % self.url_base,
+            ],
+            env=env,
+            text=True,
+            bufsize=1,  # line buffered
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        _stream_relay(self.server, self.server.stderr, self.log.warning)
+        _wait_for(
+            lambda: _http_ready(
+                'http://127.0.0.1:%s%s/status'
+                % (self.port, self.url_base.rstrip('/'))
+            ),
+            'Chromedriver',
+            timeout=10,
+            process=self.server,
+        )
 
     def __str__(self):
         return "<ChromeWebDriver {}>".format(self.display)
@@ -440,6 +950,8 @@ class ChromeWebDriver(BackendServer):
 
 class WebserverEngine(BackendServer):
     default_url = None
+    requires = frozenset({'sources'})
+    provides = frozenset({'web'})
 
     def __init__(self, url=None, mwdir=None):
         super(WebserverEngine, self).__init__()
@@ -516,6 +1028,8 @@ class PhpWebserver(WebserverEngine):
 
 
 class Xvfb(BackendServer):
+    provides = frozenset({'display'})
+
     def __init__(self, display=':94'):
         super(Xvfb, self).__init__()
         self.display = display
@@ -532,12 +1046,20 @@ class Xvfb(BackendServer):
                 # fmt: on
             ]
         )
+        _wait_for(
+            lambda: _x_display_ready(self.display),
+            'Xvfb',
+            timeout=10,
+            process=self.server,
+        )
 
     def __str__(self):
         return "<Xvfb {}>".format(self.display)
 
 
 class Memcached(BackendServer):
+    provides = frozenset({'memcached'})
+
     def __init__(self, port=11211):
         super(Memcached, self).__init__()
         self.port = port
@@ -571,6 +1093,8 @@ class Memcached(BackendServer):
 
 
 class OpenSearch(BackendServer):
+    provides = frozenset({'search'})
+
     def __init__(self):
         super(OpenSearch, self).__init__()
         self.port = 9200
@@ -30,6 +30,7 @@ import quibble.mediawiki.maintenance
 import quibble.backend
 import quibble.zuul
 import quibble.commands
+import quibble.scheduler
 import quibble.util
 
 log = logging.getLogger('quibble.cmd')
@@ -72,6 +73,8 @@ class MultipleChoices(list):
 class QuibbleCmd(object):
     def __init__(self):
         self._context_stack = contextlib.ExitStack()
+        # Set by build_execution_plan() with --console=tail
+        self.step_logs = None
 
     def _setup_environment(
         self,
@@ -201,6 +204,11 @@ class QuibbleCmd(object):
         else:
             db_dir = None
 
+        if args.durations_db is not None:
+            durations_db = os.path.join(workspace, args.durations_db)
+        else:
+            durations_db = None
+
         if args.dump_db_postrun:
             dump_dir = log_dir
         else:
@@ -228,6 +236,9 @@ class QuibbleCmd(object):
         else:
             log.debug("ZUUL_PROJECT=%s", zuul_project)
 
+        # Branch being tested, to keep track of results across builds
+        branch = args.branch or os.getenv('ZUUL_BRANCH') or 'master'
+
         is_core = zuul_project == 'mediawiki/core'
         is_extension = (
             zuul_project.startswith('mediawiki/extensions/')
@@ -237,6 +248,31 @@ class QuibbleCmd(object):
         is_vendor = zuul_project == 'mediawiki/vendor'
 
         use_composer = args.packages_source == 'composer'
+        stream_output = args.parallel_output == 'stream'
+
+        phpunit_result_cache = None
+        if args.phpunit_result_cache == 'memcached':
+            if args.memcached_server is None:
+                raise Exception(
+                    '--phpunit-result-cache=memcached requires '
+                    '--memcached-server'
+                )
+            phpunit_result_cache = quibble.commands.PhpUnitResultCache(
+                [zuul_project, branch],
+                memcached_server=args.memcached_server,
+            )
+        elif args.phpunit_result_cache is not None:
+            phpunit_result_cache = quibble.commands.PhpUnitResultCache(
+                [zuul_project, branch],
+                cache_dir=os.path.join(workspace, args.phpunit_result_cache),
+            )
+
+        # An interactive shell needs the console
+        if args.console == 'tail' and args.shell is None:
+            self.step_logs = quibble.commands.StepLogs(
+                os.path.join(log_dir, 'steps'), tail_lines=args.console_tail
+            )
+            quibble.backend.relay_to_files(log_dir)
         use_vendor = args.packages_source == 'vendor'
 
         self._setup_environment(
@@ -265,8 +301,27 @@ class QuibbleCmd(object):
         run_composer = 'composer-test' in stages
         run_npm = 'npm-test' in stages
 
+        install_snapshot_dir = None
+        if args.install_snapshot_dir is not None and not args.db_is_external:
+            install_snapshot_dir = os.path.join(
+                workspace, args.install_snapshot_dir
+            )
+
+        l10n_cache_dir = None
+        if args.l10n_cache_dir is not None:
+            l10n_cache_dir = os.path.join(workspace, args.l10n_cache_dir)
+
+        db_template_dir = None
+        if args.db_template_dir is not None:
+            db_template_dir = os.path.join(workspace, args.db_template_dir)
+
         database_backend = quibble.backend.getDatabase(
-            args.db, db_dir, dump_dir, log_dir
+            args.db,
+            db_dir,
+            dump_dir,
+            log_dir,
+            db_template_dir,
+            profile=args.db_profile,
         )
 
         web_backend_args = {}
@@ -284,7 +339,14 @@ class QuibbleCmd(object):
         # Interactive shell does not need a report
         if args.shell is None:
             plan.append(
-                quibble.commands.ReportDurations(self._context_stack, log_dir)
+                quibble.commands.ReportDurations(
+                    self._context_stack,
+                    log_dir,
+                    durations_db=durations_db,
+                    project=zuul_project,
+                    branch=branch,
+                    workspace=workspace,
+                )
             )
 
         plan.append(quibble.commands.ReportVersions())
@@ -295,6 +357,7 @@ class QuibbleCmd(object):
             zuul_params = {
                 'branch': args.branch,
                 'cache_dir': args.git_cache,
+                'clone_mode': args.git_clone_mode,
                 'project_branch': args.project_branch,
                 'workers': args.git_parallel,
                 'workspace': os.path.join(workspace, 'src'),
@@ -357,6 +420,8 @@ class QuibbleCmd(object):
                         quibble.commands.Parallel(
                             name="npm and composer tests, if present",
                             steps=parallel_steps,
+                            stream_output=stream_output,
+                            step_logs=self.step_logs,
                         ),
                         quibble.commands.GitClean(project_dir),
                     ]
@@ -410,6 +475,8 @@ class QuibbleCmd(object):
                     log_dir=log_dir,
                     memcached_port=memcached_port,
                     tmp_dir=tmp_dir,
+                    snapshot_dir=install_snapshot_dir,
+                    l10n_cache_dir=l10n_cache_dir,
                 )
             )
 
@@ -429,6 +496,8 @@ class QuibbleCmd(object):
             quibble.commands.Parallel(
                 name="Post-dependency install, pre-database dependent steps",
                 steps=parallel_steps,
+                stream_output=stream_output,
+                step_logs=self.step_logs,
             )
         )
 
@@ -436,7 +505,10 @@ class QuibbleCmd(object):
         if 'phpunit-unit' in stages:
             plan.append(
                 quibble.commands.PhpUnitUnit(
-                    mw_install_path, log_dir, args.phpunit_junit
+                    mw_install_path,
+                    log_dir,
+                    args.phpunit_junit,
+                    result_cache=phpunit_result_cache,
                 )
             )
 
@@ -465,16 +537,34 @@ class QuibbleCmd(object):
                 )
                 stages.remove('phpunit-parallel')
 
-            # MediaWiki has concurrency issues with SQLite.
+            # MediaWiki has concurrency issues with SQLite, unless each
+            # process has its own database file.
             # https://phabricator.wikimedia.org/T407954#11690025
-            if args.db == 'sqlite':
+            if args.db == 'sqlite' and args.phpunit_sharding != 'quibble':
                 log.warning(
-                    'phpunit-parallel not supported with sqlite (T407954)'
+                    'phpunit-parallel with sqlite requires '
+                    '--phpunit-sharding=quibble (T407954)'
                     ' - reverting to serial run'
                 )
                 stages.remove('phpunit-parallel')
 
-        if 'phpunit-parallel' in stages:
+        phpunit_timings = None
+        if args.phpunit_timings:
+            phpunit_timings = os.path.join(workspace, args.phpunit_timings)
+
+        if 'phpunit-parallel' in stages and args.phpunit_sharding == 'quibble':
+            plan.append(
+                quibble.commands.PhpUnitShards(
+                    mw_install_path,
+                    phpunit_testsuite,
+                    log_dir,
+                    args.phpunit_shards,
+                    database=False,
+                    junit=args.phpunit_junit,
+                    timings=phpunit_timings,
+                )
+            )
+        elif 'phpunit-parallel' in stages:
             plan.append(
                 quibble.commands.PhpUnitPrepareParallelRunComposer(
                     mw_install_path,
@@ -499,6 +589,7 @@ class QuibbleCmd(object):
                     phpunit_testsuite,
                     log_dir,
                     args.phpunit_junit,
+                    result_cache=phpunit_result_cache,
                 )
             )
 
@@ -510,6 +601,7 @@ class QuibbleCmd(object):
                     log_dir,
                     repo_path,
                     args.phpunit_junit,
+                    result_cache=phpunit_result_cache,
                 )
             )
 
@@ -541,7 +633,10 @@ class QuibbleCmd(object):
             if parallel_steps:
                 plan.append(
                     quibble.commands.Parallel(
-                        name=" and ".join(label), steps=parallel_steps
+                        name=" and ".join(label),
+                        steps=parallel_steps,
+                        stream_output=stream_output,
+                        step_logs=self.step_logs,
                     )
                 )
 
@@ -598,6 +693,8 @@ class QuibbleCmd(object):
                         name="Parallel npm install for projects with "
                         "'selenium-test' in package.json",
                         steps=parallel_steps,
+                        stream_output=stream_output,
+                        step_logs=self.step_logs,
                     )
                 )
 
@@ -630,10 +727,24 @@ class QuibbleCmd(object):
                     phpunit_testsuite,
                     log_dir,
                     args.phpunit_junit,
+                    result_cache=phpunit_result_cache,
                 )
             )
 
-        if 'phpunit-parallel' in stages:
+        if 'phpunit-parallel' in stages and args.phpunit_sharding == 'quibble':
+            plan.append(
+                quibble.commands.PhpUnitShards(
+                    mw_install_path,
+                    phpunit_testsuite,
+                    log_dir,
+                    args.phpunit_shards,
+                    database=True,
+                    junit=args.phpunit_junit,
+                    timings=phpunit_timings,
+                    db=database_backend,
+                )
+            )
+        elif 'phpunit-parallel' in stages:
             plan.append(
                 quibble.commands.PhpUnitDatabaseParallelComposer(
                     mw_install_path,
@@ -653,7 +764,8 @@ class QuibbleCmd(object):
                 )
             )
 
-        if 'phpunit-parallel' in stages:
+        # The notice is about the MediaWiki composer scripts
+        if 'phpunit-parallel' in stages and args.phpunit_sharding != 'quibble':
             plan.append(quibble.commands.PhpUnitParallelNotice())
 
         if success_cache is not None:
@@ -661,20 +773,49 @@ class QuibbleCmd(object):
 
         return project_dir, plan
 
-    def execute(self, plan, project_dir, reporting_url=None, dry_run=False):
+    def execute(
+        self,
+        plan,
+        project_dir,
+        reporting_url=None,
+        dry_run=False,
+        scheduler='linear',
+        stream_output=False,
+    ):
         log.debug("Project dir: %s", project_dir)
         log.debug("Reporting URL: %s", reporting_url or "not specified")
         log.debug("Execution plan:")
         for cmd in plan:
             log.debug(cmd)
+
+        graph = None
+        if scheduler == 'dag':
+            graph = quibble.scheduler.Scheduler(
+                plan, stream_output=stream_output, step_logs=self.step_logs
+            )
+            log.debug(graph)
+
         if dry_run:
             log.warning("Exiting without execution: --dry-run")
             return
 
         with self._context_stack:
+            if graph is not None:
+                try:
+                    graph.execute()
+                except subprocess.CalledProcessError as called_process_error:
+                    self.earlywarn(
+                        called_process_error,
+                        graph.failed_command,
+                        project_dir,
+                        reporting_url,
+                    )
+                    raise called_process_error
+                return
+
             for command in plan:
                 try:
-                    quibble.commands.execute_command(command)
+                    quibble.commands.execute_command(command, self.step_logs)
                 except quibble.commands.SuccessCache.Hit as success_cache_hit:
                     raise success_cache_hit
                 except subprocess.CalledProcessError as called_process_error:
@@ -769,6 +910,42 @@ def get_arg_parser():
         action='store_true',
         help='Stop before executing any commands.',
     )
+    global_opts.add_argument(
+        '--scheduler',
+        choices=['linear', 'dag'],
+        default='linear',
+        help='How to run the commands. "linear" runs them one after the '
+        'other. "dag" runs each command as soon as the commands it depends '
+        'on are completed. Always "linear" with --shell. Default: linear',
+    )
+    global_opts.add_argument(
+        '--parallel-output',
+        choices=['buffered', 'stream'],
+        default='buffered',
+        help='How to show the output of commands running in parallel. '
+        '"buffered" shows the whole output of a command once it completes. '
+        '"stream" shows lines as they come, prefixed by the command name. '
+        'Default: buffered',
+    )
+    global_opts.add_argument(
+        '--console',
+        choices=['full', 'tail'],
+        default='full',
+        help='What to show on the console. "full" shows the output of all '
+        'commands. "tail" writes the output of each command to its own file '
+        'under LOG_DIR/steps and the output of backends to '
+        'LOG_DIR/backend-*.log; the console only shows the start and finish '
+        'of commands and the last lines of a failing one. Ignored with '
+        '--shell. Default: full',
+    )
+    global_opts.add_argument(
+        '--console-tail',
+        default=50,
+        type=int,
+        metavar='LINES',
+        help='With --console=tail, number of lines of a failing command to '
+        'show. Default: 50',
+    )
     global_opts.add_argument(
         '--workspace',
         default='/workspace' if quibble.is_in_docker() else os.getcwd(),
@@ -781,6 +958,14 @@ def get_arg_parser():
         help='Where logs and artifacts will be written to. '
         'Default: "log" relatively to workspace',
     )
+    global_opts.add_argument(
+        '--durations-db',
+        default=None,
+        help='SQLite database where the durations of each run are kept, '
+        'keyed by project, branch and Quibble version. Compare runs with '
+        '"quibble-durations compare". '
+        'If relative, relatively to workspace. Default: none',
+    )
     global_opts.add_argument(
         '--reporting-url',
         default=None,
@@ -821,6 +1006,18 @@ def get_arg_parser():
         'operation. Passed to zuul-cloner as --cache-dir. '
         'In Docker: "/srv/git", else "ref"',
     )
+    git_ops.add_argument(
+        '--git-clone-mode',
+        choices=['full', 'blobless', 'shallow'],
+        default='full',
+        help=(
+            'How repositories are cloned when they are not in the git '
+            'cache. "blobless" fetches file contents on checkout, '
+            '"shallow" only fetches the tip of the branches. The project '
+            'under test (ZUUL_PROJECT) is always fully cloned. '
+            'Default: full'
+        ),
+    )
     git_ops.add_argument(
         '--git-parallel',
         default=4,
@@ -899,6 +1096,58 @@ def get_arg_parser():
             'Default: %s' % tempfile.gettempdir()
         ),
     )
+    install.add_argument(
+        '--db-profile',
+        choices=['default', 'ephemeral'],
+        default='default',
+        help=(
+            'Configuration of the database server. "ephemeral" is meant '
+            'for throwaway databases: data is held on a tmpfs (%s) unless '
+            '--db-dir is set and durability is turned off. For mysql: no '
+            'binary log, no log flush on commit, no doublewrite buffer and '
+            'no performance schema. For postgres: no fsync, no synchronous '
+            'commit and no full page writes. Default: default'
+            % quibble.backend.DatabaseServer.ephemeral_dir
+        ),
+    )
+    install.add_argument(
+        '--db-template-dir',
+        default=None,
+        help=(
+            'Directory caching pre-initialized database files between '
+            'runs, keyed by the database server version and options. '
+            'Used by mysql to skip mysql_install_db and by postgres to '
+            'skip initdb. '
+            'If set and relative, relatively to workspace. '
+            'Default: none'
+        ),
+    )
+    install.add_argument(
+        '--install-snapshot-dir',
+        default=None,
+        help=(
+            'Directory keeping a snapshot of the installed database and '
+            'LocalSettings.php between runs. The snapshot is reused when '
+            'the MediaWiki version, the extensions and skins and their '
+            'database schema files are the same, which skips the MediaWiki '
+            'installer and update.php. '
+            'Ignored with --db-is-external. '
+            'If set and relative, relatively to workspace. '
+            'Default: none'
+        ),
+    )
+    install.add_argument(
+        '--l10n-cache-dir',
+        default=None,
+        help=(
+            'Directory keeping the MediaWiki localisation cache between '
+            'runs. The cache is reused as long as the messages files of the '
+            'repositories are unchanged. It refers to the messages files by '
+            'their absolute path and is thus keyed by the workspace path. '
+            'If set and relative, relatively to workspace. '
+            'Default: none'
+        ),
+    )
     install.add_argument(
         '--db-is-external',
         action='store_true',
@@ -948,6 +1197,40 @@ def get_arg_parser():
         action='store_true',
         help='PHPUnit: enable Junit reporting to LOG_DIR',
     )
+    tests.add_argument(
+        '--phpunit-result-cache',
+        default=None,
+        metavar='DIR',
+        help='PHPUnit: keep the result cache of each run in DIR (relatively '
+        'to workspace) or in memcached when set to "memcached" (requires '
+        '--memcached-server). Tests which failed in the previous build of '
+        'the same project and branch are run first. Default: none',
+    )
+    tests.add_argument(
+        '--phpunit-sharding',
+        choices=['composer', 'quibble'],
+        default='composer',
+        help='PHPUnit: how phpunit-parallel splits the tests. "composer" '
+        'relies on MediaWiki composer scripts, "quibble" lists the test '
+        'classes and balances them between shards using the durations '
+        'found in --phpunit-timings. Default: composer',
+    )
+    tests.add_argument(
+        '--phpunit-shards',
+        type=int,
+        default=os.cpu_count() or 1,
+        metavar='N',
+        help='PHPUnit: number of shards with --phpunit-sharding=quibble. '
+        'Default: number of CPUs',
+    )
+    tests.add_argument(
+        '--phpunit-timings',
+        default=None,
+        metavar='PATH',
+        help='PHPUnit: JUnit file, or directory of JUnit files, from a '
+        'previous run (relatively to workspace). Used to balance shards '
+        'with --phpunit-sharding=quibble. Default: none',
+    )
 
     web = parser.add_argument_group('Web server')
     web.add_argument(
@@ -1067,6 +1350,8 @@ def main():
             project_dir=project_dir,
             reporting_url=args.reporting_url,
             dry_run=args.dry_run,
+            scheduler='linear' if args.shell else args.scheduler,
+            stream_output=args.parallel_output == 'stream',
         )
     except quibble.commands.SuccessCache.Hit:
         log.warning('Skipping remaining commands due to success cache hit')
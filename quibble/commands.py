@@ -1,16 +1,27 @@
 """Encapsulates each step of a job"""
 
+import collections
 import contextlib
+import functools
 import git
+import glob
 import hashlib
 import importlib.resources
 import io
+import itertools
 import json
 import logging
 import multiprocessing
 import os
 import os.path
+import queue
+import re
+import shutil
+import sqlite3
 import textwrap
+import threading
+import time
+import zlib
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -18,8 +29,19 @@ import requests
 import yaml
 
 from quibble.gitchangedinhead import GitChangedInHead
-from quibble.util import copylog, isExtOrSkin, ProgressReporter, strtobool
+from quibble.util import (
+    copylog,
+    isExtOrSkin,
+    OutputCapture,
+    ProgressReporter,
+    strtobool,
+)
+import quibble.cache
+import quibble.durations
+import quibble.gitplumbing
+import quibble.mediawiki.phpunit
 import quibble.mediawiki.registry
+import quibble.util
 import quibble.zuul
 import subprocess
 import sys
@@ -30,10 +52,67 @@ log = logging.getLogger(__name__)
 monitor_interval = 10
 
 
-def execute_command(command):
+def execute_command(command, step_logs=None):
     '''Shared decorator for execution'''
     with quibble.Chronometer(str(command), log.info):
-        command.execute()
+        # Steps of a Parallel command have their own log
+        if step_logs is None or isinstance(command, Parallel):
+            command.execute()
+        else:
+            with step_logs.capture(command):
+                command.execute()
+
+
+class StepLogs:
+    """Write the output of each command to its own file.
+
+    The output of a command, including logging and the output of its
+    subprocesses, is written to a file in `log_dir` instead of the console.
+    When the command fails, the last `tail_lines` lines of that file are
+    shown on the console.
+    """
+
+    def __init__(self, log_dir, tail_lines=50):
+        self.log_dir = log_dir
+        self.tail_lines = tail_lines
+
+    def _open(self, command):
+        name = re.sub(r'[^\w.-]+', '_', str(command).splitlines()[0])
+        name = name.strip('_')[:100] or 'step'
+        os.makedirs(self.log_dir, exist_ok=True)
+        # Commands running concurrently might have the same name
+        for suffix in itertools.count(1):
+            path = os.path.join(
+                self.log_dir,
+                '%s.log' % name
+                if suffix == 1
+                else '%s-%s.log' % (name, suffix),
+            )
+            try:
+                return open(path, 'xb')
+            except FileExistsError:
+                continue
+
+    @contextlib.contextmanager
+    def capture(self, command):
+        with self._open(command) as step_log:
+            try:
+                with quibble.util.redirect_all_streams(step_log):
+                    yield
+            except SuccessCache.Hit:
+                # Not a failure
+                raise
+            except Exception:
+                step_log.flush()
+                self._show_tail(step_log.name)
+                raise
+
+    def _show_tail(self, path):
+        with open(path, 'rb') as f:
+            tail = collections.deque(f, maxlen=self.tail_lines)
+        log.error('Last %s lines of %s:', len(tail), path)
+        sys.stdout.buffer.write(b''.join(tail))
+        sys.stdout.flush()
 
 
 def run(cmd: list, cwd: str, shell=False, env=None):
@@ -45,6 +124,10 @@ def run(cmd: list, cwd: str, shell=False, env=None):
     :param cwd: The current working directory.
     :param shell: Whether to set shell=True, default to False.
     :param env: The optional environment override, default to None.
+
+    The output is echoed to stdout and captured for the CalledProcessError
+    raised on failure. That capture is truncated to its head and tail, the
+    complete output being kept in a file under $LOG_DIR.
     """
 
     # We run attached to a terminal (ex: quibble -c bash), in which case there
@@ -55,7 +138,9 @@ def run(cmd: list, cwd: str, shell=False, env=None):
         subprocess.check_call(cmd, cwd=cwd, shell=shell, env=env)
         return
 
-    collected_output = b''
+    collected_output = OutputCapture(
+        name=_output_capture_name(cmd), spill_dir=os.getenv('LOG_DIR')
+    )
     with subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
@@ -67,23 +152,38 @@ def run(cmd: list, cwd: str, shell=False, env=None):
         # The process is opened in binary mode in order to accept invalid
         # Unicode emitted by the command (see 5c29fb1b and T318029).
         #
-        # `readline()` let us find new lines from the bytes stream and we
-        # output them immediately in order to keep the output interactive.
-        #
-        # py38: while line := proc.stdout.readline()
-        for line in iter(proc.stdout.readline, b''):
-            sys.stdout.buffer.write(line)
+        # read1() returns whatever is available, up to a large chunk, which
+        # we output immediately in order to keep the output interactive
+        # without paying a write and flush for each line.
+        for chunk in iter(lambda: proc.stdout.read1(64 * 1024), b''):
+            sys.stdout.buffer.write(chunk)
             sys.stdout.flush()
-            collected_output += line
+            collected_output.write(chunk)
+        _wait_accounted(proc)
+    # Keep the complete output of failing commands only
+    collected_output.close(keep=bool(proc.returncode))
     if proc.returncode:
         raise subprocess.CalledProcessError(
             proc.returncode,
             proc.args,
             # The process is in binary mode, we want to emit valid unicode
-            output=collected_output.decode('utf-8', errors='backslashreplace'),
+            output=collected_output.getvalue(),
         )
 
 
+def _output_capture_name(cmd):
+    program = cmd if isinstance(cmd, str) else cmd[0]
+    program = os.path.basename(str(program).split(' ')[0])
+    return 'output-%s' % re.sub(r'[^\w.-]', '_', program)
+
+
+def _wait_accounted(proc):
+    """Reap a process with wait4() to account its resource usage"""
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    quibble.record_child_rusage(rusage)
+
+
 def _timed_run(label, cmd, cwd, **kwargs):
     with quibble.Chronometer(label, log.info):
         run(cmd, cwd=cwd, **kwargs)
@@ -117,6 +217,9 @@ def _npm_install(project_dir, label=None):
 
 
 class ReportVersions:
+    requires = frozenset()
+    provides = frozenset()
+
     def execute(self):
         log.info("Python version: %s", sys.version)
 
@@ -173,8 +276,26 @@ class ReportVersions:
 
 
 class ReportDurations:
-    def __init__(self, context_stack, log_dir=None):
+    requires = frozenset()
+    provides = frozenset()
+    run_in_parent = True
+
+    def __init__(
+        self,
+        context_stack,
+        log_dir=None,
+        durations_db=None,
+        project=None,
+        branch=None,
+        workspace=None,
+    ):
         self.log_dir = log_dir
+        # Optional SQLite database keeping durations across runs
+        self.durations_db = durations_db
+        self.project = project
+        self.branch = branch
+        # Stripped from the stages recorded in durations_db
+        self.workspace = workspace
         context_stack.enter_context(self)
 
     def __enter__(self):
@@ -183,6 +304,9 @@ class ReportDurations:
     def __exit__(self, exc_type, exc_value, traceback):
         if self.log_dir:
             self.writeJsonReport(exc_type, exc_value)
+            self.writeTraceReport()
+        if self.durations_db:
+            self.recordDurations(exc_type)
         self.printReport()
 
     def execute(self):
@@ -198,8 +322,8 @@ class ReportDurations:
         # We cant use a dict comprehension since it does not retain order of
         # insertion.
         formatted = {}
-        for duration, command in quibble.DURATIONS:
-            formatted[command] = '%.03fs' % duration
+        for timing in quibble.DURATIONS:
+            formatted[timing.command] = '%.03fs' % timing.seconds
 
         # Width of terminal, or COLUMN, or 80
         try:
@@ -246,6 +370,28 @@ class ReportDurations:
 
         return report
 
+    def recordDurations(self, exc_type=None):
+        result = ReportDurations.result_from_exception(exc_type)
+        if result['success_cache_hit']:
+            # Nothing got run, that would skew the baseline
+            return
+
+        try:
+            quibble.durations.DurationsDB(self.durations_db).record(
+                self.project,
+                self.branch,
+                quibble.DURATIONS,
+                result['result'],
+                workspace=self.workspace,
+            )
+        except sqlite3.Error as e:
+            log.warning(
+                'Can not record durations in %s: %s', self.durations_db, e
+            )
+            return
+
+        log.info('Recorded durations in %s', self.durations_db)
+
     @staticmethod
     def result_from_exception(exc_type=None):
         # Set all logical conditions first
@@ -268,26 +414,97 @@ class ReportDurations:
 
         json_file = os.path.join(self.log_dir, 'quibble-durations.json')
         # Format the CommandTimingnamed tuple as dict to get a self explanatory
-        # json output.
+        # json output. Fields which are not known are omitted.
         json_report = {}
         json_report.update(ReportDurations.result_from_exception(exc_type))
         json_report.update(
             {
                 'durations': [
-                    timing._asdict() for timing in quibble.DURATIONS
+                    {
+                        k: v
+                        for k, v in timing._asdict().items()
+                        if v is not None
+                    }
+                    for timing in quibble.DURATIONS
                 ],
             }
         )
 
-        json.dump(json_report, open(json_file, 'w'))
+        with open(json_file, 'w') as f:
+            json.dump(json_report, f)
 
         log.info('Wrote durations to %s', json_file)
 
+    def writeTraceReport(self):
+        if not os.path.exists(self.log_dir):
+            return
+
+        trace_file = os.path.join(self.log_dir, 'quibble-trace.json')
+        with open(trace_file, 'w') as f:
+            json.dump(
+                ReportDurations._build_trace(quibble.DURATIONS, os.getpid()),
+                f,
+            )
+
+        log.info('Wrote trace to %s', trace_file)
+
+    @staticmethod
+    def _build_trace(timings, main_pid):
+        """Convert timings to the Trace Event Format
+
+        The trace can be loaded in chrome://tracing or https://ui.perfetto.dev
+        to show on a timeline which commands overlapped and where the time is
+        spent. Each process and thread gets its own track, commands nest by
+        time on their track.
+        """
+        events = []
+        pids = set()
+        for timing in timings:
+            if timing.start is None:
+                continue
+            pids.add(timing.pid)
+            event = {
+                'name': timing.command,
+                'cat': 'quibble',
+                'ph': 'X',
+                'ts': timing.start * 1e6,
+                'dur': timing.seconds * 1e6,
+                'pid': timing.pid,
+                'tid': timing.tid or timing.pid,
+            }
+            args = {}
+            if timing.parent is not None:
+                args['parent'] = timing.parent
+            if timing.rusage is not None:
+                args.update(timing.rusage)
+            if args:
+                event['args'] = args
+            events.append(event)
+
+        for pid in sorted(pids):
+            events.append(
+                {
+                    'name': 'process_name',
+                    'ph': 'M',
+                    'pid': pid,
+                    'args': {
+                        'name': 'quibble'
+                        if pid == main_pid
+                        else 'quibble worker %s' % pid
+                    },
+                }
+            )
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
     def __str__(self):
         return 'Report durations'
 
 
 class ZuulClone:
+    requires = frozenset()
+    provides = frozenset({'sources'})
+
     def __init__(
         self,
         branch,
@@ -301,6 +518,7 @@ class ZuulClone:
         zuul_project,
         zuul_ref,
         zuul_url,
+        clone_mode='full',
     ):
         self.branch = branch
         self.cache_dir = cache_dir
@@ -313,6 +531,7 @@ class ZuulClone:
         self.zuul_project = zuul_project
         self.zuul_ref = zuul_ref
         self.zuul_url = zuul_url
+        self.clone_mode = clone_mode
 
     def execute(self):
         quibble.zuul.clone(
@@ -327,6 +546,7 @@ class ZuulClone:
             self.zuul_project,
             self.zuul_ref,
             self.zuul_url,
+            clone_mode=self.clone_mode,
         )
 
     def __str__(self):
@@ -341,6 +561,9 @@ class ZuulClone:
 
 
 class ResolveRequires:
+    requires = frozenset({'sources'})
+    provides = frozenset({'sources'})
+
     def __init__(
         self,
         mw_install_path,
@@ -410,6 +633,9 @@ class ResolveRequires:
 
 
 class ExtSkinSubmoduleUpdate:
+    requires = frozenset({'sources'})
+    provides = frozenset({'sources'})
+
     def __init__(self, mw_install_path, jobs=None):
         self.mw_install_path = mw_install_path
         self.jobs = jobs
@@ -468,6 +694,9 @@ class ExtSkinSubmoduleUpdate:
 
 # Used to be bin/mw-create-composer-local.py
 class CreateComposerLocal:
+    requires = frozenset({'sources'})
+    provides = frozenset({'php_dependencies'})
+
     def __init__(self, mw_install_path, dependencies):
         self.mw_install_path = mw_install_path
         self.dependencies = dependencies
@@ -502,6 +731,8 @@ class CreateComposerLocal:
 class ExtSkinComposerTest:
     def __init__(self, directory):
         self.directory = directory
+        self.requires = frozenset({'sources'})
+        self.provides = frozenset({'composer:%s' % directory})
 
     def execute(self):
         if _repo_has_composer_script(self.directory, 'test'):
@@ -528,6 +759,8 @@ class ExtSkinComposerTest:
 class NpmTest:
     def __init__(self, directory):
         self.directory = directory
+        self.requires = frozenset({'sources'})
+        self.provides = frozenset({'npm:%s' % directory})
 
     def execute(self):
         if repo_has_npm_script(self.directory, 'test'):
@@ -545,6 +778,9 @@ class NpmTest:
 
 
 class CoreComposerTest:
+    requires = frozenset({'sources', 'php_dependencies'})
+    provides = frozenset()
+
     def __init__(self, mw_install_path):
         self.mw_install_path = mw_install_path
 
@@ -578,6 +814,9 @@ class CoreComposerTest:
 
 
 class NativeComposerDependencies:
+    requires = frozenset({'sources'})
+    provides = frozenset({'php_dependencies'})
+
     def __init__(self, mw_install_path):
         self.mw_install_path = mw_install_path
 
@@ -599,6 +838,9 @@ class NativeComposerDependencies:
 
 
 class VendorComposerDependencies:
+    requires = frozenset({'sources'})
+    provides = frozenset({'php_dependencies'})
+
     def __init__(self, mw_install_path, log_dir):
         self.mw_install_path = mw_install_path
         self.log_dir = log_dir
@@ -678,6 +920,8 @@ class NpmInstall:
             )
         self.with_package_command = with_package_command
         self.project = project
+        self.requires = frozenset({'sources'})
+        self.provides = frozenset({'npm:%s' % self.directory})
 
     def execute(self):
         if (
@@ -700,37 +944,485 @@ class NpmInstall:
 
 
 class StartBackends:
-    """Start backends and add to a global context stack, to be destroyed in
-    reverse order before application exit.
+    """Start backends and add to a global context stack, to be destroyed
+    before application exit.
+
+    Backends are started concurrently, each one as soon as the backends
+    providing what it requires are up (ChromeWebDriver requires the display
+    of Xvfb). They are stopped concurrently as well, each one after the
+    backends requiring it. Stopping is bounded by `stop_timeout` seconds,
+    backends which are still stopping are then left behind.
     """
 
+    run_in_parent = True
+    stop_timeout = 90
+
     def __init__(self, context_stack, backends):
         self.context_stack = context_stack
         self.backends = backends
 
+    @property
+    def requires(self):
+        return frozenset().union(
+            *[getattr(b, 'requires', ()) for b in self.backends]
+        )
+
+    @property
+    def provides(self):
+        return frozenset().union(
+            *[getattr(b, 'provides', ()) for b in self.backends]
+        )
+
     def execute(self):
-        """Atomically start each backend and add it to the shutdown stack."""
-        for context in self.backends + [self._exit()]:
-            self.context_stack.enter_context(context)
+        """Start the backends and add them to the shutdown stack.
 
-    def _service_names(self):
-        return " ".join([str(backend) for backend in self.backends])
+        If a backend fails to start, the ones already started are stopped.
+        """
+        started, error = self._run_graph(
+            self.backends,
+            self._dependencies(self.backends),
+            lambda backend: backend.__enter__(),
+        )
+        if error is not None:
+            self._stop(started)
+            raise error
+        self.context_stack.callback(self._exit, started)
 
-    @contextlib.contextmanager
-    def _exit(self):
-        """List which backends will be shut down.  This is run before the other
-        shutdown tasks.
+    @staticmethod
+    def _dependencies(backends):
+        """Indexes of the backends each backend requires"""
+        return [
+            {
+                j
+                for (j, other) in enumerate(backends)
+                if j != i
+                and getattr(backend, 'requires', frozenset())
+                & getattr(other, 'provides', frozenset())
+            }
+            for (i, backend) in enumerate(backends)
+        ]
+
+    @staticmethod
+    def _run_graph(backends, dependencies, action, timeout=None):
+        """Call action(backend) in threads, once for each backend.
+
+        A backend is acted upon once all its dependencies are done. When an
+        action raises, no further action is started.
+
+        Returns the backends for which the action succeeded and the first
+        exception raised, if any.
         """
-        yield
+        pending = list(range(len(backends)))
+        running = set()
+        done = set()
+        succeeded = []
+        error = None
+        completed = queue.Queue()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def worker(i):
+            try:
+                action(backends[i])
+                completed.put((i, None))
+            except BaseException as e:
+                completed.put((i, e))
+
+        while True:
+            if error is None:
+                for i in [i for i in pending if dependencies[i] <= done]:
+                    pending.remove(i)
+                    running.add(i)
+                    # Daemon threads do not prevent exiting when a backend
+                    # is stuck
+                    threading.Thread(
+                        target=worker, args=(i,), daemon=True
+                    ).start()
+            if not running:
+                break
+            try:
+                i, e = completed.get(
+                    timeout=None
+                    if deadline is None
+                    else max(0, deadline - time.monotonic())
+                )
+            except queue.Empty:
+                log.warning(
+                    'Gave up waiting for backends after %s seconds: %s',
+                    timeout,
+                    ' '.join(str(backends[i]) for i in sorted(running)),
+                )
+                break
+            running.remove(i)
+            done.add(i)
+            if e is None:
+                succeeded.append(backends[i])
+            elif error is None:
+                error = e
+
+        return succeeded, error
+
+    def _stop(self, backends):
+        dependencies = self._dependencies(backends)
+        # A backend is stopped after the ones requiring it
+        reverse = [
+            {j for j in range(len(backends)) if i in dependencies[j]}
+            for i in range(len(backends))
+        ]
+        _, error = self._run_graph(
+            backends,
+            reverse,
+            lambda backend: backend.__exit__(None, None, None),
+            timeout=self.stop_timeout,
+        )
+        return error
+
+    def _exit(self, backends):
         log.info("Shutting down backends: %s", self._service_names())
+        error = self._stop(backends)
+        if error is not None:
+            raise error
+
+    def _service_names(self):
+        return " ".join([str(backend) for backend in self.backends])
 
     def __str__(self):
         return "Start backends: {}".format(self._service_names())
 
 
+def _mediawiki_repos(mw_install_path):
+    """MediaWiki core and the extensions and skins it holds, all of which
+    are loaded by the installer (install.php --with-extensions)."""
+    yield mw_install_path
+    for kind in ('extensions', 'skins'):
+        yield from sorted(
+            os.path.dirname(path)
+            for path in glob.glob(os.path.join(mw_install_path, kind, '*', ''))
+        )
+
+
+def _mediawiki_trees(mw_install_path, paths):
+    """Yield the git tree hash of each of `paths` found in the HEAD of the
+    MediaWiki repositories, prefixed by the repository and the path.
+
+    paths: a list, or a function returning the list for a repository.
+    """
+    for repo in _mediawiki_repos(mw_install_path):
+        name = os.path.relpath(repo, mw_install_path)
+        with quibble.gitplumbing.Git(repo) as repo_git:
+            for path in paths(repo) if callable(paths) else paths:
+                sha = repo_git.object_id('HEAD:%s' % path)
+                if sha is not None:
+                    yield '%s/%s:%s' % (name, path, sha)
+
+
+class InstallSnapshot:
+    """Database and LocalSettings.php of an installed MediaWiki, kept between
+    builds.
+
+    Snapshots are saved in `snapshot_dir`, keyed by the SHA256 digest of the
+    given key data (which should hold the database type and the installer
+    arguments), of the MediaWiki version, of the extensions and skins found
+    under `mw_install_path` and of the git trees holding the database schema
+    of each of them (SCHEMA_PATHS). Changes to other files, notably the ones
+    of a patch under test, thus reuse the snapshot.
+
+    `volatile` maps names to values which differ between builds, such as the
+    database directory. They are replaced by their new value in the database
+    settings (VOLATILE_SETTINGS) of the restored LocalSettings.php and must
+    be replaced by their name in `key_data`.
+    """
+
+    # Paths in a repository defining the database schema and its updates. The
+    # registration file declares the LoadExtensionSchemaUpdates hook handler.
+    SCHEMA_PATHS = [
+        'sql',
+        'db_patches',
+        'schema',
+        'maintenance/archives',
+        'includes/installer',
+        'extension.json',
+        'skin.json',
+    ]
+
+    # Settings of LocalSettings.php which may hold volatile values
+    VOLATILE_SETTINGS = ['wgDBserver', 'wgSQLiteDataDir', 'wgDBpassword']
+
+    def __init__(
+        self, snapshot_dir, mw_install_path, db, key_data, volatile=None
+    ):
+        self.snapshot_dir = snapshot_dir
+        self.mw_install_path = mw_install_path
+        self.db = db
+        self.key_data = key_data
+        self.volatile = volatile or {}
+        self.__digest = None
+
+    def _version(self):
+        try:
+            with open(
+                os.path.join(self.mw_install_path, 'includes/Defines.php')
+            ) as f:
+                defines = f.read()
+        except FileNotFoundError:
+            return ''
+        m = re.search(r"define\(\s*'MW_VERSION',\s*'([^']+)'", defines)
+        return m.group(1) if m else ''
+
+    def _keys(self):
+        yield 'version:%s' % self._version()
+        for repo in _mediawiki_repos(self.mw_install_path):
+            yield os.path.relpath(repo, self.mw_install_path)
+        yield from _mediawiki_trees(self.mw_install_path, self.SCHEMA_PATHS)
+
+    def _digest(self):
+        if self.__digest is None:
+            h = hashlib.new('sha256')
+
+            for key in self.key_data:
+                h.update(key.encode('utf8') + b"\x00")
+
+            for key in self._keys():
+                h.update(key.encode('utf8') + b"\x00")
+
+            self.__digest = h.hexdigest()
+
+        return self.__digest
+
+    @property
+    def path(self):
+        return os.path.join(self.snapshot_dir, 'install-%s' % self._digest())
+
+    def restore(self, localsettings):
+        """Restore the database and write the installer LocalSettings.php
+        to `localsettings`. Returns whether a snapshot has been restored."""
+        if not os.path.isdir(self.path):
+            log.info('Install snapshot: MISS (%s)', self.path)
+            return False
+
+        log.info('Install snapshot: HIT (%s)', self.path)
+        if not self.db.restore(os.path.join(self.path, 'db')):
+            return False
+
+        with open(os.path.join(self.path, 'snapshot.json')) as f:
+            previous = json.load(f)['volatile']
+        with open(os.path.join(self.path, 'LocalSettings.php')) as f:
+            settings = f.read()
+
+        def replace_volatile(assignment):
+            line = assignment.group(0)
+            for name, value in self.volatile.items():
+                if previous.get(name):
+                    line = line.replace(previous[name], value)
+            return line
+
+        settings = re.sub(
+            r'^\s*\$(?:%s)\s*=.*$' % '|'.join(self.VOLATILE_SETTINGS),
+            replace_volatile,
+            settings,
+            flags=re.M,
+        )
+        with open(localsettings, 'w') as f:
+            f.write(settings)
+
+        return True
+
+    def save(self, localsettings):
+        """Save the database along with the installer `localsettings`"""
+        log.info('Saving install snapshot %s', self.path)
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            staging = tempfile.mkdtemp(
+                dir=self.snapshot_dir, prefix='.install-'
+            )
+        except OSError as e:
+            log.warning('Could not save install snapshot: %s', e)
+            return
+
+        try:
+            os.mkdir(os.path.join(staging, 'db'))
+            if not self.db.snapshot(os.path.join(staging, 'db')):
+                return
+            shutil.copyfile(
+                localsettings, os.path.join(staging, 'LocalSettings.php')
+            )
+            with open(os.path.join(staging, 'snapshot.json'), 'w') as f:
+                json.dump({'volatile': self.volatile}, f)
+            try:
+                os.rename(staging, self.path)
+            except OSError:
+                # Unless a concurrent build saved it first
+                if not os.path.isdir(self.path):
+                    raise
+        except Exception as e:
+            log.warning('Could not save install snapshot: %s', e)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+class LocalisationCache:
+    """Localisation cache files of MediaWiki, kept between builds.
+
+    The files generated by rebuildLocalisationCache in `tmp_dir` (the
+    MediaWiki $wgCacheDirectory) are saved in `cache_dir`, keyed by the
+    SHA256 digest of the given key data, of `mw_install_path` and of the git
+    trees holding the messages of MediaWiki core and of each extension and
+    skin, as declared in their registration file. The cache records the
+    absolute path of the messages files, it can not be shared between
+    different installation paths.
+
+    MediaWiki considers its cache expired when the modification time of a
+    messages file changed, which a fresh clone always does. The files under
+    the hashed paths are thus given a fixed modification time before
+    building a cache to save or restoring one: their content is known to be
+    the same.
+    """
+
+    # Paths in a repository holding messages or defining where they are
+    L10N_PATHS = [
+        'languages',
+        'includes/language',
+        'extension.json',
+        'skin.json',
+    ]
+    # Registration attributes listing messages directories and files
+    REGISTRATION_KEYS = [
+        'MessagesDirs',
+        'ExtensionMessagesFiles',
+        'TranslationAliasesDirs',
+    ]
+    FILES = 'l10n_cache-*'
+    # Fixed modification time of the messages files, 2001-01-15
+    MTIME = 979516800
+
+    def __init__(self, cache_dir, mw_install_path, tmp_dir, key_data):
+        self.cache_dir = cache_dir
+        self.mw_install_path = mw_install_path
+        self.tmp_dir = tmp_dir
+        self.key_data = key_data
+        self.__digest = None
+
+    def _paths(self, repo):
+        paths = list(self.L10N_PATHS)
+        for registration in ('extension.json', 'skin.json'):
+            try:
+                with open(os.path.join(repo, registration)) as f:
+                    spec = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key in self.REGISTRATION_KEYS:
+                for value in spec.get(key, {}).values():
+                    for path in [value] if isinstance(value, str) else value:
+                        path = os.path.normpath(path)
+                        # Only paths within the repository
+                        if path.startswith('..') or os.path.isabs(path):
+                            continue
+                        if path not in paths:
+                            paths.append(path)
+        return paths
+
+    def _digest(self):
+        if self.__digest is None:
+            h = hashlib.new('sha256')
+
+            for key in self.key_data:
+                h.update(key.encode('utf8') + b"\x00")
+            h.update(self.mw_install_path.encode('utf8') + b"\x00")
+
+            for tree in _mediawiki_trees(self.mw_install_path, self._paths):
+                h.update(tree.encode('utf8') + b"\x00")
+
+            self.__digest = h.hexdigest()
+
+        return self.__digest
+
+    @property
+    def path(self):
+        return os.path.join(self.cache_dir, 'l10n-%s' % self._digest())
+
+    def fix_mtimes(self):
+        times = (self.MTIME, self.MTIME)
+        for repo in _mediawiki_repos(self.mw_install_path):
+            for path in self._paths(repo):
+                path = os.path.join(repo, path)
+                if os.path.isfile(path):
+                    os.utime(path, times)
+                for root, dirs, files in os.walk(path):
+                    for name in files:
+                        os.utime(os.path.join(root, name), times)
+
+    def restore(self):
+        """Copy the cached files to `tmp_dir`, returns whether they were
+        found"""
+        if not os.path.isdir(self.path):
+            log.info('Localisation cache: MISS (%s)', self.path)
+            return False
+
+        log.info('Localisation cache: HIT (%s)', self.path)
+        self.fix_mtimes()
+        quibble.util.clone_tree(self.path, self.tmp_dir)
+        return True
+
+    def prepare_save(self):
+        """Prepare building a cache to save, returns whether it can be saved
+
+        Must be called before rebuilding the localisation cache, since the
+        modification times of the messages files are recorded in it.
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            log.warning('Could not save localisation cache: %s', e)
+            return False
+        if not os.access(self.cache_dir, os.W_OK | os.X_OK):
+            log.warning(
+                'Could not save localisation cache: %s is not writable',
+                self.cache_dir,
+            )
+            return False
+        self.fix_mtimes()
+        return True
+
+    def save(self):
+        log.info('Saving localisation cache %s', self.path)
+        try:
+            staging = tempfile.mkdtemp(dir=self.cache_dir, prefix='.l10n-')
+        except OSError as e:
+            log.warning('Could not save localisation cache: %s', e)
+            return
+
+        try:
+            for path in glob.glob(os.path.join(self.tmp_dir, self.FILES)):
+                quibble.util.clone_file(
+                    path, os.path.join(staging, os.path.basename(path))
+                )
+            try:
+                os.rename(staging, self.path)
+            except OSError:
+                # Unless a concurrent build saved it first
+                if not os.path.isdir(self.path):
+                    raise
+        except OSError as e:
+            log.warning('Could not save localisation cache: %s', e)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
 class InstallMediaWiki:
+    requires = frozenset(
+        {'sources', 'mediawiki', 'php_dependencies', 'database'}
+    )
+    provides = frozenset({'localsettings'})
+
     def __init__(
-        self, mw_install_path, db, web_url, log_dir, memcached_port, tmp_dir
+        self,
+        mw_install_path,
+        db,
+        web_url,
+        log_dir,
+        memcached_port,
+        tmp_dir,
+        snapshot_dir=None,
+        l10n_cache_dir=None,
     ):
         self.mw_install_path = mw_install_path
         self.db = db
@@ -738,14 +1430,49 @@ class InstallMediaWiki:
         self.log_dir = log_dir
         self.memcached_port = memcached_port
         self.tmp_dir = tmp_dir
+        self.snapshot_dir = snapshot_dir
+        self.l10n_cache_dir = l10n_cache_dir
+
+    def _snapshot(self):
+        if self.snapshot_dir is None:
+            return None
+
+        volatile = {'rootdir': self.db.rootdir}
+        # Set by the database server, possibly randomly (Postgres)
+        if getattr(self.db, 'password', None):
+            volatile['password'] = self.db.password
+
+        key_data = [self.db.type, self.web_url]
+        for arg in self._get_install_args():
+            for name, value in volatile.items():
+                arg = arg.replace(value, '{%s}' % name)
+            key_data.append(arg)
+
+        snapshot = InstallSnapshot(
+            self.snapshot_dir,
+            self.mw_install_path,
+            self.db,
+            key_data,
+            volatile,
+        )
+        try:
+            snapshot.path
+        except git.exc.InvalidGitRepositoryError as e:
+            log.warning('Install snapshot disabled, not a git repo: %s', e)
+            return None
+        return snapshot
 
     def execute(self):
         self.clearQuibbleLocalSettings()
-        quibble.mediawiki.maintenance.install(
-            args=self._get_install_args(), mwdir=self.mw_install_path
-        )
 
         localsettings = os.path.join(self.mw_install_path, 'LocalSettings.php')
+        snapshot = self._snapshot()
+        restored = snapshot is not None and snapshot.restore(localsettings)
+        if not restored:
+            quibble.mediawiki.maintenance.install(
+                args=self._get_install_args(), mwdir=self.mw_install_path
+            )
+
         localsettings_installer = os.path.join(
             self.mw_install_path, 'LocalSettings-installer.php'
         )
@@ -767,19 +1494,20 @@ class InstallMediaWiki:
             log_dir=self.log_dir,
         )
 
-        quibble.mediawiki.maintenance.addSite(
-            args=[
-                self.db.dbname,  # globalid
-                'CI',  # site-group
-                '--filepath=%s/$1' % self.web_url,
-                '--pagepath=%s/index.php?title=$1' % self.web_url,
-            ],
-            mwdir=self.mw_install_path,
-        )
-        quibble.mediawiki.maintenance.update(mwdir=self.mw_install_path)
-        quibble.mediawiki.maintenance.rebuildLocalisationCache(
-            lang=['en'], mwdir=self.mw_install_path
-        )
+        if not restored:
+            quibble.mediawiki.maintenance.addSite(
+                args=[
+                    self.db.dbname,  # globalid
+                    'CI',  # site-group
+                    '--filepath=%s/$1' % self.web_url,
+                    '--pagepath=%s/index.php?title=$1' % self.web_url,
+                ],
+                mwdir=self.mw_install_path,
+            )
+            quibble.mediawiki.maintenance.update(mwdir=self.mw_install_path)
+            if snapshot is not None:
+                snapshot.save(localsettings_installer)
+        self._rebuild_l10n_cache(lang=['en'])
 
         if strtobool(os.getenv('QUIBBLE_OPENSEARCH', 'false')):
             quibble.mediawiki.maintenance.updateSearchIndexConfig(
@@ -789,6 +1517,32 @@ class InstallMediaWiki:
                 mwdir=self.mw_install_path
             )
 
+    def _rebuild_l10n_cache(self, lang):
+        l10n_cache = None
+        if self.l10n_cache_dir is not None:
+            l10n_cache = LocalisationCache(
+                self.l10n_cache_dir, self.mw_install_path, self.tmp_dir, lang
+            )
+            try:
+                if l10n_cache.restore():
+                    return
+            except git.exc.InvalidGitRepositoryError as e:
+                log.warning(
+                    'Localisation cache disabled, not a git repo: %s', e
+                )
+                l10n_cache = None
+            else:
+                if not l10n_cache.prepare_save():
+                    l10n_cache = None
+
+        quibble.mediawiki.maintenance.rebuildLocalisationCache(
+            lang=lang,
+            mwdir=self.mw_install_path,
+            threads=min(len(lang), os.cpu_count() or 1),
+        )
+        if l10n_cache is not None:
+            l10n_cache.save()
+
     def clearQuibbleLocalSettings(self):
         marker = "# Quibble MediaWiki configuration\n"
         quibbleLocalSettings = os.path.join(
@@ -889,6 +1643,13 @@ class Phpbench:
         self.directory = directory
         self.composer_install = composer_install
         self.aggregate = aggregate
+        self.requires = frozenset(
+            {'sources', 'localsettings', 'php_dependencies'}
+        )
+        # Checks out HEAD~1 or installs then cleans dependencies
+        self.provides = frozenset(
+            {'sources'} if aggregate or composer_install else ()
+        )
 
     def execute(self):
         log.info(self)
@@ -942,7 +1703,75 @@ class Phpbench:
         return "Run phpbench"
 
 
+class PhpUnitResultCache:
+    """Keep PHPUnit result cache files between builds.
+
+    The result cache records which tests failed and how long each test took,
+    PHPUnit then runs the previously failed tests first. Files are kept per
+    project and branch, either in a local `cache_dir` or in memcached when
+    given a `memcached_server`.
+    """
+
+    def __init__(self, key_data, cache_dir=None, memcached_server=None):
+        """
+        key_data: list of strings identifying the build, e.g. the project
+        and branch.
+        """
+        self.key_data = key_data
+        self.cache_dir = cache_dir
+        self.memcached_server = memcached_server
+
+    def _digest(self):
+        h = hashlib.new('sha256')
+        for key in self.key_data:
+            h.update(key.encode('utf8') + b"\x00")
+        return h.hexdigest()
+
+    @contextlib.contextmanager
+    def cache_file(self, name):
+        """Yield the path of the named result cache file.
+
+        The file is saved on exit, even when PHPUnit failed since the
+        failures are what we want to remember.
+        """
+        if self.cache_dir:
+            directory = os.path.join(self.cache_dir, self._digest())
+            os.makedirs(directory, exist_ok=True)
+            yield os.path.join(directory, name)
+            return
+
+        client = quibble.cache.client(self.memcached_server)
+        key = 'phpunit-results/%s/%s' % (self._digest(), name)
+        with tempfile.TemporaryDirectory(prefix='phpunit-results') as tmp:
+            path = os.path.join(tmp, name)
+            try:
+                cached = client.get(key)
+            except Exception as e:
+                log.warning('Could not get PHPUnit results cache: %s', e)
+                cached = None
+            if cached is not None:
+                with open(path, 'wb') as f:
+                    f.write(zlib.decompress(cached))
+            try:
+                yield path
+            finally:
+                self._save(client, key, path)
+
+    @staticmethod
+    def _save(client, key, path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            data = zlib.compress(f.read())
+        try:
+            client.set(key, data)
+        except Exception as e:
+            log.warning('Could not save PHPUnit results cache: %s', e)
+
+
 class AbstractPhpUnit:
+    result_cache = None
+
     def get_phpunit_command(self, repo_path=None):
         phpunit_command = [
             'composer',
@@ -979,16 +1808,40 @@ class AbstractPhpUnit:
 
         if self.junit and self.junit_file:
             cmd.extend(['--log-junit', self.junit_file])
-        log.info(' '.join(cmd))
 
         phpunit_env = {}
         phpunit_env.update(os.environ)
         phpunit_env.update({'LANG': 'C.UTF-8'})
 
-        run(cmd, cwd=self.mw_install_path, env=phpunit_env)
+        with self._result_cache_file() as cache_result_file:
+            if cache_result_file:
+                cmd.extend(
+                    [
+                        '--cache-result-file',
+                        cache_result_file,
+                        '--order-by=defects,duration',
+                    ]
+                )
+            log.info(' '.join(cmd))
+            run(cmd, cwd=self.mw_install_path, env=phpunit_env)
+
+    def _result_cache_file(self):
+        # An explicit cache_result_file is passed by get_phpunit_command()
+        if self.result_cache is None or self.cache_result_file is not None:
+            return contextlib.nullcontext()
+        name = os.path.basename(self.junit_file)
+        name = name.replace('junit-', 'phpunit-').replace('.xml', '')
+        return self.result_cache.cache_file(
+            '%s-%s.result.cache' % (name, self.testsuite or 'default')
+        )
 
 
 class PhpUnitDatabaseless(AbstractPhpUnit):
+    requires = frozenset(
+        {'sources', 'localsettings', 'php_dependencies', 'memcached'}
+    )
+    provides = frozenset()
+
     def __init__(
         self,
         mw_install_path,
@@ -996,6 +1849,7 @@ class PhpUnitDatabaseless(AbstractPhpUnit):
         log_dir,
         junit=False,
         cache_result_file=None,
+        result_cache=None,
     ):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
@@ -1003,6 +1857,7 @@ class PhpUnitDatabaseless(AbstractPhpUnit):
         self.junit_file = os.path.join(self.log_dir, 'junit-dbless.xml')
         self.junit = junit
         self.cache_result_file = cache_result_file
+        self.result_cache = result_cache
 
     def execute(self):
         # XXX might want to run the triggered extension first then the
@@ -1018,6 +1873,11 @@ class PhpUnitDatabaseless(AbstractPhpUnit):
 
 
 class PhpUnitStandalone(AbstractPhpUnit):
+    requires = frozenset(
+        {'sources', 'localsettings', 'php_dependencies', 'memcached'}
+    )
+    provides = frozenset()
+
     def __init__(
         self,
         mw_install_path,
@@ -1026,6 +1886,7 @@ class PhpUnitStandalone(AbstractPhpUnit):
         repo_path,
         junit=False,
         cache_result_file=None,
+        result_cache=None,
     ):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
@@ -1034,6 +1895,7 @@ class PhpUnitStandalone(AbstractPhpUnit):
         self.junit_file = os.path.join(self.log_dir, 'junit-standalone.xml')
         self.junit = junit
         self.cache_result_file = cache_result_file
+        self.result_cache = result_cache
 
     def execute(self):
         self._run_phpunit(
@@ -1048,8 +1910,16 @@ class PhpUnitStandalone(AbstractPhpUnit):
 
 
 class PhpUnitUnit(AbstractPhpUnit):
+    requires = frozenset({'sources', 'localsettings', 'php_dependencies'})
+    provides = frozenset()
+
     def __init__(
-        self, mw_install_path, log_dir, junit=False, cache_result_file=None
+        self,
+        mw_install_path,
+        log_dir,
+        junit=False,
+        cache_result_file=None,
+        result_cache=None,
     ):
         self.mw_install_path = mw_install_path
         self.log_dir = log_dir
@@ -1057,6 +1927,7 @@ class PhpUnitUnit(AbstractPhpUnit):
         self.junit_file = os.path.join(self.log_dir, 'junit-unit.xml')
         self.junit = junit
         self.cache_result_file = cache_result_file
+        self.result_cache = result_cache
 
     def execute(self):
         if _repo_has_composer_script(self.mw_install_path, 'phpunit:unit'):
@@ -1070,6 +1941,17 @@ class PhpUnitUnit(AbstractPhpUnit):
 
 
 class PhpUnitDatabase(AbstractPhpUnit):
+    requires = frozenset(
+        {
+            'sources',
+            'localsettings',
+            'php_dependencies',
+            'memcached',
+            'database',
+        }
+    )
+    provides = frozenset()
+
     def __init__(
         self,
         mw_install_path,
@@ -1077,6 +1959,7 @@ class PhpUnitDatabase(AbstractPhpUnit):
         log_dir,
         junit=False,
         cache_result_file=None,
+        result_cache=None,
     ):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
@@ -1084,6 +1967,7 @@ class PhpUnitDatabase(AbstractPhpUnit):
         self.junit_file = os.path.join(self.log_dir, 'junit-db.xml')
         self.junit = junit
         self.cache_result_file = cache_result_file
+        self.result_cache = result_cache
 
     def execute(self):
         self._run_phpunit(group=['Database'], exclude_group=['Standalone'])
@@ -1105,6 +1989,9 @@ class PhpUnitPrepareParallelRunComposer:
     @see T365978
     """
 
+    requires = frozenset({'sources', 'localsettings', 'php_dependencies'})
+    provides = frozenset({'phpunit_parallel'})
+
     def __init__(
         self,
         mw_install_path,
@@ -1164,6 +2051,12 @@ class PhpUnitDatabaselessParallelComposer(AbstractParallelPhpUnit):
     """Run the tests in the provided suite in parallel, excluding
     Database and Standalone tests."""
 
+    requires = frozenset(
+        {'sources', 'localsettings', 'php_dependencies', 'memcached'}
+    )
+    # Shares the split suites and results with the other parallel run
+    provides = frozenset({'phpunit_parallel'})
+
     def execute(self):
         """Execute the parallel databaseless test suite"""
         phpunit_env = {}
@@ -1191,6 +2084,17 @@ class PhpUnitDatabaseParallelComposer(AbstractParallelPhpUnit):
     """Run the tests in the provided suite in parallel, excluding
     Standalone tests and including the Database tests."""
 
+    requires = frozenset(
+        {
+            'sources',
+            'localsettings',
+            'php_dependencies',
+            'memcached',
+            'database',
+        }
+    )
+    provides = frozenset({'phpunit_parallel'})
+
     def execute(self):
         """Execute the parallel databaseless test suite"""
         phpunit_env = {}
@@ -1213,6 +2117,222 @@ class PhpUnitDatabaseParallelComposer(AbstractParallelPhpUnit):
         ).format(self.testsuite or 'default')
 
 
+class PhpUnitShards(AbstractPhpUnit):
+    """Run the tests in the provided suite split in shards running in
+    parallel, either the Database tests or the ones without database.
+
+    Unlike the Composer parallel run, Quibble lists the test classes and
+    balances them between the shards using their durations from the JUnit
+    files found at `timings`. Each shard runs with a copy of the PHPUnit
+    configuration listing the files of its classes. See
+    quibble.mediawiki.phpunit.
+
+    When a database server `db` is given, each shard runs against its own
+    copy of the wiki database, passed to MediaWiki as MW_DB.
+    """
+
+    provides = frozenset({'phpunit_parallel'})
+
+    def __init__(
+        self,
+        mw_install_path,
+        testsuite,
+        log_dir,
+        shards,
+        database=False,
+        junit=False,
+        timings=None,
+        db=None,
+    ):
+        self.mw_install_path = mw_install_path
+        self.testsuite = testsuite
+        self.log_dir = log_dir
+        self.shards = shards
+        self.database = database
+        self.junit = junit
+        self.timings = timings
+        self.db = db
+        self.databases = []
+        self.cache_result_file = None
+        self.name = 'db' if database else 'dbless'
+
+        self.requires = frozenset(
+            {'sources', 'localsettings', 'php_dependencies', 'memcached'}
+            | ({'database'} if database else set())
+        )
+
+    def _groups(self):
+        if self.database:
+            return (['Database'], ['Broken', 'Standalone'])
+        return ([], ['Broken', 'Database', 'Standalone'])
+
+    def _list_classes(self, env):
+        """Test classes to run and the files defining them"""
+        list_tests_xml = os.path.join(
+            self.log_dir, 'phpunit-%s-tests.xml' % self.name
+        )
+        cmd = self.get_phpunit_command()
+        if self.testsuite:
+            cmd.extend(['--testsuite', self.testsuite])
+        cmd.extend(['--list-tests-xml', list_tests_xml])
+        run(cmd, cwd=self.mw_install_path, env=env)
+
+        group, exclude_group = self._groups()
+        classes = quibble.mediawiki.phpunit.list_test_classes(
+            list_tests_xml, group, exclude_group
+        )
+        files = quibble.mediawiki.phpunit.listed_class_files(list_tests_xml)
+        missing = [c for c in classes if c not in files]
+        if missing:
+            # PHPUnit 9 does not list the files
+            files.update(
+                quibble.mediawiki.phpunit.find_class_files(
+                    missing, self.mw_install_path
+                )
+            )
+        return classes, {
+            name: os.path.join(self.mw_install_path, files[name])
+            for name in classes
+        }
+
+    def _base_config(self):
+        # Same lookup as PHPUnit
+        config = os.path.join(self.mw_install_path, 'phpunit.xml')
+        if os.path.exists(config):
+            return config
+        return config + '.dist'
+
+    def _shard_config(self, index, files):
+        """Write the PHPUnit configuration of a shard, returns its path"""
+        config = os.path.join(
+            self.mw_install_path,
+            'phpunit-quibble-%s-shard-%s.xml' % (self.name, index),
+        )
+        quibble.mediawiki.phpunit.write_shard_config(
+            self._base_config(),
+            config,
+            'quibble-%s-shard-%s' % (self.name, index),
+            files,
+        )
+        return config
+
+    def _shard_command(self, index, config):
+        group, exclude_group = self._groups()
+        cmd = self.get_phpunit_command()
+        cmd.extend(['--configuration', config])
+        if group:
+            cmd.extend(['--group', ','.join(group)])
+        cmd.extend(['--exclude-group', ','.join(exclude_group)])
+        if self.junit:
+            cmd.extend(
+                [
+                    '--log-junit',
+                    os.path.join(
+                        self.log_dir,
+                        'junit-%s-shard-%s.xml' % (self.name, index),
+                    ),
+                ]
+            )
+        return cmd
+
+    def shard_env(self, index, env):
+        """Environment of the PHPUnit process of a shard"""
+        if not self.databases:
+            return env
+        return dict(env, MW_DB=self.databases[index - 1])
+
+    def execute(self):
+        env = {}
+        env.update(os.environ)
+        env.update({'LANG': 'C.UTF-8'})
+
+        classes, class_files = self._list_classes(env)
+        if not classes:
+            log.info('No tests to run')
+            return
+
+        durations = {}
+        if self.timings and os.path.exists(self.timings):
+            durations = quibble.mediawiki.phpunit.junit_durations(self.timings)
+        shards = quibble.mediawiki.phpunit.shard(
+            classes, durations, self.shards
+        )
+        if self.db is not None:
+            databases = self.db.clone_databases(len(shards))
+            if databases is None:
+                log.warning('Running the tests in a single shard')
+                shards = [(sum(s for s, _ in shards), classes)]
+            else:
+                self.databases = databases
+
+        procs = []
+        configs = []
+        try:
+            for index, (seconds, shard_classes) in enumerate(shards, start=1):
+                log.info(
+                    'Shard %s: %s test classes, estimated %.0fs',
+                    index,
+                    len(shard_classes),
+                    seconds,
+                )
+                shard_log = os.path.join(
+                    self.log_dir,
+                    'phpunit-%s-shard-%s.log' % (self.name, index),
+                )
+                # Files defining several classes are only listed once
+                files = dict.fromkeys(class_files[c] for c in shard_classes)
+                config = self._shard_config(index, list(files))
+                configs.append(config)
+                cmd = self._shard_command(index, config)
+                with open(shard_log, 'wb') as output:
+                    procs.append(
+                        (
+                            shard_log,
+                            subprocess.Popen(
+                                cmd,
+                                cwd=self.mw_install_path,
+                                env=self.shard_env(index, env),
+                                stdout=output,
+                                stderr=subprocess.STDOUT,
+                            ),
+                        )
+                    )
+
+            failed = None
+            for index, (shard_log, proc) in enumerate(procs, start=1):
+                _wait_accounted(proc)
+                log.info(
+                    'Shard %s exited with code %s, output:',
+                    index,
+                    proc.returncode,
+                )
+                capture = OutputCapture()
+                with open(shard_log, 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        sys.stdout.buffer.write(chunk)
+                        capture.write(chunk)
+                sys.stdout.flush()
+                if proc.returncode and failed is None:
+                    failed = subprocess.CalledProcessError(
+                        proc.returncode, proc.args, output=capture.getvalue()
+                    )
+        finally:
+            for config in configs:
+                os.unlink(config)
+
+        if failed is not None:
+            raise failed
+
+    def __str__(self):
+        return "PHPUnit {} suite ({}) in {} shards (Quibble)".format(
+            self.testsuite or 'default',
+            'with database'
+            if self.database
+            else 'without database or standalone',
+            self.shards,
+        )
+
+
 class PhpUnitParallelNotice:
     """Write a notice to the end of the log output so that users
     know that this has been a parallel test run and know where to
@@ -1242,6 +2362,11 @@ class QunitTests:
     def __init__(self, mw_install_path, web_url):
         self.mw_install_path = mw_install_path
         self.web_url = web_url
+        self.requires = frozenset(
+            {'sources', 'localsettings', 'memcached', 'web', 'wiki'}
+            | {'npm:%s' % mw_install_path}
+        )
+        self.provides = frozenset()
 
     def execute(self):
         karma_env = {
@@ -1264,12 +2389,25 @@ class QunitTests:
 
 
 class ApiTesting:
+    requires = frozenset({'sources', 'localsettings', 'memcached', 'web'})
+
     def __init__(self, mw_install_path, projects, url, web_backend):
         self.mw_install_path = mw_install_path
         self.projects = projects
         self.url = url
         self.web_backend = web_backend
 
+    @property
+    def provides(self):
+        # Installs npm dependencies and alters the wiki content
+        return frozenset(
+            {'wiki'}
+            | {
+                'npm:%s' % get_project_dir(self.mw_install_path, project)
+                for project in self.projects
+            }
+        )
+
     def execute(self):
         settings_in_path = (
             self.mw_install_path
@@ -1327,6 +2465,33 @@ class BrowserTests:
         self.web_backend = web_backend
         self.parallel_npm_install = parallel_npm_install
 
+    @property
+    def requires(self):
+        requires = {
+            'sources',
+            'localsettings',
+            'memcached',
+            'web',
+            'webdriver',
+        }
+        if self.parallel_npm_install:
+            requires |= self._npm_resources()
+        return frozenset(requires)
+
+    @property
+    def provides(self):
+        # Browser tests alter the wiki content
+        provides = {'wiki'}
+        if not self.parallel_npm_install:
+            provides |= self._npm_resources()
+        return frozenset(provides)
+
+    def _npm_resources(self):
+        return {
+            'npm:%s' % get_project_dir(self.mw_install_path, project)
+            for project in self.projects
+        }
+
     def execute(self):
         for project in self.projects:
             project_dir = get_project_dir(self.mw_install_path, project)
@@ -1416,6 +2581,16 @@ class EnsureDirectory:
 class GitClean:
     def __init__(self, directory):
         self.directory = directory
+        self.requires = frozenset({'sources'})
+        # Reverts what tests installed in the directory, MediaWiki can only
+        # be used once the directory got cleaned.
+        self.provides = frozenset(
+            {
+                'mediawiki',
+                'composer:%s' % directory,
+                'npm:%s' % directory,
+            }
+        )
 
     def execute(self):
         subprocess.check_call(['git', 'clean', '-xqdf'], cwd=self.directory)
@@ -1444,46 +2619,74 @@ class Parallel:
     immediately.
 
     Subprocess stdout and stderr, and logging are piped to an interleaved
-    capture buffer and logged by the parent as each child completes.
+    capture buffer and logged by the parent as each child completes. With
+    `stream_output`, the lines are instead shown as they come, prefixed by the
+    name of the step, while the capture is still kept for errors. With
+    `step_logs` (a StepLogs), each step writes its output to its own file.
+
+    Durations measured by the children are sent back to the parent and added
+    to quibble.DURATIONS.
 
     Any exceptions are bubbled up.
     """
 
-    def __init__(self, *, name=None, steps):
+    def __init__(
+        self, *, name=None, steps, stream_output=False, step_logs=None
+    ):
         self.name = name or "parallel steps"
         self.steps = list(steps)
+        self.stream_output = stream_output
+        self.step_logs = step_logs
 
-        self.workers = max(1, min(len(self.steps), os.cpu_count()))
+        self.workers = max(1, min(len(self.steps), os.cpu_count() or 1))
 
     def execute(self):
         # Short-circuit if there aren't enough steps to run in parallel.
         if len(self.steps) == 0:
             return
         elif len(self.steps) == 1:
-            return execute_command(self.steps[0])
+            return execute_command(self.steps[0], self.step_logs)
 
         with multiprocessing.Pool(processes=self.workers) as pool:
-            results = pool.imap_unordered(self._run_child, self.steps)
+            results = pool.imap_unordered(
+                functools.partial(
+                    self._run_child,
+                    stream_output=self.stream_output,
+                    step_logs=self.step_logs,
+                ),
+                self.steps,
+            )
             results_in_progress = ProgressReporter(
                 desc=self.name,
                 iterable=results,
                 sleep_interval=monitor_interval,
                 total=len(self.steps),
             )
-            for error, capture in results_in_progress:
-                log.info(capture)
+            for error, capture, timings in results_in_progress:
+                if not self.stream_output:
+                    log.info(capture)
+                quibble.DURATIONS.extend(timings)
                 if error:
-                    error.output = capture
+                    Parallel._set_error_output(error, capture, self.step_logs)
                     raise error
 
     @staticmethod
-    def _run_child(command):
+    def _set_error_output(error, capture, step_logs):
+        # With step logs, the capture only has the tail of the step log
+        if step_logs is None or not getattr(error, 'output', None):
+            error.output = capture
+
+    @staticmethod
+    def _run_child(command, stream_output=False, step_logs=None):
         """Run a command and return its output
 
         This is executed in the child process context, and pipes all of its own
         output streams to a single collector.  This collected output and any
         error are returned in a serializable format.
 
+        With `stream_output`, each line is also written as it comes to the
+        original stdout, prefixed with the name of the command.
+
         The child outputs are read as bytes and decoded to Unicode replacing
         any potential invalid characters with their hexadecimal form.
 
@@ -1494,22 +2697,42 @@ class Parallel:
             captured : text
                 Output of the command, with stdout, stderr, and log lines
                 interleaved.
+            timings : list of CommandTiming
+                Durations measured while running the command.
         """
-        with tempfile.TemporaryFile() as collector, \
-                quibble.util.redirect_all_streams(collector):  # fmt: skip
-            try:
-                execute_command(command)
-                error = None
-            except Exception as ex:
-                error = ex
-            finally:
-                collector.flush()
-                collector.seek(0, io.SEEK_SET)
-                # With Python 3.8 we could use:
-                #   TemporaryFile(errors='backslashreplace')
-                captured = collector.read().decode(errors='backslashreplace')
+        # A forked child inherits the parent durations, only send back the
+        # new ones.
+        known_durations = len(quibble.DURATIONS)
+        with tempfile.TemporaryFile() as collector:
+            with contextlib.ExitStack() as stack:
+                sink = collector
+                if stream_output:
+                    console = os.dup(sys.stdout.fileno())
+                    stack.callback(os.close, console)
+                    prefix = '[%s] ' % str(command).splitlines()[0]
+                    sink = stack.enter_context(
+                        quibble.util.stream_prefixed(
+                            collector, console, prefix.encode(errors='replace')
+                        )
+                    )
+
+                with quibble.util.redirect_all_streams(sink):
+                    try:
+                        execute_command(command, step_logs)
+                        error = None
+                    except Exception as ex:
+                        error = ex
+
+            collector.flush()
+            collector.seek(0, io.SEEK_SET)
+            # With Python 3.8 we could use:
+            #   TemporaryFile(errors='backslashreplace')
+            captured = collector.read().decode(errors='backslashreplace')
+
+        timings = quibble.DURATIONS[known_durations:]
+        del quibble.DURATIONS[known_durations:]
 
-        return (error, captured)
+        return (error, captured, timings)
 
     def __str__(self):
         return "Run {} in parallel (concurrency={}):".format(
@@ -1592,7 +2815,7 @@ class SuccessCache:
 
     def _trees(self):
         for path in sorted(self._repos()):
-            tree = git.Repo(path).tree('HEAD').hexsha
+            tree = quibble.gitplumbing.Git(path).rev_parse('HEAD^{tree}')
             log.info('Found repo %s with tree %s', path, tree)
             yield tree
 
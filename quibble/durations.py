@@ -0,0 +1,299 @@
+"""Historical durations of Quibble runs
+
+Each run records the duration of its commands in a SQLite database (see
+``quibble --durations-db``). ``quibble-durations compare`` then reports the
+stages of the latest run which got slower than the median of the previous
+runs of the same Quibble version, which lets one notice slow drifts that a
+single ``quibble-durations.json`` can not show.
+"""
+
+import argparse
+import contextlib
+import importlib.metadata
+import logging
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    quibble_version TEXT NOT NULL,
+    result TEXT NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_project_branch ON runs (project, branch);
+CREATE TABLE IF NOT EXISTS durations (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_run ON durations (run);
+"""
+
+# Parts of stage names which vary between hosts
+VARIABLE_PARTS = [
+    (re.compile(r'\(concurrency=\d+\)'), '(concurrency=N)'),
+    (re.compile(r' in \d+ shards '), ' in N shards '),
+]
+
+
+def quibble_version():
+    try:
+        return importlib.metadata.version('quibble')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def normalize_stage(stage, workspace=None):
+    """Stage name without the parts varying between hosts
+
+    The concurrency, the number of shards and the workspace path are replaced
+    by placeholders, so that stages of runs on different hosts can be
+    compared.
+    """
+    if workspace:
+        stage = stage.replace(
+            os.path.normpath(workspace) + os.sep, '$WORKSPACE' + os.sep
+        )
+    for pattern, replacement in VARIABLE_PARTS:
+        stage = pattern.sub(replacement, stage)
+    return stage
+
+
+class DurationsDB:
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.executescript(SCHEMA)
+                yield conn
+        finally:
+            conn.close()
+
+    def record(
+        self, project, branch, timings, result, version=None, workspace=None
+    ):
+        """Record the timings of a run
+
+        Stage names are normalized (see normalize_stage).
+
+        Returns the id of the run.
+        """
+        with self.connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO runs'
+                ' (project, branch, quibble_version, result, recorded)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (
+                    project,
+                    branch,
+                    version or quibble_version(),
+                    result,
+                    time.time(),
+                ),
+            )
+            run_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT INTO durations (run, stage, seconds) VALUES (?, ?, ?)',
+                [
+                    (run_id, normalize_stage(t.command, workspace), t.seconds)
+                    for t in timings
+                ],
+            )
+        return run_id
+
+    def keys(self):
+        """(project, branch) pairs having recorded runs"""
+        with self.connect() as conn:
+            return conn.execute(
+                'SELECT DISTINCT project, branch FROM runs'
+                ' ORDER BY project, branch'
+            ).fetchall()
+
+    def runs(self, project, branch, limit, version=None):
+        """Most recent runs first, as (id, quibble_version, result) rows
+
+        Only runs of Quibble `version` are returned, unless it is None.
+        """
+        query = (
+            'SELECT id, quibble_version, result FROM runs'
+            ' WHERE project = ? AND branch = ?'
+        )
+        params = [project, branch]
+        if version is not None:
+            query += ' AND quibble_version = ?'
+            params.append(version)
+        query += ' ORDER BY recorded DESC, id DESC LIMIT ?'
+        params.append(limit)
+        with self.connect() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def stages(self, run_id):
+        """Seconds spent in each stage of a run
+
+        A stage ran several times is summed.
+        """
+        with self.connect() as conn:
+            return dict(
+                conn.execute(
+                    'SELECT stage, SUM(seconds) FROM durations'
+                    ' WHERE run = ? GROUP BY stage',
+                    (run_id,),
+                ).fetchall()
+            )
+
+    def compare(
+        self,
+        project,
+        branch,
+        window=10,
+        threshold=20,
+        min_delta=5,
+        version=None,
+    ):
+        """Stages of the latest run slower than the rolling baseline
+
+        Only runs of Quibble `version` are compared, the current version when
+        it is None. The baseline of a stage is the median of its duration over
+        the `window` successful runs preceding the latest one. A stage is
+        reported when it took more than `threshold` percent and more than
+        `min_delta` seconds over its baseline.
+
+        Returns a list of (stage, baseline, seconds) tuples.
+        """
+        runs = self.runs(
+            project, branch, window + 1, version=version or quibble_version()
+        )
+        if len(runs) < 2:
+            return []
+
+        latest = self.stages(runs[0][0])
+        history = [
+            self.stages(run_id)
+            for (run_id, _, result) in runs[1:]
+            if result == 'SUCCESS'
+        ]
+
+        regressions = []
+        for stage, seconds in latest.items():
+            previous = [run[stage] for run in history if stage in run]
+            if not previous:
+                continue
+            baseline = statistics.median(previous)
+            delta = seconds - baseline
+            if delta > min_delta and delta > baseline * threshold / 100:
+                regressions.append((stage, baseline, seconds))
+        return regressions
+
+
+def compare(args):
+    db = DurationsDB(args.db)
+    if args.project and args.branch:
+        keys = [(args.project, args.branch)]
+    else:
+        keys = [
+            (project, branch)
+            for (project, branch) in db.keys()
+            if args.project in (None, project)
+            and args.branch in (None, branch)
+        ]
+
+    found = False
+    for project, branch in keys:
+        regressions = db.compare(
+            project,
+            branch,
+            window=args.window,
+            threshold=args.threshold,
+            min_delta=args.min_delta,
+            version=args.version,
+        )
+        if not regressions:
+            continue
+        found = True
+        print('%s (%s):' % (project, branch))
+        for stage, baseline, seconds in regressions:
+            print(
+                '  %s: %.03fs, baseline %.03fs (+%.03fs)'
+                % (stage, seconds, baseline, seconds - baseline)
+            )
+
+    if not found:
+        print('No regression found')
+    return 1 if found else 0
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Inspect durations recorded by Quibble runs',
+        prog='quibble-durations',
+    )
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    compare_parser = subparsers.add_parser(
+        'compare',
+        help='Report stages of the latest run which got slower than the '
+        'median of the previous successful runs of the same Quibble '
+        'version. '
+        'Exits with 1 when regressions are found.',
+    )
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument(
+        '--db',
+        required=True,
+        help='SQLite database written by quibble --durations-db',
+    )
+    compare_parser.add_argument(
+        '--project',
+        default=None,
+        help='Only compare runs of this project. Default: all projects',
+    )
+    compare_parser.add_argument(
+        '--branch',
+        default=None,
+        help='Only compare runs of this branch. Default: all branches',
+    )
+    compare_parser.add_argument(
+        '--version',
+        default=None,
+        help='Only compare runs of this Quibble version. '
+        'Default: the installed version',
+    )
+    compare_parser.add_argument(
+        '--window',
+        default=10,
+        type=int,
+        help='Number of previous runs making the baseline. Default: 10',
+    )
+    compare_parser.add_argument(
+        '--threshold',
+        default=20,
+        type=float,
+        help='Percentage over the baseline after which a stage is reported. '
+        'Default: 20',
+    )
+    compare_parser.add_argument(
+        '--min-delta',
+        default=5,
+        type=float,
+        help='Ignore stages which got slower by less than this number of '
+        'seconds. Default: 5',
+    )
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,138 @@
+"""Thin layer over git plumbing commands
+
+GitPython builds objects and reads references and configuration in Python for
+most operations. The hot paths preparing repositories and computing cache
+keys instead run git directly and batch their requests: a single
+`for-each-ref` to resolve references, a single `update-ref --stdin` to write
+them and a long lived `cat-file --batch-check` to look up objects.
+
+Failing commands raise GitPython exceptions, so that callers handle them like
+before.
+"""
+
+import os
+import subprocess
+
+import git
+
+
+def clone(url, path, *options):
+    cmd = ['git', 'clone', '--quiet'] + list(options) + [url, path]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise git.GitCommandError(cmd, proc.returncode, proc.stderr)
+
+
+class Git:
+    """Git commands for the repository at `path`
+
+    Repositories of the parent directories are never looked up, a directory
+    which is not a repository raises InvalidGitRepositoryError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._batch_check = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _env(self):
+        env = dict(os.environ)
+        env['GIT_CEILING_DIRECTORIES'] = os.path.dirname(
+            os.path.abspath(self.path)
+        )
+        return env
+
+    def _raise(self, cmd, returncode, stderr):
+        if 'not a git repository' in stderr:
+            raise git.InvalidGitRepositoryError(self.path)
+        raise git.GitCommandError(cmd, returncode, stderr)
+
+    def run(self, *args, input=None):
+        """Run a git command and return its output"""
+        cmd = ['git', '-C', self.path] + list(args)
+        proc = subprocess.run(
+            cmd,
+            input=input,
+            capture_output=True,
+            text=True,
+            env=self._env(),
+        )
+        if proc.returncode != 0:
+            self._raise(cmd, proc.returncode, proc.stderr)
+        return proc.stdout
+
+    def rev_parse(self, rev):
+        """Object id of a revision, raises GitCommandError if it is unknown"""
+        return self.run('rev-parse', '--verify', '--quiet', rev).strip()
+
+    def refs(self, *patterns):
+        """Object ids of the references matching the patterns
+
+        Patterns match full reference names or their leading components (see
+        git-for-each-ref). Symbolic references are resolved.
+        """
+        output = self.run(
+            'for-each-ref', '--format=%(refname) %(objectname)', *patterns
+        )
+        return dict(line.split(' ', 1) for line in output.splitlines())
+
+    def update_refs(self, updates):
+        """Set references to object ids in a single transaction
+
+        updates: a dict of reference name to object id.
+        """
+        if not updates:
+            return
+        commands = ''.join(
+            'update %s %s\n' % (ref, sha) for ref, sha in updates.items()
+        )
+        self.run('update-ref', '--stdin', input=commands)
+
+    def detach_head(self, sha):
+        """Point HEAD to an object id, the working tree is left as is"""
+        self.run('update-ref', '--no-deref', 'HEAD', sha)
+
+    def object_id(self, rev):
+        """Object id of a revision such as HEAD:path, None if it is missing
+
+        Served by a `git cat-file --batch-check` kept running until close().
+        """
+        if self._batch_check is None:
+            self._batch_check = subprocess.Popen(
+                ['git', '-C', self.path, 'cat-file', '--batch-check'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                env=self._env(),
+            )
+        try:
+            self._batch_check.stdin.write(rev + '\n')
+            self._batch_check.stdin.flush()
+            line = self._batch_check.stdout.readline()
+        except BrokenPipeError:
+            line = ''
+        if not line:
+            # git exited, for example when path is not a repository
+            proc = self._batch_check
+            self._batch_check = None
+            stdout, stderr = proc.communicate()
+            self._raise(proc.args, proc.returncode, stderr)
+        # "<sha> <type> <size>" or "<rev> missing"
+        fields = line.split()
+        if len(fields) != 3 or fields[2] == 'missing':
+            return None
+        return fields[0]
+
+    def close(self):
+        if self._batch_check is not None:
+            self._batch_check.stdin.close()
+            self._batch_check.wait()
+            self._batch_check.stdout.close()
+            self._batch_check.stderr.close()
+            self._batch_check = None
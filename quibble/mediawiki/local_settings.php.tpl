@@ -52,6 +52,42 @@ $wgFlowContentFormat = 'wikitext';
 
 require_once __DIR__ . '/LocalSettings-installer.php';
 
+// Database copy dedicated to a parallel PHPUnit shard
+if ( getenv( 'MW_DB' ) ) {
+    $quibbleInstalledDBname = $wgDBname;
+    $wgDBname = getenv( 'MW_DB' );
+
+    // The installer settings above derive database names from $wgDBname,
+    // such as "{$wgDBname}_jobqueue" with SQLite. Give them the name of the
+    // shard database as well.
+    $quibbleShardDBname = static function ( $dbname ) use (
+        $quibbleInstalledDBname, $wgDBname
+    ) {
+        $prefix = "{$quibbleInstalledDBname}_";
+        if ( strpos( $dbname, $prefix ) === 0 ) {
+            return "{$wgDBname}_" . substr( $dbname, strlen( $prefix ) );
+        }
+        return $dbname;
+    };
+    if ( isset( $wgJobTypeConf['default']['server']['dbname'] ) ) {
+        $wgJobTypeConf['default']['server']['dbname'] = $quibbleShardDBname(
+            $wgJobTypeConf['default']['server']['dbname']
+        );
+    }
+    if ( isset( $wgLocalisationCacheConf['storeServer']['dbname'] ) ) {
+        $wgLocalisationCacheConf['storeServer']['dbname'] = $quibbleShardDBname(
+            $wgLocalisationCacheConf['storeServer']['dbname']
+        );
+    }
+    // The SQLite object cache database is not named after the wiki one
+    if ( isset( $wgObjectCaches[CACHE_DB]['server']['dbname'] )
+        && $wgObjectCaches[CACHE_DB]['server']['dbname'] === 'wikicache'
+    ) {
+        $wgObjectCaches[CACHE_DB]['server']['dbname'] = "{$wgDBname}_wikicache";
+    }
+    unset( $quibbleInstalledDBname, $quibbleShardDBname );
+}
+
 $wgLocalDatabases = [ $wgDBname ];
 
 // Caching settings.
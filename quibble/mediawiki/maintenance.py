@@ -94,11 +94,14 @@ def install(args, mwdir=None):
         raise Exception('Install failed with exit code: %s' % p.returncode)
 
 
-def rebuildLocalisationCache(lang=['en'], mwdir=None):
+def rebuildLocalisationCache(lang=['en'], mwdir=None, threads=None):
     log = logging.getLogger('mw.maintenance.rebuildLocalisationCache')
 
     cmd = getMaintenanceScript('rebuildLocalisationCache')
     cmd.extend(['--lang', ','.join(lang)])
+    # Languages are split between the threads
+    if threads is not None and threads > 1:
+        cmd.extend(['--threads', str(threads)])
     log.info(' '.join(cmd))
 
     p = subprocess.Popen(cmd, cwd=mwdir)
@@ -0,0 +1,215 @@
+"""Split a PHPUnit suite in shards of similar durations
+
+PHPUnit lists the tests of a suite with `--list-tests-xml`. Test classes are
+then distributed among shards using their durations as recorded in JUnit
+files of previous runs. Each shard runs with a copy of the PHPUnit
+configuration whose test suite only holds the files of its classes: a
+`--filter` matching thousands of classes would exceed the maximum length of a
+command line argument.
+"""
+
+import glob
+import heapq
+import logging
+import os
+import re
+import statistics
+import xml.etree.ElementTree as ET
+
+log = logging.getLogger(__name__)
+
+# Assumed duration of a test class when no durations are known at all
+DEFAULT_DURATION = 1.0
+
+
+def _parse_list(list_tests_xml):
+    root = ET.parse(list_tests_xml).getroot()
+    for element in root.iter():
+        # PHPUnit 10 uses a namespace
+        element.tag = element.tag.rpartition('}')[2]
+    return root
+
+
+def _test_classes(root):
+    for element in root.iter():
+        if element.tag in ('testCaseClass', 'testClass'):
+            yield element
+
+
+def list_test_classes(list_tests_xml, group=(), exclude_group=()):
+    """Test classes listed by PHPUnit `--list-tests-xml`
+
+    Classes are kept when one of their test methods belongs to `group` (if
+    any) and to none of `exclude_group`.
+
+    Supports the PHPUnit 9 (testCaseClass) and PHPUnit 10 (testClass)
+    formats.
+    """
+    root = _parse_list(list_tests_xml)
+
+    # PHPUnit 10 lists groups separately, referencing the tests by id
+    test_groups = {}
+    for group_element in root.iter('group'):
+        for test in group_element.iter('test'):
+            test_groups.setdefault(test.get('id'), set()).add(
+                group_element.get('name')
+            )
+
+    classes = []
+    for test_class in _test_classes(root):
+        for method in test_class:
+            if method.get('groups') is not None:
+                groups = set(filter(None, method.get('groups').split(',')))
+            else:
+                groups = test_groups.get(method.get('id'), set())
+            if group and not groups & set(group):
+                continue
+            if groups & set(exclude_group):
+                continue
+            classes.append(test_class.get('name'))
+            break
+    return classes
+
+
+def listed_class_files(list_tests_xml):
+    """Files of the test classes, as listed by PHPUnit 10 and later
+
+    PHPUnit 9 does not list files, an empty dict is returned.
+    """
+    return {
+        test_class.get('name'): test_class.get('file')
+        for test_class in _test_classes(_parse_list(list_tests_xml))
+        if test_class.get('file')
+    }
+
+
+def _namespace(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        match = re.search(r'^\s*namespace\s+([^;\s]+)\s*;', f.read(), re.M)
+    return match.group(1) if match else ''
+
+
+def find_class_files(classes, directory):
+    """Files defining the given classes, looked up in `directory`
+
+    MediaWiki requires a class to be defined in a file with the same name
+    (MediaWiki.Files.ClassMatchesFilename). When several files have that
+    name, the one declaring the namespace of the class is picked.
+
+    Raises an Exception listing the classes which could not be found.
+    """
+    wanted = {}
+    for name in classes:
+        namespace, _, short = name.rpartition('\\')
+        wanted.setdefault(short + '.php', []).append((name, namespace))
+
+    candidates = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d not in ('.git', 'node_modules')]
+        for filename in files:
+            if filename in wanted:
+                candidates.setdefault(filename, []).append(
+                    os.path.join(root, filename)
+                )
+
+    found = {}
+    for filename, names in wanted.items():
+        paths = candidates.get(filename, [])
+        for name, namespace in names:
+            if len(paths) == 1:
+                found[name] = paths[0]
+                continue
+            matching = [p for p in paths if _namespace(p) == namespace]
+            if len(matching) == 1:
+                found[name] = matching[0]
+
+    missing = [name for name in classes if name not in found]
+    if missing:
+        raise Exception(
+            'Could not find the file of test classes: %s'
+            % ', '.join(sorted(missing))
+        )
+    return found
+
+
+def write_shard_config(base_config, path, name, files):
+    """Copy a PHPUnit configuration with a single test suite of `files`
+
+    The copy is meant to be written next to `base_config`, since PHPUnit
+    resolves relative paths from the directory of the configuration.
+    """
+    tree = ET.parse(base_config)
+    root = tree.getroot()
+
+    testsuites = ET.Element('testsuites')
+    testsuite = ET.SubElement(testsuites, 'testsuite', name=name)
+    for test_file in files:
+        ET.SubElement(testsuite, 'file').text = test_file
+
+    previous = root.find('testsuites')
+    if previous is None:
+        root.append(testsuites)
+    else:
+        index = list(root).index(previous)
+        root.remove(previous)
+        root.insert(index, testsuites)
+    tree.write(path, encoding='utf-8', xml_declaration=True)
+
+
+def junit_durations(path):
+    """Seconds spent in each test class according to JUnit files
+
+    path: a JUnit XML file or a directory holding some.
+    """
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, '**', '*.xml'), recursive=True)
+    else:
+        files = [path]
+
+    durations = {}
+    for junit_file in files:
+        try:
+            root = ET.parse(junit_file).getroot()
+        except ET.ParseError as e:
+            log.warning('Skipping invalid JUnit file %s: %s', junit_file, e)
+            continue
+        for testcase in root.iter('testcase'):
+            name = testcase.get('class')
+            if name is None and testcase.get('classname'):
+                name = testcase.get('classname').replace('.', '\\')
+            if name is None:
+                continue
+            durations[name] = durations.get(name, 0.0) + float(
+                testcase.get('time', 0)
+            )
+    return durations
+
+
+def shard(classes, durations, count):
+    """Distribute test classes in `count` shards of similar durations
+
+    Longest classes are placed first, each in the shard having the lowest
+    total so far. Classes without a known duration are assumed to take the
+    median duration.
+
+    Returns a list of (estimated seconds, classes) tuples.
+    """
+    if durations:
+        default = statistics.median(durations.values())
+    else:
+        default = DEFAULT_DURATION
+
+    shards = [(0.0, i, []) for i in range(count)]
+    heapq.heapify(shards)
+    for name in sorted(classes, key=lambda c: (-durations.get(c, default), c)):
+        total, i, members = heapq.heappop(shards)
+        members.append(name)
+        heapq.heappush(
+            shards, (total + durations.get(name, default), i, members)
+        )
+
+    return [
+        (total, members)
+        for (total, _, members) in sorted(shards, key=lambda s: s[1])
+        if members
+    ]
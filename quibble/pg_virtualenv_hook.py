@@ -1,36 +0,0 @@
-# Copyright © 2017, Kunal Mehta
-#
-# Licensed under the Apache License, Version 2.0 (the "License");
-# you may not use this file except in compliance with the License.
-# You may obtain a copy of the License at
-#
-#     http://www.apache.org/licenses/LICENSE-2.0
-#
-#     Unless required by applicable law or agreed to in writing, software
-#     distributed under the License is distributed on an "AS IS" BASIS,
-#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
-#     See the License for the specific language governing permissions and
-#     limitations under the License.
-
-import json
-import os
-import signal
-
-
-def main():
-    with open(os.environ['QUIBBLE_TMPFILE'], 'w') as f:
-        json.dump(
-            {
-                'PGUSER': os.environ['PGUSER'],
-                'PGPASSWORD': os.environ['PGPASSWORD'],
-                'PGDATABASE': os.environ['PGDATABASE'],
-                'PID': os.getpid(),
-            },
-            f,
-        )
-    # Wait for a signal
-    signal.pause()
-
-
-if __name__ == '__main__':
-    main()
@@ -0,0 +1,187 @@
+"""Run an execution plan as a graph of dependent commands"""
+
+import logging
+import multiprocessing
+import os
+import queue
+
+import quibble
+import quibble.commands
+
+log = logging.getLogger(__name__)
+
+
+def is_barrier(command):
+    """Whether a command did not declare what it requires and provides.
+
+    Such a command runs alone: it waits for every command planned before it
+    and every command planned after it waits for it.
+    """
+    return not (hasattr(command, 'requires') and hasattr(command, 'provides'))
+
+
+def depends_on(command, other):
+    """Whether command must wait for the earlier planned command `other`.
+
+    The resources a command `provides` are the ones it creates or alters. A
+    command thus waits for an earlier command which:
+
+    - provides a resource it requires,
+    - provides a resource it provides as well,
+    - requires a resource it provides, so it is not altered in its back.
+    """
+    if is_barrier(command) or is_barrier(other):
+        return True
+    return bool(
+        command.requires & other.provides
+        or command.provides & other.provides
+        or command.provides & other.requires
+    )
+
+
+def flatten(plan):
+    """Replace Parallel commands by their steps.
+
+    Steps of a Parallel group are independent by construction, the scheduler
+    runs them concurrently on its own.
+    """
+    commands = []
+    for command in plan:
+        if isinstance(command, quibble.commands.Parallel):
+            commands.extend(flatten(command.steps))
+        else:
+            commands.append(command)
+    return commands
+
+
+def dependencies(commands):
+    """Map the index of each command to the indexes it depends on."""
+    return [
+        {j for j in range(i) if depends_on(command, commands[j])}
+        for i, command in enumerate(commands)
+    ]
+
+
+def runs_in_parent(command):
+    return is_barrier(command) or getattr(command, 'run_in_parent', False)
+
+
+class Scheduler:
+    """Run each command of a plan as soon as its dependencies are met.
+
+    Commands declare the resources they need with a `requires` set and the
+    ones they create or alter with a `provides` set. Resources are plain
+    strings such as 'sources', 'php_dependencies', 'database' or
+    'localsettings'. See depends_on() for how the graph is derived from the
+    plan order.
+
+    Commands setting `run_in_parent` (for example StartBackends which holds
+    the backends in the parent context stack) and commands lacking
+    declarations are executed by the parent process. Others are sent to a
+    pool of worker processes; their output is captured and logged on
+    completion, or streamed with `stream_output`, just like Parallel does.
+    `step_logs` writes the output of each command to its own file.
+    """
+
+    def __init__(
+        self, plan, workers=None, stream_output=False, step_logs=None
+    ):
+        self.commands = flatten(plan)
+        self.dependencies = dependencies(self.commands)
+        self.workers = workers or os.cpu_count() or 1
+        self.stream_output = stream_output
+        self.step_logs = step_logs
+        # The command which caused execute() to raise
+        self.failed_command = None
+
+    def execute(self):
+        pending = list(range(len(self.commands)))
+        running = set()
+        done = set()
+        completed = queue.Queue()
+
+        with multiprocessing.Pool(processes=self.workers) as pool:
+            while pending or running:
+                ready = [i for i in pending if self.dependencies[i] <= done]
+
+                # Dispatch to the workers first, they make progress while the
+                # parent runs its own commands.
+                for i in ready:
+                    if runs_in_parent(self.commands[i]):
+                        continue
+                    pending.remove(i)
+                    running.add(i)
+                    pool.apply_async(
+                        quibble.commands.Parallel._run_child,
+                        (self.commands[i], self.stream_output, self.step_logs),
+                        callback=lambda result, i=i: completed.put(
+                            (i, result)
+                        ),
+                        error_callback=lambda error, i=i: completed.put(
+                            (i, (error, '', []))
+                        ),
+                    )
+
+                in_parent = [i for i in ready if i in pending]
+                if in_parent:
+                    i = in_parent[0]
+                    pending.remove(i)
+                    self.failed_command = self.commands[i]
+                    quibble.commands.execute_command(
+                        self.commands[i], self.step_logs
+                    )
+                    self.failed_command = None
+                    done.add(i)
+                    continue
+
+                try:
+                    i, (error, capture, timings) = completed.get(
+                        timeout=quibble.commands.monitor_interval
+                    )
+                except queue.Empty:
+                    log.debug(
+                        'Waiting for: %s',
+                        ', '.join(str(self.commands[i]) for i in running),
+                    )
+                    continue
+
+                running.remove(i)
+                if not self.stream_output:
+                    log.info(capture)
+                quibble.DURATIONS.extend(timings)
+                if error:
+                    self.failed_command = self.commands[i]
+                    quibble.commands.Parallel._set_error_output(
+                        error, capture, self.step_logs
+                    )
+                    raise error
+                done.add(i)
+
+    def _direct_dependencies(self):
+        """Dependencies without the ones implied by another dependency."""
+        closures = []
+        direct = []
+        for deps in self.dependencies:
+            implied = set()
+            for dep in deps:
+                implied |= closures[dep]
+            closures.append(deps | implied)
+            direct.append(deps - implied)
+        return direct
+
+    def __str__(self):
+        lines = ['Execution graph:']
+        direct = self._direct_dependencies()
+        for i, command in enumerate(self.commands):
+            deps = direct[i]
+            lines.append(
+                '%s. %s%s'
+                % (
+                    i,
+                    command,
+                    ' (after %s)' % ', '.join(map(str, sorted(deps)))
+                    if deps
+                    else '',
+                )
+            )
+        return '\n'.join(lines)
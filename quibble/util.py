@@ -15,23 +15,48 @@
 #     limitations under the License.
 
 import contextlib
+import fcntl
 import json
 import logging
 import os
+import select
+import selectors
 import urllib.request
-from shutil import copyfile
+from shutil import copyfile, copytree
 import sys
+import tempfile
 import threading
 import time
 
 log = logging.getLogger(__name__)
 
+# ioctl() sharing the blocks of a file with another one, on copy-on-write
+# filesystems such as Btrfs or XFS. From linux/fs.h.
+FICLONE = 0x40049409
+
 
 def copylog(src, dest):
     log.info('Copying %s to %s', src, dest)
     copyfile(src, dest)
 
 
+def clone_file(src, dest):
+    """Copy a file as a reflink when the filesystem supports it, else fall
+    back to a regular copy."""
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    copyfile(src, dest)
+
+
+def clone_tree(src, dest):
+    """Copy a directory using clone_file(), dest may already exist."""
+    copytree(src, dest, copy_function=clone_file, dirs_exist_ok=True)
+
+
 def isCoreOrVendor(project):
     """
     project: a gerrit repository name
@@ -68,10 +93,12 @@ def _redirect_stream(source, sink):
     old_source_fileno = os.dup(source.fileno())
     os.dup2(sink.fileno(), source.fileno())
 
-    yield
-    source.flush()
-
-    os.dup2(old_source_fileno, source.fileno())
+    try:
+        yield
+    finally:
+        source.flush()
+        os.dup2(old_source_fileno, source.fileno())
+        os.close(old_source_fileno)
 
 
 class BytesStreamHandler(logging.StreamHandler):
@@ -114,13 +141,15 @@ def _redirect_logging(sink):
         logger.removeHandler(handler)
     logger.addHandler(log_handler)
 
-    yield
-    log_handler.flush()
+    try:
+        yield
+    finally:
+        log_handler.flush()
 
-    logger.removeHandler(log_handler)
-    for handler in old_handlers:
-        logger.addHandler(handler)
-    log_handler.close()
+        logger.removeHandler(log_handler)
+        for handler in old_handlers:
+            logger.addHandler(handler)
+        log_handler.close()
 
 
 @contextlib.contextmanager
@@ -132,6 +161,293 @@ def redirect_all_streams(sink):
         yield
 
 
+class OutputPump:
+    """Relay the output of pipes from a single thread.
+
+    Registered pipes are watched with a selector and read by chunks of up to
+    `chunk_size` bytes. The callback of a pipe is given the chunks cut after
+    their last complete line, the remainder waits for the next chunk. At the
+    end of the pipe, the remainder is passed as is and `on_close` is invoked.
+    A pipe can also be detached before its end, see detach().
+
+    The thread starts with the first pipe and stops once all pipes ended.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self):
+        self._reset()
+        # The thread does not survive a fork, a child needs its own
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._selector = None
+        self._thread = None
+        self._wakeup = None
+        self._detached = set()
+
+    def register(self, pipe, callback, on_close=None):
+        fd = pipe if isinstance(pipe, int) else pipe.fileno()
+        with self._lock:
+            if self._thread is None:
+                self._selector = selectors.DefaultSelector()
+                self._wakeup = os.pipe()
+                self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+                self._thread = threading.Thread(
+                    target=self._run, name='OutputPump', daemon=True
+                )
+                self._thread.start()
+            with contextlib.suppress(KeyError):
+                # A closed pipe whose file descriptor got reused
+                self._selector.unregister(fd)
+            self._selector.register(
+                fd, selectors.EVENT_READ, [callback, on_close, b'']
+            )
+        # Have select() take the new pipe in account
+        os.write(self._wakeup[1], b'.')
+
+    def detach(self, pipe):
+        """Stop relaying a pipe once the data it holds has been relayed
+
+        The data already written to the pipe is read, then the pipe is handled
+        as if it ended even though some process may still have it open.
+        """
+        fd = pipe if isinstance(pipe, int) else pipe.fileno()
+        with self._lock:
+            if self._thread is None:
+                return
+            self._detached.add(fd)
+            # Under the lock, the thread closes the wakeup pipe before exiting
+            os.write(self._wakeup[1], b'.')
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._selector.get_map()) == 1:
+                    self._selector.close()
+                    for fd in self._wakeup:
+                        os.close(fd)
+                    self._thread = None
+                    return
+                selector = self._selector
+
+            for key, _ in selector.select():
+                if key.fd == self._wakeup[0]:
+                    os.read(key.fd, 1024)
+                else:
+                    self._read(key)
+
+            with self._lock:
+                detached, self._detached = self._detached, set()
+            for fd in detached:
+                try:
+                    key = selector.get_key(fd)
+                except KeyError:
+                    # Already ended
+                    continue
+                os.set_blocking(fd, False)
+                while self._read(key):
+                    pass
+
+    def _read(self, key):
+        """Relay a chunk of a pipe, returns whether the pipe is still open
+
+        A callback raising an exception is logged and its pipe is handled as
+        if it ended, the other pipes keep being relayed.
+        """
+        callback, on_close, pending = key.data
+        try:
+            chunk = os.read(key.fd, self.chunk_size)
+        except OSError:
+            # Includes BlockingIOError once a detached pipe is drained
+            chunk = b''
+
+        try:
+            if chunk:
+                data = pending + chunk
+                end = data.rfind(b'\n') + 1
+                key.data[2] = data[end:]
+                if end:
+                    callback(data[:end])
+                return True
+            if pending:
+                callback(pending)
+        except Exception:
+            log.exception('Relaying output of fd %s failed', key.fd)
+
+        with self._lock:
+            self._selector.unregister(key.fd)
+        if on_close:
+            try:
+                on_close()
+            except Exception:
+                log.exception('Closing relay of fd %s failed', key.fd)
+        return False
+
+
+def write_all(fd, data):
+    """Write all of data to a file descriptor, despite partial writes"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+output_pump = OutputPump()
+
+# Seconds stream_prefixed() waits for the output of a command to be relayed
+STREAM_CLOSE_TIMEOUT = 30
+
+
+@contextlib.contextmanager
+def stream_prefixed(collector, console, prefix):
+    """Provide a pipe copied to a collector and, prefixed, to a console.
+
+    The output written to the pipe is appended as is to the `collector` file
+    and written to the `console` file descriptor, each line prefixed by
+    `prefix` (bytes). Lines are sent to the console by batches of at most
+    PIPE_BUF bytes, which are written atomically, so that lines of concurrent
+    processes sharing the console are not mixed.
+
+    Yields the binary file object of the pipe, suitable for
+    redirect_all_streams(). On exit, the output already written is relayed
+    and the pipe is detached: a process which inherited the pipe and outlives
+    the command, such as a daemonized server, does not hold up the caller.
+    """
+    read_fd, write_fd = os.pipe()
+    closed = threading.Event()
+    console_ok = True
+
+    def write_console(batch):
+        nonlocal console_ok
+        try:
+            write_all(console, batch)
+        except OSError as e:
+            # Keep collecting the output, it is still logged on completion.
+            # Logging is redirected to the pipe being relayed, write directly.
+            message = 'Can not stream output to the console: %s\n' % e
+            collector.write(message.encode())
+            console_ok = False
+        return console_ok
+
+    def relay(chunk):
+        collector.write(chunk)
+        if not console_ok:
+            return
+        batch = b''
+        for line in chunk.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            line = prefix + line
+            if batch and len(batch) + len(line) > select.PIPE_BUF:
+                if not write_console(batch):
+                    return
+                batch = b''
+            batch += line
+        if batch:
+            write_console(batch)
+
+    output_pump.register(read_fd, relay, on_close=closed.set)
+    try:
+        with open(write_fd, 'wb', buffering=0) as writer:
+            yield writer
+    finally:
+        # read_fd is closed here rather than by the pump, so that it can not
+        # be reused by another pipe before being detached.
+        output_pump.detach(read_fd)
+        if closed.wait(timeout=STREAM_CLOSE_TIMEOUT):
+            os.close(read_fd)
+        else:
+            log.warning(
+                'Output of %s still being relayed after %s seconds',
+                prefix.decode(errors='replace').strip(),
+                STREAM_CLOSE_TIMEOUT,
+            )
+
+
+class OutputCapture:
+    """Capture the output of a command within bounded memory.
+
+    The first `head_size` bytes and the last `tail_size` bytes are kept in
+    memory. Once the output grows beyond both and if `spill_dir` is set, the
+    whole output is written to a file in that directory, named after `name`.
+
+    getvalue() returns the head and the tail, separated by a note telling
+    how many bytes got truncated and where to find them.
+    """
+
+    def __init__(
+        self,
+        name='output',
+        spill_dir=None,
+        head_size=64 * 1024,
+        tail_size=1024 * 1024,
+    ):
+        self.name = name
+        if spill_dir and os.path.isdir(spill_dir):
+            self.spill_dir = spill_dir
+        else:
+            self.spill_dir = None
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+        self.spill_file = None
+
+    @property
+    def spill_path(self):
+        return self.spill_file.name if self.spill_file else None
+
+    def write(self, data):
+        self.size += len(data)
+
+        head_room = self.head_size - len(self.head)
+        if head_room > 0:
+            self.head += data[:head_room]
+        self.tail += data[max(head_room, 0) :]
+
+        if self.spill_file:
+            self.spill_file.write(data)
+        elif self.spill_dir and self.size > self.head_size + self.tail_size:
+            # Nothing has been dropped yet, the spill file gets everything
+            self.spill_file = tempfile.NamedTemporaryFile(
+                dir=self.spill_dir,
+                prefix='%s-' % self.name,
+                suffix='.log',
+                delete=False,
+            )
+            self.spill_file.write(self.head)
+            self.spill_file.write(self.tail)
+
+        # Trim once in a while rather than on each write
+        if len(self.tail) > 2 * self.tail_size:
+            del self.tail[: -self.tail_size]
+
+    def close(self, keep=True):
+        """Close the spill file, deleting it unless `keep`"""
+        if self.spill_file is None:
+            return
+        self.spill_file.close()
+        if not keep:
+            os.unlink(self.spill_file.name)
+            self.spill_file = None
+
+    def getvalue(self):
+        """Captured output as text, possibly truncated"""
+        truncated = self.size - len(self.head) - self.tail_size
+        if truncated <= 0:
+            output = bytes(self.head + self.tail)
+        else:
+            output = bytes(self.head)
+            output += b'\n[... %d bytes truncated' % truncated
+            if self.spill_path:
+                output += b', full output in %s' % self.spill_path.encode()
+            output += b' ...]\n'
+            output += bytes(self.tail[-self.tail_size :])
+        return output.decode('utf-8', errors='backslashreplace')
+
+
 class ProgressReporter:
     """Report job progress at regular intervals, wraps an iterable and tracks
     how many items have been served from it.
@@ -14,12 +14,16 @@
 #     limitations under the License.
 
 import copy
+import errno
 import logging
 import os
+import shutil
+import tempfile
 import threading
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import quibble
 from zuul.lib.cloner import Cloner
 from zuul.lib.clonemapper import CloneMapper
 
@@ -44,6 +48,7 @@ def clone(
     zuul_project,
     zuul_ref,
     zuul_url,
+    clone_mode='full',
 ):
     log = logging.getLogger('quibble.zuul.clone')
 
@@ -74,12 +79,16 @@ def clone(
         zuul_newrev=zuul_newrev,
         zuul_project=zuul_project,
         cache_no_hardlinks=False,  # False allows hardlink
+        narrow_fetch=True,
+        clone_mode=clone_mode,
+        # The project under test keeps its whole history, for example for
+        # GitChangedInHead or Phpbench comparing with HEAD~1.
+        full_clone_projects=[zuul_project or 'mediawiki/core'],
     )
     # The constructor expects a file, set the value directly
     zuul_cloner.clone_map = CLONE_MAP
 
-    # Reimplement Cloner.execute() to make sure mediawiki/core is cloned first
-    # and clone the rest in parallel.
+    # Reimplement Cloner.execute() to clone the repositories in parallel
     dests = working_trees(workspace, projects)
 
     if workers == 1:
@@ -89,19 +98,33 @@ def clone(
     # suitable for multiplexed output.
     log.info("Preparing %d repositories with %s workers", len(dests), workers)
 
-    if 'mediawiki/core' in projects:
-        mw_git_dir = os.path.join(dests['mediawiki/core'], '.git')
-        if not os.path.exists(mw_git_dir):
-            log.info("Cloning mediawiki/core first")
-            zuul_cloner.prepareRepo('mediawiki/core', dests['mediawiki/core'])
-            del dests['mediawiki/core']
+    # mediawiki/core working tree holds the other repositories. When it has
+    # not been cloned yet, it is prepared in a staging directory and moved in
+    # place, git refusing to clone in a non empty directory.
+    staged = {
+        project
+        for project, dest in dests.items()
+        if not os.path.exists(os.path.join(dest, '.git'))
+        and any(_is_within(other, dest) for other in dests.values())
+    }
+
+    # Worker threads do not know about the command cloning the repositories
+    parent = quibble.current_chronometer()
 
     can_run = threading.Event()
     can_run.set()
 
     with ThreadPoolExecutor(max_workers=workers) as executor:
         futures = [
-            executor.submit(_clone_worker, can_run, zuul_cloner, project, dest)
+            executor.submit(
+                _clone_worker,
+                can_run,
+                zuul_cloner,
+                project,
+                dest,
+                parent,
+                stage=project in staged,
+            )
             for project, dest in dests.items()
         ]
         # Consume results
@@ -111,7 +134,7 @@ def clone(
     log.info("Prepared all repositories")
 
 
-def _clone_worker(can_run, cloner, project, dest):
+def _clone_worker(can_run, cloner, project, dest, parent=None, stage=False):
     if not can_run.is_set():
         return
 
@@ -119,13 +142,71 @@ def _clone_worker(can_run, cloner, project, dest):
     project_cloner = copy.copy(cloner)
     project_cloner.log = project_cloner.log.getChild(project)
     try:
-        project_cloner.prepareRepo(project, dest)
+        with quibble.Chronometer(
+            'Prepare repository %s' % project,
+            project_cloner.log.debug,
+            parent=parent,
+        ):
+            if stage:
+                _prepare_staged(project_cloner, project, dest)
+            else:
+                project_cloner.prepareRepo(project, dest)
     except Exception as e:
         # Prevent other workers from executing
         can_run.clear()
         raise e
 
 
+def _is_within(path, directory):
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    return path != directory and path.startswith(directory + os.sep)
+
+
+def _prepare_staged(cloner, project, dest):
+    """Prepare a repository in a staging directory then move it to dest
+
+    Other repositories might be cloned in dest concurrently, the staging
+    directory is thus merged in dest.
+    """
+    os.makedirs(dest, exist_ok=True)
+    # Under dest to be on the same filesystem
+    staging = tempfile.mkdtemp(dir=dest, prefix='.quibble-staging-')
+    try:
+        cloner.prepareRepo(project, staging)
+        _move_into(staging, dest)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _move_into(source, dest):
+    """Move the content of source to dest, merging directories
+
+    Repositories cloned concurrently create directories in dest at any time.
+    When one shows up while moving a directory of the same name, it is merged
+    instead.
+    """
+    for name in os.listdir(source):
+        src = os.path.join(source, name)
+        dst = os.path.join(dest, name)
+        while True:
+            if _is_dir(dst) and _is_dir(src):
+                _move_into(src, dst)
+                os.rmdir(src)
+                break
+            try:
+                os.replace(src, dst)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # dst has been created meanwhile, merge it
+
+
+def _is_dir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
 def repo_dir(repo):
     mapper = CloneMapper(CLONE_MAP, [repo])
     return mapper.expand(workspace='./')[repo]
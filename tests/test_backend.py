@@ -1,7 +1,14 @@
+import glob
+import http.server
 import json
 import os
 import shutil
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 from unittest.mock import ANY
@@ -9,18 +16,148 @@ import urllib.request
 
 from pytest import mark
 from quibble.backend import getDatabase, get_backend, _tcp_wait
+from quibble.backend import _stream_relay
+from quibble.backend import _http_ready
+from quibble.backend import _unix_socket_ready
+from quibble.backend import _wait_for
+from quibble.backend import _x_display_ready
 from quibble.backend import DatabaseServer
+import quibble
 from quibble.backend import ChromeWebDriver
 from quibble.backend import PhpWebserver
 from quibble.backend import ExternalWebserver
 from quibble.backend import MySQL
 from quibble.backend import Postgres
+from quibble.backend import SQLite
 from quibble.backend import Memcached
 
 FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
 PHPDOCROOT = os.path.join(FIXTURES_DIR, 'phpdocroot')
 
 
+def test_stream_relay_logs_each_line():
+    lines = []
+    done = threading.Event()
+
+    def log_function(line):
+        lines.append(line)
+        if line == 'third':
+            done.set()
+
+    with subprocess.Popen(
+        [
+            sys.executable,
+            '-c',
+            'import sys; sys.stderr.write("first  \\nsecond\\nthird")',
+        ],
+        stderr=subprocess.PIPE,
+        text=True,
+    ) as proc:
+        _stream_relay(proc, proc.stderr, log_function)
+        assert done.wait(timeout=5)
+
+    assert lines == ['first', 'second', 'third']
+
+
+def test_stream_relay_to_files(tmp_path):
+    log_function = mock.Mock()
+    relay_log = tmp_path / (
+        'backend-%s.log' % os.path.basename(sys.executable)
+    )
+    with mock.patch('quibble.backend._relay_log_dir', str(tmp_path)):
+        with subprocess.Popen(
+            [sys.executable, '-c', 'import sys; sys.stderr.write("a\\nb\\n")'],
+            stderr=subprocess.PIPE,
+        ) as proc:
+            _stream_relay(proc, proc.stderr, log_function)
+            # The file is flushed once the process ended
+            for _ in range(50):
+                if relay_log.read_text():
+                    break
+                time.sleep(0.1)
+
+    assert relay_log.read_text() == 'a\nb\n'
+    log_function.assert_not_called()
+
+
+class TestWaitFor(unittest.TestCase):
+    def test_retries_until_ready(self):
+        probe = mock.Mock(side_effect=[False, ConnectionRefusedError, True])
+        _wait_for(probe, 'something', timeout=5)
+        self.assertEqual(3, probe.call_count)
+
+    def test_timeout(self):
+        with self.assertRaisesRegex(
+            TimeoutError, 'something not ready after 0.05 seconds'
+        ):
+            _wait_for(lambda: False, 'something', timeout=0.05)
+
+    def test_process_died(self):
+        with subprocess.Popen([sys.executable, '-c', 'exit(3)']) as proc:
+            proc.wait()
+            with self.assertRaisesRegex(
+                Exception, r'something died during startup \(3\)'
+            ):
+                _wait_for(lambda: False, 'something', 5, process=proc)
+
+    def test_prints_errorlog_on_failure(self):
+        errorlog = os.path.join(FIXTURES_DIR, 'phpdocroot', 'index.php')
+        with mock.patch('builtins.print') as mock_print:
+            with self.assertRaises(TimeoutError):
+                _wait_for(lambda: False, 'x', 0, errorlog=errorlog)
+        with open(errorlog) as f:
+            mock_print.assert_called_once_with(f.read())
+
+    def test_unix_socket_ready(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'socket')
+            with self.assertRaises(OSError):
+                _unix_socket_ready(path)
+            with socket.socket(socket.AF_UNIX) as server:
+                server.bind(path)
+                server.listen()
+                self.assertTrue(_unix_socket_ready(path))
+
+    @mark.skipif(
+        not sys.platform.startswith('linux'),
+        reason='Requires the Linux abstract socket namespace',
+    )
+    def test_x_display_ready_on_abstract_socket(self):
+        display = ':%s' % (9000 + os.getpid() % 1000)
+        with self.assertRaises(OSError):
+            _x_display_ready(display)
+        with socket.socket(socket.AF_UNIX) as server:
+            server.bind('\0/tmp/.X11-unix/X%s' % display[1:])
+            server.listen()
+            self.assertTrue(_x_display_ready(display + '.0'))
+
+    def test_http_ready(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == '/status' else 404)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        with http.server.HTTPServer(('127.0.0.1', 0), Handler) as httpd:
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.start()
+            try:
+                url = 'http://127.0.0.1:%s' % httpd.server_port
+                # A proxy from the environment is not used
+                with mock.patch.dict(
+                    'os.environ',
+                    {'http_proxy': 'http://192.0.2.1:3128', 'no_proxy': ''},
+                ):
+                    self.assertTrue(_http_ready(url + '/status'))
+                self.assertFalse(_http_ready(url + '/missing'))
+                self.assertTrue(_http_ready(url + '/missing', status=404))
+            finally:
+                httpd.shutdown()
+                thread.join()
+
+
 class TestBackendRegistry(unittest.TestCase):
     def test_recognizes_mysql(self):
         get_backend(DatabaseServer, 'mysql')
@@ -41,6 +178,15 @@ class TestBackendRegistry(unittest.TestCase):
 
 
 class TestDatabaseServer(unittest.TestCase):
+    def test_unsupported_operations(self):
+        db = DatabaseServer()
+        with self.assertLogs(db.log, 'WARNING'):
+            self.assertIsNone(db.clone_databases(2))
+        with self.assertLogs(db.log, 'WARNING'):
+            self.assertFalse(db.snapshot('/tmp/snapshot'))
+        with self.assertLogs(db.log, 'WARNING'):
+            self.assertFalse(db.restore('/tmp/snapshot'))
+
     @mock.patch('quibble.backend.os.makedirs')
     @mock.patch('quibble.backend.tempfile.TemporaryDirectory')
     def test_creates_basedir(self, mock_makedirs, _):
@@ -70,14 +216,41 @@ class TestDatabaseServer(unittest.TestCase):
         (args, kwargs) = mock_makedirs.call_args
         self.assertEqual(os.path.join(os.getcwd(), 'data'), kwargs.get('dir'))
 
+    @mock.patch('quibble.backend.os.makedirs')
+    @mock.patch('quibble.backend.tempfile.TemporaryDirectory')
+    def test_ephemeral_profile_uses_tmpfs(self, mock_tmpdir, _):
+        db = DatabaseServer()
+        db.profile = 'ephemeral'
+        db.ephemeral_dir = FIXTURES_DIR
+        db.start()
+        self.assertEqual(FIXTURES_DIR, mock_tmpdir.call_args.kwargs['dir'])
+
+    @mock.patch('quibble.backend.os.makedirs')
+    @mock.patch('quibble.backend.tempfile.TemporaryDirectory')
+    def test_ephemeral_profile_honors_basedir(self, mock_tmpdir, _):
+        db = DatabaseServer(base_dir='/tmp/booo')
+        db.profile = 'ephemeral'
+        db.start()
+        self.assertEqual('/tmp/booo', mock_tmpdir.call_args.kwargs['dir'])
+
+    def test_getDatabase_profile(self):
+        self.assertEqual(
+            getDatabase(
+                'mysql', None, None, None, profile='ephemeral'
+            ).profile,
+            'ephemeral',
+        )
+
 
 class TestChromeWebDriver(unittest.TestCase):
     def setUp(self):
-        patcher = mock.patch(
-            'quibble.backend._stream_relay', return_value=True
-        )
-        self.addCleanup(patcher.stop)
-        patcher.start()
+        for target in [
+            'quibble.backend._stream_relay',
+            'quibble.backend._wait_for',
+        ]:
+            patcher = mock.patch(target, return_value=True)
+            self.addCleanup(patcher.stop)
+            patcher.start()
 
     @mock.patch('quibble.is_in_docker', return_value=True)
     @mock.patch('subprocess.Popen')
@@ -130,9 +303,17 @@ class TestChromeWebDriver(unittest.TestCase):
 
     @mock.patch.dict(os.environ, {'DISPLAY': ':30'})
     @mock.patch('subprocess.Popen')
-    def test_restore_display(self, mock_popen):
-        ChromeWebDriver(display=':42').start()
-        self.assertEqual(os.environ['DISPLAY'], ':30')
+    def test_does_not_alter_environment(self, mock_popen):
+        environ = dict(os.environ)
+        with mock.patch(
+            'quibble.chromium_flags', wraps=quibble.chromium_flags
+        ) as chromium_flags:
+            ChromeWebDriver(display=':42').start()
+
+        chromium_flags.assert_called_once_with(':42')
+        self.assertEqual(dict(os.environ), environ)
+        env = mock_popen.call_args.kwargs['env']
+        self.assertEqual(env['DISPLAY'], ':42')
 
 
 class TestExternalWebserverEngine(unittest.TestCase):
@@ -253,10 +434,151 @@ class TestMySQL(unittest.TestCase):
         with self.assertRaises(Exception, msg='FAILED (42): some output'):
             MySQL()._createwikidb()
 
+    def test_mysqld_command(self):
+        mysql = MySQL()
+        mysql.rootdir = '/db'
+        mysql.errorlog = '/log/mysql-error.log'
+        mysql.pidfile = '/db/mysqld.pid'
+        mysql.socket = '/db/socket'
+
+        self.assertNotIn('--skip-log-bin', mysql._mysqld_command())
+
+        mysql.profile = 'ephemeral'
+        self.assertEqual(
+            mysql._mysqld_command()[-4:],
+            [
+                '--skip-log-bin',
+                '--innodb-flush-log-at-trx-commit=0',
+                '--innodb-doublewrite=0',
+                '--performance-schema=OFF',
+            ],
+        )
+
+    @mock.patch('quibble.backend.subprocess.check_output')
+    @mock.patch('quibble.backend.MySQL._run_install_db')
+    def test_install_db_from_template(self, mock_install_db, mock_version):
+        def install_db(datadir):
+            with open(os.path.join(datadir, 'ibdata1'), 'w') as f:
+                f.write('pristine')
+
+        mock_install_db.side_effect = install_db
+        mock_version.return_value = b'mysqld  Ver 10.11.6-MariaDB\n'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            template_dir = os.path.join(tmp, 'templates')
+            servers = []
+            for _ in range(2):
+                mysql = MySQL(base_dir=tmp, template_dir=template_dir)
+                mysql._init_rootdir(tmp)
+                mysql._install_db()
+                servers.append(mysql)
+
+            mock_install_db.assert_called_once()
+            self.assertEqual(
+                os.listdir(template_dir),
+                [
+                    os.path.basename(
+                        mysql._template_path(mysql._template_key())
+                    )
+                ],
+            )
+            for server in servers:
+                with open(os.path.join(server.rootdir, 'ibdata1')) as f:
+                    self.assertEqual(f.read(), 'pristine')
+
+            # Another server version gets another template
+            mock_version.return_value = b'mysqld  Ver 11.4.2-MariaDB\n'
+            mysql._install_db()
+            self.assertEqual(mock_install_db.call_count, 2)
+            self.assertEqual(len(os.listdir(template_dir)), 2)
+
+    @mock.patch('quibble.backend.subprocess.Popen')
+    def test_clone_databases(self, mock_popen):
+        mock_popen.return_value.communicate.side_effect = [
+            ('page\nuser\n', None),
+            ('', None),
+        ]
+        mock_popen.return_value.returncode = 0
+
+        self.assertEqual(MySQL().clone_databases(2), ['wikidb_1', 'wikidb_2'])
+
+        sql = mock_popen.return_value.communicate.call_args.kwargs['input']
+        self.assertIn('CREATE DATABASE wikidb_2;', sql)
+        self.assertIn(
+            'CREATE TABLE `wikidb_1`.`page` LIKE `wikidb`.`page`;'
+            'INSERT INTO `wikidb_1`.`page` SELECT * FROM `wikidb`.`page`;',
+            sql,
+        )
+        self.assertIn('INSERT INTO `wikidb_2`.`user`', sql)
+
+
+class TestSQLite(unittest.TestCase):
+    def test_clone_databases(self):
+        sqlite = SQLite()
+        sqlite.start()
+        self.addCleanup(sqlite._tmpdir.cleanup)
+        with open(os.path.join(sqlite.rootdir, 'wikidb.sqlite'), 'w') as f:
+            f.write('data')
+
+        self.assertEqual(sqlite.clone_databases(2), ['wikidb_1', 'wikidb_2'])
+        for name in ('wikidb_1', 'wikidb_2'):
+            with open(os.path.join(sqlite.rootdir, name + '.sqlite')) as f:
+                self.assertEqual(f.read(), 'data')
+
+    def test_clone_databases_copies_the_derived_databases(self):
+        sqlite = SQLite()
+        sqlite.start()
+        self.addCleanup(sqlite._tmpdir.cleanup)
+        for name in (
+            'wikidb.sqlite',
+            'wikidb_jobqueue.sqlite',
+            'wikicache.sqlite',
+        ):
+            with open(os.path.join(sqlite.rootdir, name), 'w') as f:
+                f.write(name)
+
+        sqlite.clone_databases(1)
+
+        for clone, source in (
+            ('wikidb_1.sqlite', 'wikidb.sqlite'),
+            ('wikidb_1_jobqueue.sqlite', 'wikidb_jobqueue.sqlite'),
+            ('wikidb_1_wikicache.sqlite', 'wikicache.sqlite'),
+        ):
+            with open(os.path.join(sqlite.rootdir, clone)) as f:
+                self.assertEqual(f.read(), source)
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(sqlite.rootdir, 'wikidb_1_l10n_cache.sqlite')
+            )
+        )
+
+    def test_snapshot_and_restore(self):
+        sqlite = SQLite()
+        sqlite.start()
+        self.addCleanup(sqlite._tmpdir.cleanup)
+        for name in ('wikidb.sqlite', 'wikicache.sqlite', 'other.log'):
+            with open(os.path.join(sqlite.rootdir, name), 'w') as f:
+                f.write(name)
+
+        with tempfile.TemporaryDirectory() as snapshot:
+            sqlite.snapshot(snapshot)
+            self.assertEqual(
+                sorted(os.listdir(snapshot)),
+                ['wikicache.sqlite', 'wikidb.sqlite'],
+            )
+
+            restored = SQLite()
+            restored.start()
+            self.addCleanup(restored._tmpdir.cleanup)
+            restored.restore(snapshot)
+            with open(os.path.join(restored.rootdir, 'wikidb.sqlite')) as f:
+                self.assertEqual(f.read(), 'wikidb.sqlite')
+
 
 @mark.skipif(
-    not shutil.which('pg_virtualenv'),
-    reason='Requires pg_virtualenv PostgreSQL command',
+    not shutil.which('initdb')
+    and not glob.glob('/usr/lib/postgresql/*/bin/initdb'),
+    reason='Requires PostgreSQL initdb command',
 )
 class TestPostgres(unittest.TestCase):
     @mark.integration
@@ -268,6 +590,70 @@ class TestPostgres(unittest.TestCase):
             )
 
 
+class TestPostgresCommand(unittest.TestCase):
+    def test_server_options(self):
+        pg = Postgres()
+        pg.socket = '/db/socket'
+
+        self.assertEqual(
+            pg._server_options(),
+            ['-c', "listen_addresses=''", '-k', '/db/socket'],
+        )
+
+        pg.profile = 'ephemeral'
+        self.assertEqual(
+            pg._server_options()[4:],
+            [
+                '-c',
+                'fsync=off',
+                '-c',
+                'synchronous_commit=off',
+                '-c',
+                'full_page_writes=off',
+            ],
+        )
+
+    @mock.patch('shutil.which', return_value=None)
+    @mock.patch('glob.glob')
+    def test_pg_command_picks_most_recent_version(self, mock_glob, _):
+        mock_glob.return_value = [
+            '/usr/lib/postgresql/9/bin/initdb',
+            '/usr/lib/postgresql/15/bin/initdb',
+            '/usr/lib/postgresql/13/bin/initdb',
+        ]
+        self.assertEqual(
+            Postgres._pg_command('initdb'),
+            '/usr/lib/postgresql/15/bin/initdb',
+        )
+
+    def test_wait_ready(self):
+        with tempfile.TemporaryDirectory() as rootdir:
+            pg = Postgres()
+            pg.datadir = rootdir
+            pg.socket = rootdir
+            pg.errorlog = os.path.join(rootdir, 'postgres.log')
+
+            with open(pg.errorlog, 'w') as f:
+                f.write('FATAL: something went wrong\n')
+            pidfile = os.path.join(rootdir, 'postmaster.pid')
+            with open(pidfile, 'w') as f:
+                f.write('42\n' * 7 + 'starting\n')
+
+            with socket.socket(socket.AF_UNIX) as server:
+                server.bind(os.path.join(rootdir, '.s.PGSQL.5432'))
+                server.listen()
+
+                with self.assertRaisesRegex(
+                    TimeoutError, 'Postgres not ready'
+                ):
+                    with mock.patch('builtins.print'):
+                        pg._wait_ready(timeout=0.1)
+
+                with open(pidfile, 'w') as f:
+                    f.write('42\n' * 7 + 'ready   \n')
+                pg._wait_ready(timeout=1)
+
+
 @mark.skipif(
     not shutil.which('memcached'),
     reason='Requires memcached command',
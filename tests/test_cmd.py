@@ -149,6 +149,7 @@ class CmdTest(unittest.TestCase):
         args = cmd._parse_arguments([])
 
         self.assertEqual('ref', args.git_cache)
+        self.assertEqual('full', args.git_clone_mode)
         self.assertEqual(os.getcwd(), args.workspace)
         self.assertEqual('log', args.log_dir)
 
@@ -597,3 +598,21 @@ class CmdTest(unittest.TestCase):
                 quibbleCmd.execute(plan, '/tmp')
                 assert quibbleCmd.earlywarn.assert_called_once()
                 assert otherCmd.assert_not_called, 'build plan must be aborted'
+
+    def test_execute_with_dag_scheduler_calls_earlywarn(self):
+        error = subprocess.CalledProcessError(42, 'fail')
+        with mock.patch('quibble.scheduler.Scheduler') as scheduler:
+            scheduler.return_value.execute.side_effect = error
+            with mock.patch('quibble.cmd.QuibbleCmd.earlywarn') as earlywarn:
+                with self.assertRaises(subprocess.CalledProcessError):
+                    cmd.QuibbleCmd().execute(
+                        ['some plan'], '/tmp', scheduler='dag'
+                    )
+
+        earlywarn.assert_called_once_with(
+            error, scheduler.return_value.failed_command, '/tmp', None
+        )
+
+    def test_scheduler_defaults_to_linear(self):
+        args = cmd._parse_arguments(args=[])
+        self.assertEqual('linear', args.scheduler)
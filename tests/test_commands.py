@@ -1,21 +1,29 @@
 #!/usr/bin/env python3
 
 import contextlib
+import git
 import hashlib
 import io
+import json
 import logging
 import os.path
 import pathlib
 import pytest
 import re
+import resource
 import subprocess
 import sys
+import tempfile
+import threading
 import unittest
+import xml.etree.ElementTree as ET
 from unittest import mock
 from unittest.mock import call
+import zlib
 
 from quibble import CommandTiming
 import quibble.commands
+import quibble.durations
 
 
 broken_on_macos = pytest.mark.skipif(
@@ -231,7 +239,9 @@ class ReportDurationsTest:
 
         assert [rec.message for rec in caplog.records] == [
             'Wrote durations to %s'
-            % os.path.join(test_log_dir, 'quibble-durations.json')
+            % os.path.join(test_log_dir, 'quibble-durations.json'),
+            'Wrote trace to %s'
+            % os.path.join(test_log_dir, 'quibble-trace.json'),
         ]
 
     @pytest.mark.usefixtures('caplog')
@@ -272,7 +282,8 @@ class ReportDurationsTest:
         )
         assert expected == result
 
-    def test_dumps_json(self):
+    @mock.patch.object(quibble.commands.ReportDurations, 'writeTraceReport')
+    def test_dumps_json(self, _):
         reporter = quibble.commands.ReportDurations(
             contextlib.ExitStack(), log_dir='/tmp/quibble-test-log'
         )
@@ -309,6 +320,144 @@ class ReportDurationsTest:
             )
         )
 
+    def test_reports_are_closed(self, tmp_path):
+        reporter = quibble.commands.ReportDurations(
+            contextlib.ExitStack(), log_dir=str(tmp_path)
+        )
+        fixture = [CommandTiming(1.5, 'npm test', start=10.0, end=11.5)]
+
+        with mock.patch('quibble.DURATIONS', fixture):
+            with mock.patch('builtins.open', mock.mock_open()) as m:
+                with reporter:
+                    pass
+
+        assert [c.args[0] for c in m.call_args_list] == [
+            str(tmp_path / 'quibble-durations.json'),
+            str(tmp_path / 'quibble-trace.json'),
+        ]
+        assert m.return_value.__exit__.call_count == 2
+
+    @mock.patch.object(quibble.commands.ReportDurations, 'writeTraceReport')
+    def test_json_has_nested_timings(self, _):
+        reporter = quibble.commands.ReportDurations(
+            contextlib.ExitStack(), log_dir='/tmp/quibble-test-log'
+        )
+        fixture = [
+            CommandTiming(
+                1.5, 'npm test', start=10.0, end=11.5, pid=42, parent='tests'
+            ),
+            CommandTiming(2.0, 'tests', start=10.0, end=12.0, pid=1),
+        ]
+
+        with mock.patch('quibble.DURATIONS', fixture):
+            with mock.patch('os.path.exists', return_value=True):
+                with mock.patch('builtins.open', mock.mock_open()) as m:
+                    with reporter:
+                        pass
+
+        json_str = "".join(
+            [write_call.args[0] for write_call in m().write.mock_calls]
+        )
+        assert json.loads(json_str)['durations'] == [
+            {
+                'seconds': 1.5,
+                'command': 'npm test',
+                'start': 10.0,
+                'end': 11.5,
+                'pid': 42,
+                'parent': 'tests',
+            },
+            {
+                'seconds': 2.0,
+                'command': 'tests',
+                'start': 10.0,
+                'end': 12.0,
+                'pid': 1,
+            },
+        ]
+
+    @pytest.mark.parametrize(
+        'exc_type,expected_runs',
+        [
+            pytest.param(None, [('SUCCESS',)], id='success'),
+            pytest.param(
+                subprocess.CalledProcessError, [('FAILURE',)], id='failure'
+            ),
+            pytest.param(
+                quibble.commands.SuccessCache.Hit, [], id='success cache hit'
+            ),
+        ],
+    )
+    def test_records_durations(self, tmp_path, exc_type, expected_runs):
+        db_path = str(tmp_path / 'durations.sqlite')
+        reporter = quibble.commands.ReportDurations(
+            contextlib.ExitStack(),
+            durations_db=db_path,
+            project='mediawiki/core',
+            branch='master',
+        )
+
+        with mock.patch('quibble.DURATIONS', [CommandTiming(1.5, 'npm ci')]):
+            reporter.recordDurations(exc_type)
+
+        db = quibble.durations.DurationsDB(db_path)
+        runs = db.runs('mediawiki/core', 'master', 5)
+        assert [(result,) for (_, _, result) in runs] == expected_runs
+        if runs:
+            assert db.stages(runs[0][0]) == {'npm ci': 1.5}
+
+    def test_build_trace(self):
+        timings = [
+            CommandTiming(0.5, 'no start'),
+            CommandTiming(
+                1.5,
+                'npm test',
+                start=10.0,
+                end=11.5,
+                pid=42,
+                parent='tests',
+                tid=43,
+            ),
+            CommandTiming(2.0, 'tests', start=10.0, end=12.0, pid=1, tid=1),
+        ]
+
+        trace = quibble.commands.ReportDurations._build_trace(timings, 1)
+
+        assert trace['displayTimeUnit'] == 'ms'
+        assert trace['traceEvents'] == [
+            {
+                'name': 'npm test',
+                'cat': 'quibble',
+                'ph': 'X',
+                'ts': 10000000.0,
+                'dur': 1500000.0,
+                'pid': 42,
+                'tid': 43,
+                'args': {'parent': 'tests'},
+            },
+            {
+                'name': 'tests',
+                'cat': 'quibble',
+                'ph': 'X',
+                'ts': 10000000.0,
+                'dur': 2000000.0,
+                'pid': 1,
+                'tid': 1,
+            },
+            {
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': 1,
+                'args': {'name': 'quibble'},
+            },
+            {
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': 42,
+                'args': {'name': 'quibble worker 42'},
+            },
+        ]
+
 
 class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
     def test_submodule_update_errors(self):
@@ -527,6 +676,340 @@ class StartBackendsTest(unittest.TestCase):
         self.assertRegex(log.output[1], "Shutting down backends:.*contextlib")
         self.assertRegex(log.output[2], "Stopped mock.")
 
+    class FakeBackend:
+        def __init__(self, name, events, requires=(), provides=(), fail=False):
+            self.name = name
+            self.events = events
+            self.requires = frozenset(requires)
+            self.provides = frozenset(provides)
+            self.fail = fail
+
+        def __enter__(self):
+            self.events.append('start %s' % self.name)
+            if self.fail:
+                raise Exception('%s failed' % self.name)
+
+        def __exit__(self, *args):
+            self.events.append('stop %s' % self.name)
+
+        def __str__(self):
+            return self.name
+
+    def test_starts_and_stops_respecting_requirements(self):
+        events = []
+        xvfb = self.FakeBackend('xvfb', events, provides={'display'})
+        chromedriver = self.FakeBackend(
+            'chromedriver', events, requires={'display'}
+        )
+        context_stack = contextlib.ExitStack()
+        cmd = quibble.commands.StartBackends(
+            context_stack, [chromedriver, xvfb]
+        )
+
+        with context_stack:
+            cmd.execute()
+            self.assertEqual(['start xvfb', 'start chromedriver'], events)
+        self.assertEqual(['stop chromedriver', 'stop xvfb'], events[2:])
+
+    def test_stops_started_backends_on_failure(self):
+        events = []
+        ok = self.FakeBackend('ok', events)
+        failing = self.FakeBackend(
+            'failing', events, provides={'display'}, fail=True
+        )
+        never = self.FakeBackend('never', events, requires={'display'})
+        context_stack = contextlib.ExitStack()
+        cmd = quibble.commands.StartBackends(
+            context_stack, [ok, failing, never]
+        )
+
+        with self.assertRaisesRegex(Exception, 'failing failed'):
+            cmd.execute()
+
+        self.assertNotIn('start never', events)
+        self.assertIn('stop ok', events)
+        self.assertNotIn('stop failing', events)
+        # Nothing left to stop on exit
+        del events[:]
+        context_stack.close()
+        self.assertEqual([], events)
+
+    def test_stop_is_bounded(self):
+        stuck = threading.Event()
+        backend = mock.MagicMock()
+        backend.__exit__.side_effect = lambda *args: stuck.wait()
+        cmd = quibble.commands.StartBackends(contextlib.ExitStack(), [backend])
+        cmd.stop_timeout = 0.1
+
+        with self.assertLogs('quibble.commands', level='WARNING') as log:
+            cmd._stop([backend])
+        stuck.set()
+        self.assertIn('Gave up waiting for backends', log.output[0])
+
+
+def git_commit(path, files):
+    """Commit files, given as a name to content dict, to a git repository
+    which is created as needed"""
+    if os.path.exists(os.path.join(path, '.git')):
+        repo = git.Repo(path)
+    else:
+        repo = git.Repo.init(path)
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+    repo.index.add(list(files))
+    repo.index.commit('test')
+
+
+class InstallSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.mw = os.path.join(self.tmp, 'src')
+        self.snapshot_dir = os.path.join(self.tmp, 'snapshots')
+
+        self.commit(self.mw, {'sql/tables.json': '[]', 'README': 'core'})
+        self.commit(
+            os.path.join(self.mw, 'extensions/Foo'),
+            {'extension.json': '{}', 'README': 'foo'},
+        )
+
+        self.db = mock.Mock(rootdir='/tmp/quibble-mysql-old')
+
+        def snapshot(path):
+            with open(os.path.join(path, 'mysql.sql'), 'w') as f:
+                f.write('CREATE TABLE page;')
+            return True
+
+        self.db.snapshot.side_effect = snapshot
+
+    def commit(self, path, files):
+        git_commit(path, files)
+
+    def snapshot(self, rootdir='/tmp/quibble-mysql-old'):
+        self.db.rootdir = rootdir
+        return quibble.commands.InstallSnapshot(
+            self.snapshot_dir,
+            self.mw,
+            self.db,
+            key_data=['mysql', '--dbserver={rootdir}/socket'],
+            volatile={'rootdir': rootdir},
+        )
+
+    def test_save_and_restore(self):
+        installed = os.path.join(self.tmp, 'LocalSettings-installer.php')
+        with open(installed, 'w') as f:
+            f.write(
+                '$wgDBserver = "/tmp/quibble-mysql-old/socket";\n'
+                # Unrelated settings are left alone
+                '$wgLogo = "/tmp/quibble-mysql-old/socket";\n'
+            )
+
+        snapshot = self.snapshot()
+        self.assertFalse(snapshot.restore(installed))
+        snapshot.save(installed)
+
+        snapshot = self.snapshot(rootdir='/tmp/quibble-mysql-new')
+        localsettings = os.path.join(self.tmp, 'LocalSettings.php')
+        self.assertTrue(snapshot.restore(localsettings))
+
+        self.db.restore.assert_called_once_with(
+            os.path.join(snapshot.path, 'db')
+        )
+        with open(os.path.join(snapshot.path, 'db', 'mysql.sql')) as f:
+            self.assertEqual(f.read(), 'CREATE TABLE page;')
+        with open(localsettings) as f:
+            self.assertEqual(
+                f.read(),
+                '$wgDBserver = "/tmp/quibble-mysql-new/socket";\n'
+                '$wgLogo = "/tmp/quibble-mysql-old/socket";\n',
+            )
+        self.assertEqual(
+            os.listdir(self.snapshot_dir),
+            ['install-%s' % (snapshot._digest())],
+        )
+
+    def test_key_depends_on_the_schema_trees(self):
+        digest = self.snapshot()._digest()
+
+        # Changes of a patch under test which do not touch the schema
+        self.commit(self.mw, {'README': 'patched'})
+        self.commit(
+            os.path.join(self.mw, 'extensions/Foo'),
+            {'includes/Hooks.php': '<?php'},
+        )
+        self.assertEqual(self.snapshot()._digest(), digest)
+
+        self.commit(
+            os.path.join(self.mw, 'extensions/Foo'),
+            {'sql/foo.sql': 'CREATE TABLE foo;'},
+        )
+        self.assertNotEqual(self.snapshot()._digest(), digest)
+
+    def test_key_depends_on_the_mediawiki_version(self):
+        digest = self.snapshot()._digest()
+
+        self.commit(
+            self.mw,
+            {'includes/Defines.php': "<?php\ndefine( 'MW_VERSION', '1.40' );"},
+        )
+        self.assertNotEqual(self.snapshot()._digest(), digest)
+        digest = self.snapshot()._digest()
+
+        self.commit(
+            self.mw,
+            {
+                'includes/Defines.php': "<?php\n"
+                "define( 'MW_VERSION', '1.40' );\n"
+                "define( 'NS_MAIN', 0 );"
+            },
+        )
+        self.assertEqual(self.snapshot()._digest(), digest)
+
+    def test_key_depends_on_installed_extensions(self):
+        digest = self.snapshot()._digest()
+
+        self.commit(
+            os.path.join(self.mw, 'extensions/Bar'), {'extension.json': '{}'}
+        )
+        self.assertNotEqual(self.snapshot()._digest(), digest)
+
+    def test_backend_without_snapshots(self):
+        installed = os.path.join(self.tmp, 'LocalSettings-installer.php')
+        with open(installed, 'w') as f:
+            f.write('$wgDBserver = "/tmp/quibble-mysql-old/socket";')
+        self.db.snapshot.side_effect = None
+        self.db.snapshot.return_value = False
+
+        self.snapshot().save(installed)
+        self.assertEqual(os.listdir(self.snapshot_dir), [])
+
+        # A snapshot saved before can not be restored either
+        self.db.snapshot.side_effect = lambda path: True
+        self.snapshot().save(installed)
+        self.db.restore.return_value = False
+        self.assertFalse(
+            self.snapshot().restore(
+                os.path.join(self.tmp, 'LocalSettings.php')
+            )
+        )
+
+    @mock.patch('quibble.commands.log')
+    def test_save_failure_is_not_fatal(self, mock_log):
+        self.db.snapshot.side_effect = Exception('mysqldump failed')
+
+        self.snapshot().save(os.path.join(self.tmp, 'missing.php'))
+
+        mock_log.warning.assert_called_once_with(
+            'Could not save install snapshot: %s', mock.ANY
+        )
+        self.assertEqual(os.listdir(self.snapshot_dir), [])
+
+
+class LocalisationCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.mw = os.path.join(self.tmp, 'src')
+        self.ext = os.path.join(self.mw, 'extensions/Foo')
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+
+        git_commit(self.mw, {'languages/i18n/en.json': '{}', 'README': 'core'})
+        git_commit(
+            self.ext,
+            {
+                'extension.json': json.dumps(
+                    {
+                        'MessagesDirs': {'Foo': ['i18n', 'i18n/api']},
+                        'ExtensionMessagesFiles': {
+                            'FooAlias': 'Foo.alias.php'
+                        },
+                    }
+                ),
+                'i18n/en.json': '{}',
+                'Foo.alias.php': '<?php',
+                'src/Foo.php': '<?php',
+            },
+        )
+
+    def l10n_cache(self, tmp_dir=None):
+        tmp_dir = tmp_dir or os.path.join(self.tmp, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return quibble.commands.LocalisationCache(
+            self.cache_dir, self.mw, tmp_dir, ['en']
+        )
+
+    def test_save_and_restore(self):
+        l10n_cache = self.l10n_cache()
+        self.assertFalse(l10n_cache.restore())
+        self.assertTrue(l10n_cache.prepare_save())
+        for name in ('l10n_cache-en.cdb', 'unrelated.txt'):
+            with open(os.path.join(l10n_cache.tmp_dir, name), 'w') as f:
+                f.write(name)
+        l10n_cache.save()
+
+        restored_dir = os.path.join(self.tmp, 'restored')
+        self.assertTrue(self.l10n_cache(restored_dir).restore())
+        self.assertEqual(os.listdir(restored_dir), ['l10n_cache-en.cdb'])
+
+    def test_messages_files_get_a_fixed_mtime(self):
+        mtime = quibble.commands.LocalisationCache.MTIME
+        en_json = os.path.join(self.mw, 'languages/i18n/en.json')
+
+        # Not on a cache miss
+        self.l10n_cache().restore()
+        self.assertNotEqual(os.path.getmtime(en_json), mtime)
+
+        self.l10n_cache().prepare_save()
+
+        for path in (
+            'languages/i18n/en.json',
+            'extensions/Foo/i18n/en.json',
+            'extensions/Foo/Foo.alias.php',
+            'extensions/Foo/extension.json',
+        ):
+            self.assertEqual(
+                os.path.getmtime(os.path.join(self.mw, path)), mtime, path
+            )
+        self.assertNotEqual(
+            os.path.getmtime(os.path.join(self.ext, 'src/Foo.php')), mtime
+        )
+
+    @mock.patch('quibble.commands.log')
+    def test_unusable_cache_dir(self, mock_log):
+        with open(self.cache_dir, 'w'):
+            pass
+
+        self.assertFalse(self.l10n_cache().prepare_save())
+
+        mock_log.warning.assert_called_once_with(
+            'Could not save localisation cache: %s', mock.ANY
+        )
+        self.assertNotEqual(
+            os.path.getmtime(os.path.join(self.mw, 'languages/i18n/en.json')),
+            quibble.commands.LocalisationCache.MTIME,
+        )
+
+    def test_key_depends_on_install_path(self):
+        digest = self.l10n_cache()._digest()
+
+        moved = os.path.join(self.tmp, 'moved')
+        os.rename(self.mw, moved)
+        self.mw = moved
+        self.assertNotEqual(self.l10n_cache()._digest(), digest)
+
+    def test_key_depends_on_messages_files_only(self):
+        digest = self.l10n_cache()._digest()
+
+        git_commit(self.ext, {'src/Foo.php': '<?php // changed'})
+        self.assertEqual(self.l10n_cache()._digest(), digest)
+
+        git_commit(self.ext, {'Foo.alias.php': '<?php // changed'})
+        self.assertNotEqual(self.l10n_cache()._digest(), digest)
+
 
 class InstallMediaWikiTest:
     @mock.patch('quibble.mediawiki.maintenance.rebuildLocalisationCache')
@@ -841,6 +1324,280 @@ class PhpUnitPrepareParallelRunComposerTest(unittest.TestCase):
         )
 
 
+class PhpUnitShardsTest(unittest.TestCase):
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.log_dir = log_dir.name
+
+        mw_install_path = tempfile.TemporaryDirectory()
+        self.addCleanup(mw_install_path.cleanup)
+        self.mw_install_path = mw_install_path.name
+        with open(
+            os.path.join(self.mw_install_path, 'phpunit.xml.dist'), 'w'
+        ) as f:
+            f.write(
+                '<phpunit bootstrap="tests/phpunit/bootstrap.php">'
+                '<testsuites><testsuite name="extensions"/></testsuites>'
+                '</phpunit>'
+            )
+        tests_dir = os.path.join(self.mw_install_path, 'tests')
+        os.mkdir(tests_dir)
+        for name in ('FastTest', 'OtherTest', 'SlowTest', 'UnitTest'):
+            with open(os.path.join(tests_dir, name + '.php'), 'w') as f:
+                f.write('<?php\n')
+
+        with open(os.path.join(self.log_dir, 'junit-db.xml'), 'w') as f:
+            f.write(
+                '<testsuites><testsuite>'
+                '<testcase class="SlowTest" time="10"/>'
+                '<testcase class="FastTest" time="1"/>'
+                '<testcase class="OtherTest" time="2"/>'
+                '</testsuite></testsuites>'
+            )
+
+    def list_tests(self, cmd, **kwargs):
+        with open(cmd[-1], 'w') as f:
+            f.write(
+                '<tests>'
+                '<testCaseClass name="FastTest">'
+                '<testCaseMethod name="testA" groups="Database"/>'
+                '</testCaseClass>'
+                '<testCaseClass name="OtherTest">'
+                '<testCaseMethod name="testA" groups="Database"/>'
+                '</testCaseClass>'
+                '<testCaseClass name="SlowTest">'
+                '<testCaseMethod name="testA" groups="Database"/>'
+                '</testCaseClass>'
+                '<testCaseClass name="UnitTest">'
+                '<testCaseMethod name="testA" groups=""/>'
+                '</testCaseClass>'
+                '</tests>'
+            )
+
+    def shards(self, **kwargs):
+        return quibble.commands.PhpUnitShards(
+            mw_install_path=self.mw_install_path,
+            testsuite='extensions',
+            log_dir=self.log_dir,
+            shards=2,
+            database=True,
+            timings=os.path.join(self.log_dir, 'junit-db.xml'),
+            **kwargs,
+        )
+
+    def shard_files(self, cmd):
+        """Files of the test suite of a shard command"""
+        config = cmd[cmd.index('--configuration') + 1]
+        return [
+            os.path.basename(f.text)
+            for f in ET.parse(config).getroot().iter('file')
+        ]
+
+    @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
+    @mock.patch('quibble.commands._wait_accounted')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_execute(self, mock_run, mock_popen, mock_wait):
+        mock_run.side_effect = self.list_tests
+        mock_popen.return_value.returncode = 0
+        shard_files = []
+
+        def popen(cmd, **kwargs):
+            shard_files.append(self.shard_files(cmd))
+            return mock_popen.return_value
+
+        mock_popen.side_effect = popen
+
+        with mock.patch('sys.stdout'):
+            self.shards(junit=True).execute()
+
+        list_tests_xml = os.path.join(self.log_dir, 'phpunit-db-tests.xml')
+        mock_run.assert_called_once_with(
+            [
+                'composer',
+                'run',
+                '--timeout=0',
+                'phpunit',
+                '--',
+                '--testsuite',
+                'extensions',
+                '--list-tests-xml',
+                list_tests_xml,
+            ],
+            cwd=self.mw_install_path,
+            env={'LANG': 'C.UTF-8', 'somevar': '42'},
+        )
+
+        self.assertEqual(
+            shard_files, [['SlowTest.php'], ['OtherTest.php', 'FastTest.php']]
+        )
+        commands = [c.args[0] for c in mock_popen.call_args_list]
+        for index, cmd in enumerate(commands, start=1):
+            self.assertEqual(
+                cmd[5:],
+                [
+                    '--configuration',
+                    os.path.join(
+                        self.mw_install_path,
+                        'phpunit-quibble-db-shard-%s.xml' % index,
+                    ),
+                    '--group',
+                    'Database',
+                    '--exclude-group',
+                    'Broken,Standalone',
+                    '--log-junit',
+                    os.path.join(
+                        self.log_dir, 'junit-db-shard-%s.xml' % index
+                    ),
+                ],
+            )
+        # Configurations of the shards are removed once done
+        self.assertEqual(
+            sorted(os.listdir(self.mw_install_path)),
+            ['phpunit.xml.dist', 'tests'],
+        )
+        self.assertEqual(mock_wait.call_count, 2)
+
+    @mock.patch('quibble.commands._wait_accounted')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_command_line_length_with_many_classes(
+        self, mock_run, mock_popen, mock_wait
+    ):
+        # About the number of test classes of mediawiki/core
+        count = 6000
+
+        def list_tests(cmd, **kwargs):
+            with open(cmd[-1], 'w') as f:
+                f.write('<testSuite><tests>')
+                for i in range(count):
+                    name = 'MediaWiki\\Tests\\Some\\Namespace\\Class%sTest' % i
+                    f.write(
+                        '<testClass name="%s" file="%s">'
+                        '<testMethod id="%s::testA" name="testA"/>'
+                        '</testClass>'
+                        % (name, 'tests/phpunit/Class%sTest.php' % i, name)
+                    )
+                f.write(
+                    '</tests><groups><group name="Database">%s</group>'
+                    '</groups></testSuite>'
+                    % ''.join(
+                        '<test id="MediaWiki\\Tests\\Some\\Namespace\\'
+                        'Class%sTest::testA"/>' % i
+                        for i in range(count)
+                    )
+                )
+
+        mock_run.side_effect = list_tests
+        mock_popen.return_value.returncode = 0
+        shard_files = []
+
+        def popen(cmd, **kwargs):
+            shard_files.append(self.shard_files(cmd))
+            return mock_popen.return_value
+
+        mock_popen.side_effect = popen
+
+        with mock.patch('sys.stdout'):
+            quibble.commands.PhpUnitShards(
+                mw_install_path=self.mw_install_path,
+                testsuite=None,
+                log_dir=self.log_dir,
+                shards=1,
+                database=True,
+            ).execute()
+
+        self.assertEqual(len(shard_files[0]), count)
+        cmd = mock_popen.call_args.args[0]
+        # Linux MAX_ARG_STRLEN
+        self.assertLess(max(len(arg) for arg in cmd), 128 * 1024)
+        self.assertLess(len(' '.join(cmd)), 4096)
+
+    @mock.patch('quibble.commands._wait_accounted')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_failing_shard(self, mock_run, mock_popen, mock_wait):
+        mock_run.side_effect = self.list_tests
+
+        def popen(cmd, stdout, **kwargs):
+            failing = 'SlowTest.php' in self.shard_files(cmd)
+            stdout.write(b'FAILURES!' if failing else b'OK')
+            return mock.Mock(args=cmd, returncode=int(failing))
+
+        mock_popen.side_effect = popen
+
+        with mock.patch('sys.stdout'):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                self.shards().execute()
+
+        self.assertEqual(cm.exception.returncode, 1)
+        self.assertEqual(cm.exception.output, 'FAILURES!')
+        with open(os.path.join(self.log_dir, 'phpunit-db-shard-2.log')) as f:
+            self.assertEqual(f.read(), 'OK')
+
+    @mock.patch('quibble.commands._wait_accounted')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_shards_get_their_own_database(
+        self, mock_run, mock_popen, mock_wait
+    ):
+        mock_run.side_effect = self.list_tests
+        mock_popen.return_value.returncode = 0
+        db = mock.Mock()
+        db.clone_databases.return_value = ['wikidb_1', 'wikidb_2']
+
+        with mock.patch('sys.stdout'):
+            self.shards(db=db).execute()
+
+        db.clone_databases.assert_called_once_with(2)
+        self.assertEqual(
+            [c.kwargs['env']['MW_DB'] for c in mock_popen.call_args_list],
+            ['wikidb_1', 'wikidb_2'],
+        )
+        self.assertNotIn('MW_DB', mock_run.call_args.kwargs['env'])
+
+    @mock.patch('quibble.commands._wait_accounted')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_database_cloning_not_supported(
+        self, mock_run, mock_popen, mock_wait
+    ):
+        mock_run.side_effect = self.list_tests
+        mock_popen.return_value.returncode = 0
+        shard_files = []
+
+        def popen(cmd, env, **kwargs):
+            self.assertNotIn('MW_DB', env)
+            shard_files.append(sorted(self.shard_files(cmd)))
+            return mock_popen.return_value
+
+        mock_popen.side_effect = popen
+        db = mock.Mock()
+        db.clone_databases.return_value = None
+
+        with mock.patch('sys.stdout'):
+            self.shards(db=db).execute()
+
+        # A single shard running all the tests against the wiki database
+        self.assertEqual(
+            shard_files, [['FastTest.php', 'OtherTest.php', 'SlowTest.php']]
+        )
+
+    @mock.patch('subprocess.Popen')
+    @mock.patch('quibble.commands.run')
+    def test_no_tests(self, mock_run, mock_popen):
+        def list_tests(cmd, **kwargs):
+            with open(cmd[-1], 'w') as f:
+                f.write('<tests/>')
+
+        mock_run.side_effect = list_tests
+
+        self.shards().execute()
+
+        mock_popen.assert_not_called()
+
+
 class PhpUnitDatabaseTest(unittest.TestCase):
     @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
     @mock.patch('quibble.commands.run')
@@ -873,6 +1630,81 @@ class PhpUnitDatabaseTest(unittest.TestCase):
         )
 
 
+class PhpUnitResultCacheTest(unittest.TestCase):
+    @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
+    @mock.patch('quibble.commands.run')
+    def test_execute_orders_by_defects(self, mock_run):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            result_cache = quibble.commands.PhpUnitResultCache(
+                ['mediawiki/core', 'master'], cache_dir=cache_dir
+            )
+            quibble.commands.PhpUnitDatabase(
+                mw_install_path='/tmp',
+                testsuite='extensions',
+                log_dir='/log',
+                result_cache=result_cache,
+            ).execute()
+
+            cache_file = os.path.join(
+                cache_dir,
+                result_cache._digest(),
+                'phpunit-db-extensions.result.cache',
+            )
+            self.assertTrue(os.path.isdir(os.path.dirname(cache_file)))
+
+        mock_run.assert_called_once_with(
+            [
+                'composer',
+                'run',
+                '--timeout=0',
+                'phpunit',
+                '--',
+                '--testsuite',
+                'extensions',
+                '--group',
+                'Database',
+                '--exclude-group',
+                'Broken,Standalone',
+                '--cache-result-file',
+                cache_file,
+                '--order-by=defects,duration',
+            ],
+            cwd='/tmp',
+            env={'LANG': 'C.UTF-8', 'somevar': '42'},
+        )
+
+    def test_key_varies_with_key_data(self):
+        self.assertNotEqual(
+            quibble.commands.PhpUnitResultCache(['a', 'master'])._digest(),
+            quibble.commands.PhpUnitResultCache(['b', 'master'])._digest(),
+        )
+
+    @mock.patch('quibble.cache.client')
+    def test_memcached_restore_and_save(self, mock_client):
+        client = mock_client.return_value
+        client.get.return_value = zlib.compress(b'previous')
+        result_cache = quibble.commands.PhpUnitResultCache(
+            ['mediawiki/core', 'master'], memcached_server='localhost:11211'
+        )
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            with result_cache.cache_file('phpunit-db.result.cache') as path:
+                with open(path, 'rb') as f:
+                    self.assertEqual(b'previous', f.read())
+                with open(path, 'wb') as f:
+                    f.write(b'failures')
+                raise subprocess.CalledProcessError(1, 'phpunit')
+
+        key = 'phpunit-results/%s/phpunit-db.result.cache' % (
+            result_cache._digest()
+        )
+        client.get.assert_called_once_with(key)
+        client.set.assert_called_once_with(key, mock.ANY)
+        self.assertEqual(
+            b'failures', zlib.decompress(client.set.call_args.args[1])
+        )
+
+
 class PhpUnitDatabaselessTest(unittest.TestCase):
     @mock.patch('quibble.commands.run')
     def test_execute(self, mock_run):
@@ -1312,6 +2144,9 @@ class EchoCommand:
             print("then fail")
             raise Exception("bad")
 
+    def __str__(self):
+        return 'EchoCommand {}'.format(self.number)
+
 
 class InvalidUnicodeCommand:
     invalid_unicode = b"with invalid unicode: \x80abc"
@@ -1354,13 +2189,19 @@ def test_GitClean(check_output, run, tmp_path, caplog):
     ]
 
 
+@mock.patch('os.wait4')
 @mock.patch('subprocess.Popen')
-def test_run_handles_invalid_unicode(mock_popen, capfdbinary):
+def test_run_handles_invalid_unicode(mock_popen, mock_wait4, capfdbinary):
     invalid_unicode = InvalidUnicodeCommand.invalid_unicode
 
     context = mock_popen.return_value.__enter__.return_value
     context.stdout = io.BytesIO(InvalidUnicodeCommand.invalid_unicode)
-    context.returncode = 1
+    # Exit code 1
+    mock_wait4.return_value = (
+        context.pid,
+        1 << 8,
+        resource.getrusage(resource.RUSAGE_CHILDREN),
+    )
 
     with pytest.raises(subprocess.CalledProcessError) as exc_info:
         quibble.commands.run('fake', cwd='/tmp')
@@ -1373,11 +2214,51 @@ def test_run_handles_invalid_unicode(mock_popen, capfdbinary):
     ), 'raw binary is emitted to stdout'
 
 
+@pytest.mark.parametrize('fail', [False, True])
+def test_run_spills_large_output_to_log_dir(tmp_path, fail):
+    script = 'print("x" * 2 * 1024 * 1024); raise SystemExit(%d)' % fail
+    with mock.patch.dict('os.environ', {'LOG_DIR': str(tmp_path)}):
+        if fail:
+            with pytest.raises(subprocess.CalledProcessError) as exc_info:
+                quibble.commands.run([sys.executable, '-c', script], '/tmp')
+        else:
+            quibble.commands.run([sys.executable, '-c', script], '/tmp')
+
+    spilled = list(tmp_path.iterdir())
+    if fail:
+        assert [f.name.startswith('output-python') for f in spilled] == [True]
+        assert spilled[0].stat().st_size == 2 * 1024 * 1024 + 1
+        assert 'bytes truncated, full output in %s' % spilled[0] in (
+            exc_info.value.output
+        )
+        assert len(exc_info.value.output) < 2 * 1024 * 1024
+    else:
+        assert spilled == []
+
+
+@mock.patch('quibble.DURATIONS', new=[])
+def test_run_accounts_child_resource_usage():
+    with quibble.Chronometer('allocate', mock.MagicMock()):
+        quibble.commands.run(
+            [sys.executable, '-c', 'bytearray(64 * 1024 * 1024)'],
+            cwd='/tmp',
+        )
+
+    rusage = quibble.DURATIONS[0].rusage
+    assert rusage['max_rss'] > 64 * 1024
+    assert rusage['user_cpu'] + rusage['system_cpu'] > 0
+
+
 class ParallelTest(unittest.TestCase):
     def test_init(self):
         p = quibble.commands.Parallel(steps=range(3))
         self.assertEqual(3, len(p.steps))
 
+    @mock.patch('os.cpu_count', return_value=None)
+    def test_workers_when_cpu_count_is_unknown(self, _):
+        p = quibble.commands.Parallel(steps=range(3))
+        self.assertEqual(1, p.workers)
+
     @mock.patch('multiprocessing.Pool')
     def test_execute_empty(self, mock_pool):
         quibble.commands.Parallel(steps=[]).execute()
@@ -1445,6 +2326,25 @@ class ParallelTest(unittest.TestCase):
             "log line\nstdout line\nstderr line\nthen fail\n"
         )
 
+    @broken_on_macos
+    @mock.patch('quibble.commands.log')
+    def test_parallel_propagates_children_timings(self, mock_log):
+        with mock.patch('quibble.DURATIONS', new=[]):
+            with quibble.Chronometer('parallel', mock.MagicMock()):
+                quibble.commands.Parallel(
+                    steps=[EchoCommand(number=1), EchoCommand(number=2)]
+                ).execute()
+
+            timings = {t.command: t for t in quibble.DURATIONS}
+
+        self.assertEqual(
+            ['EchoCommand 1', 'EchoCommand 2', 'parallel'], sorted(timings)
+        )
+        for step in ['EchoCommand 1', 'EchoCommand 2']:
+            self.assertEqual('parallel', timings[step].parent)
+            self.assertNotEqual(os.getpid(), timings[step].pid)
+            self.assertLessEqual(timings[step].start, timings[step].end)
+
     @mock.patch('quibble.commands.log')
     @broken_on_macos
     def test_parallel_run_child_handles_invalid_unicode(self, mock_log):
@@ -1462,13 +2362,133 @@ class ParallelTest(unittest.TestCase):
         )
 
 
+@broken_on_macos
+@pytest.mark.parametrize('fail', [False, True])
+def test_parallel_run_child_streams_output(capfd, fail):
+    error, capture, _ = quibble.commands.Parallel._run_child(
+        EchoCommand(number=1, fail=fail), stream_output=True
+    )
+
+    assert bool(error) == fail
+    expected = ['log line', 'stdout line', 'stderr line', 'I am 1.']
+    if fail:
+        expected.append('then fail')
+    assert set(expected) <= set(capture.splitlines())
+
+    streamed = capfd.readouterr().out.splitlines()
+    assert all(line.startswith('[EchoCommand 1] ') for line in streamed)
+    assert set('[EchoCommand 1] ' + line for line in expected) <= set(streamed)
+
+
+@mock.patch('quibble.commands.log')
+@mock.patch('multiprocessing.Pool', new_callable=sequential_pool)
+def test_parallel_streamed_output_is_not_logged_again(mock_pool, mock_log):
+    with pytest.raises(Exception, match='bad') as exc_info:
+        quibble.commands.Parallel(
+            steps=[EchoCommand(number=1), EchoCommand(fail=True)],
+            stream_output=True,
+        ).execute()
+
+    assert 'then fail\n' in exc_info.value.output
+    for call_args in mock_log.info.call_args_list:
+        assert 'stdout line' not in str(call_args)
+
+
+class NamedCommand:
+    def __init__(self, name, lines=(), fail=False):
+        self.name = name
+        self.lines = lines
+        self.fail = fail
+
+    def execute(self):
+        for line in self.lines:
+            print(line)
+        if self.fail:
+            raise subprocess.CalledProcessError(1, self.name)
+
+    def __str__(self):
+        return self.name
+
+
+def test_step_logs_writes_command_output_to_its_file(tmp_path, capfd):
+    step_logs = quibble.commands.StepLogs(str(tmp_path))
+    quibble.commands.execute_command(
+        NamedCommand('npm test in /src', ['hello']), step_logs
+    )
+
+    assert (tmp_path / 'npm_test_in_src.log').read_text() == 'hello\n'
+    assert 'hello' not in capfd.readouterr().out
+
+
+def test_step_logs_shows_tail_of_failing_command(tmp_path, capfd):
+    step_logs = quibble.commands.StepLogs(str(tmp_path), tail_lines=2)
+    with pytest.raises(subprocess.CalledProcessError):
+        quibble.commands.execute_command(
+            NamedCommand('phpunit', ['one', 'two', 'three'], fail=True),
+            step_logs,
+        )
+
+    assert (tmp_path / 'phpunit.log').read_text() == 'one\ntwo\nthree\n'
+    assert capfd.readouterr().out == 'two\nthree\n'
+
+
+@pytest.mark.parametrize(
+    'exception',
+    [quibble.commands.SuccessCache.Hit, KeyboardInterrupt],
+)
+def test_step_logs_tail_is_only_shown_on_failures(tmp_path, capfd, exception):
+    class Interrupted(NamedCommand):
+        def execute(self):
+            print('output')
+            raise exception()
+
+    step_logs = quibble.commands.StepLogs(str(tmp_path))
+    with pytest.raises(exception):
+        quibble.commands.execute_command(Interrupted('step'), step_logs)
+
+    assert (tmp_path / 'step.log').read_text() == 'output\n'
+    assert capfd.readouterr().out == ''
+
+
+def test_step_logs_do_not_overwrite_each_other(tmp_path):
+    step_logs = quibble.commands.StepLogs(str(tmp_path))
+    quibble.commands.execute_command(NamedCommand('step', ['a']), step_logs)
+    quibble.commands.execute_command(NamedCommand('step', ['b']), step_logs)
+
+    assert (tmp_path / 'step.log').read_text() == 'a\n'
+    assert (tmp_path / 'step-2.log').read_text() == 'b\n'
+
+
+@mock.patch('quibble.commands.log')
+@mock.patch('multiprocessing.Pool', new_callable=sequential_pool)
+def test_parallel_with_step_logs_keeps_command_output(
+    mock_pool, mock_log, tmp_path
+):
+    step_logs = quibble.commands.StepLogs(str(tmp_path))
+    error = subprocess.CalledProcessError(1, 'fail', output='full output')
+
+    class FailingCommand(NamedCommand):
+        def execute(self):
+            print('some output')
+            raise error
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        quibble.commands.Parallel(
+            steps=[NamedCommand('ok'), FailingCommand('failing')],
+            step_logs=step_logs,
+        ).execute()
+
+    assert exc_info.value.output == 'full output'
+    assert (tmp_path / 'failing.log').read_text() == 'some output\n'
+
+
 class SuccessCacheTest(unittest.TestCase):
-    @mock.patch('git.Repo')
+    @mock.patch('quibble.gitplumbing.Git')
     @mock.patch('quibble.zuul.working_trees')
     @mock.patch('quibble.commands.log')
     def test_check_execute_miss(self, mock_log, mock_zuul_trees, mock_repo):
-        mock_tree = mock.Mock(return_value=mock.Mock(**{'hexsha': 'abc123'}))
-        mock_repo.return_value = mock.Mock(**{'tree': mock_tree})
+        mock_rev_parse = mock.Mock(return_value='abc123')
+        mock_repo.return_value = mock.Mock(**{'rev_parse': mock_rev_parse})
 
         mock_zuul_trees.return_value = {
             'extensions/Foo': '/mw/src/extensions/Foo',
@@ -1484,7 +2504,7 @@ class SuccessCacheTest(unittest.TestCase):
         ).check_command().execute()
 
         mock_repo.assert_called_with('/mw/src/extensions/Foo')
-        mock_tree.assert_called_with('HEAD')
+        mock_rev_parse.assert_called_with('HEAD^{tree}')
 
         sha256 = hashlib.new('sha256')
         sha256.update(b'foo-key\x00')
@@ -1495,12 +2515,12 @@ class SuccessCacheTest(unittest.TestCase):
         mock_cache_client.get.assert_called_with(key)
         mock_log.info.assert_any_call('Success cache: MISS')
 
-    @mock.patch('git.Repo')
+    @mock.patch('quibble.gitplumbing.Git')
     @mock.patch('quibble.zuul.working_trees')
     @mock.patch('quibble.commands.log')
     def test_check_execute_hit(self, mock_log, mock_zuul_trees, mock_repo):
-        mock_tree = mock.Mock(return_value=mock.Mock(**{'hexsha': 'abc123'}))
-        mock_repo.return_value = mock.Mock(**{'tree': mock_tree})
+        mock_rev_parse = mock.Mock(return_value='abc123')
+        mock_repo.return_value = mock.Mock(**{'rev_parse': mock_rev_parse})
 
         mock_zuul_trees.return_value = {
             'extensions/Foo': '/mw/src/extensions/Foo',
@@ -1517,7 +2537,7 @@ class SuccessCacheTest(unittest.TestCase):
             ).check_command().execute()
 
         mock_repo.assert_called_with('/mw/src/extensions/Foo')
-        mock_tree.assert_called_with('HEAD')
+        mock_rev_parse.assert_called_with('HEAD^{tree}')
 
         sha256 = hashlib.new('sha256')
         sha256.update(b'foo-key\x00')
@@ -1528,11 +2548,11 @@ class SuccessCacheTest(unittest.TestCase):
         mock_cache_client.get.assert_called_with(key)
         mock_log.info.assert_any_call('Success cache: HIT')
 
-    @mock.patch('git.Repo')
+    @mock.patch('quibble.gitplumbing.Git')
     @mock.patch('quibble.zuul.working_trees')
     def test_save_execute(self, mock_zuul_trees, mock_repo):
-        mock_tree = mock.Mock(return_value=mock.Mock(**{'hexsha': 'abc123'}))
-        mock_repo.return_value = mock.Mock(**{'tree': mock_tree})
+        mock_rev_parse = mock.Mock(return_value='abc123')
+        mock_repo.return_value = mock.Mock(**{'rev_parse': mock_rev_parse})
 
         mock_zuul_trees.return_value = {
             'extensions/Foo': '/mw/src/extensions/Foo',
@@ -1548,7 +2568,7 @@ class SuccessCacheTest(unittest.TestCase):
         ).save_command().execute()
 
         mock_repo.assert_called_with('/mw/src/extensions/Foo')
-        mock_tree.assert_called_with('HEAD')
+        mock_rev_parse.assert_called_with('HEAD^{tree}')
 
         sha256 = hashlib.new('sha256')
         sha256.update(b'foo-key\x00')
@@ -0,0 +1,185 @@
+import sqlite3
+
+import pytest
+
+from quibble import CommandTiming
+from quibble.durations import DurationsDB, get_arg_parser, normalize_stage
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr('quibble.durations.quibble_version', lambda: '1.0.0')
+    return DurationsDB(str(tmp_path / 'durations.sqlite'))
+
+
+def record(
+    db, npm_seconds, result='SUCCESS', project='mediawiki/core', version=None
+):
+    return db.record(
+        project,
+        'master',
+        [
+            CommandTiming(npm_seconds, 'npm ci'),
+            CommandTiming(10, 'composer install'),
+        ],
+        result,
+        version=version or '1.0.0',
+    )
+
+
+def test_record(db):
+    run_id = record(db, 30)
+
+    assert db.runs('mediawiki/core', 'master', 5) == [
+        (run_id, '1.0.0', 'SUCCESS')
+    ]
+    assert db.stages(run_id) == {'npm ci': 30, 'composer install': 10}
+
+
+def test_stages_sums_repeated_commands(db):
+    run_id = db.record(
+        'mediawiki/core',
+        'master',
+        [CommandTiming(1, 'git clean'), CommandTiming(2, 'git clean')],
+        'SUCCESS',
+    )
+    assert db.stages(run_id) == {'git clean': 3}
+
+
+def test_compare_without_history(db):
+    record(db, 30)
+    assert db.compare('mediawiki/core', 'master') == []
+
+
+def test_compare_reports_slower_stages(db):
+    for seconds in (30, 32, 31):
+        record(db, seconds)
+    record(db, 60)
+
+    assert db.compare('mediawiki/core', 'master') == [('npm ci', 31, 60)]
+
+
+@pytest.mark.parametrize(
+    'latest,kwargs',
+    [
+        pytest.param(33, {}, id='under threshold'),
+        pytest.param(60, {'threshold': 100}, id='under custom threshold'),
+        pytest.param(40, {'min_delta': 10}, id='under minimum delta'),
+    ],
+)
+def test_compare_ignores_small_changes(db, latest, kwargs):
+    for seconds in (30, 30, 30):
+        record(db, seconds)
+    record(db, latest)
+
+    assert db.compare('mediawiki/core', 'master', **kwargs) == []
+
+
+def test_compare_baseline_ignores_failures_and_old_runs(db):
+    record(db, 120)
+    record(db, 5, result='FAILURE')
+    record(db, 30)
+    record(db, 30)
+    record(db, 60)
+
+    assert db.compare('mediawiki/core', 'master', window=3) == [
+        ('npm ci', 30, 60)
+    ]
+
+
+def test_compare_is_per_project(db):
+    record(db, 30)
+    record(db, 60, project='mediawiki/extensions/Foo')
+
+    assert db.compare('mediawiki/core', 'master') == []
+
+
+def test_compare_is_per_version(db):
+    for seconds in (30, 30, 30):
+        record(db, seconds, version='0.9.0')
+    record(db, 60)
+
+    assert db.compare('mediawiki/core', 'master') == []
+    record(db, 61, version='0.9.0')
+    assert db.compare('mediawiki/core', 'master', version='0.9.0') == [
+        ('npm ci', 30, 61)
+    ]
+
+
+def test_runs_filters_version(db):
+    old = record(db, 30, version='0.9.0')
+    new = record(db, 30)
+
+    assert db.runs('mediawiki/core', 'master', 5, version='0.9.0') == [
+        (old, '0.9.0', 'SUCCESS')
+    ]
+    assert [run[0] for run in db.runs('mediawiki/core', 'master', 5)] == [
+        new,
+        old,
+    ]
+
+
+@pytest.mark.parametrize(
+    'stage,expected',
+    [
+        (
+            'Run 3 in parallel (concurrency=16):',
+            'Run 3 in parallel (concurrency=N):',
+        ),
+        (
+            'PHPUnit database suite (default) in 4 shards (Quibble)',
+            'PHPUnit database suite (default) in N shards (Quibble)',
+        ),
+        (
+            'npm test in /workspace/src/extensions/Foo',
+            'npm test in $WORKSPACE/src/extensions/Foo',
+        ),
+        ('npm test in /elsewhere', 'npm test in /elsewhere'),
+    ],
+)
+def test_normalize_stage(stage, expected):
+    assert normalize_stage(stage, '/workspace/') == expected
+
+
+def test_record_normalizes_stages(db):
+    run_id = db.record(
+        'mediawiki/core',
+        'master',
+        [CommandTiming(1, 'npm test in /srv/ws/src')],
+        'SUCCESS',
+        workspace='/srv/ws',
+    )
+    assert db.stages(run_id) == {'npm test in $WORKSPACE/src': 1}
+
+
+@pytest.mark.parametrize(
+    'latest,expected_status',
+    [
+        pytest.param(30, 0, id='no regression'),
+        pytest.param(60, 1, id='regression'),
+    ],
+)
+def test_compare_command(db, capsys, latest, expected_status):
+    record(db, 30)
+    record(db, latest)
+
+    args = get_arg_parser().parse_args(['compare', '--db', db.path])
+    assert args.func(args) == expected_status
+
+    if expected_status:
+        assert capsys.readouterr().out == '\n'.join(
+            [
+                'mediawiki/core (master):',
+                '  npm ci: 60.000s, baseline 30.000s (+30.000s)',
+                '',
+            ]
+        )
+    else:
+        assert capsys.readouterr().out == 'No regression found\n'
+
+
+def test_schema_is_created_once(db):
+    record(db, 30)
+    record(db, 30)
+    with sqlite3.connect(db.path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM runs').fetchone() == (2,)
@@ -0,0 +1,79 @@
+import os
+
+import git
+import pytest
+
+from quibble.gitplumbing import Git, clone
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = str(tmp_path / 'repo')
+    repo = git.Repo.init(path, initial_branch='master')
+    os.makedirs(os.path.join(path, 'sql'))
+    with open(os.path.join(path, 'sql', 'tables.json'), 'w') as f:
+        f.write('[]')
+    repo.index.add(['sql/tables.json'])
+    repo.index.commit('initial')
+    repo.create_head('REL1_42')
+    return repo
+
+
+def test_rev_parse(repo):
+    assert Git(repo.working_dir).rev_parse('HEAD^{tree}') == (
+        repo.head.commit.tree.hexsha
+    )
+    with pytest.raises(git.GitCommandError):
+        Git(repo.working_dir).rev_parse('missing')
+
+
+def test_refs(repo):
+    sha = repo.head.commit.hexsha
+    assert Git(repo.working_dir).refs('refs/heads') == {
+        'refs/heads/REL1_42': sha,
+        'refs/heads/master': sha,
+    }
+    assert Git(repo.working_dir).refs('refs/heads/REL1_42', 'refs/nope') == {
+        'refs/heads/REL1_42': sha
+    }
+
+
+def test_update_refs_and_detach_head(repo):
+    sha = repo.head.commit.hexsha
+    repo_git = Git(repo.working_dir)
+
+    repo_git.detach_head(sha)
+    repo_git.update_refs({'refs/heads/master': sha, 'refs/heads/new': sha})
+
+    assert repo.head.is_detached
+    assert repo.heads['new'].commit.hexsha == sha
+
+
+def test_object_id(repo):
+    tree = repo.head.commit.tree
+    with Git(repo.working_dir) as repo_git:
+        assert repo_git.object_id('HEAD:sql') == (tree / 'sql').hexsha
+        assert repo_git.object_id('HEAD:sql/tables.json') == (
+            (tree / 'sql/tables.json').hexsha
+        )
+        assert repo_git.object_id('HEAD:missing') is None
+        assert repo_git.object_id('HEAD:with space') is None
+        batch_check = repo_git._batch_check
+    assert batch_check.returncode == 0
+
+
+def test_subdirectory_is_not_a_repository(repo):
+    # A directory of the repository working tree, which is not a repository
+    with pytest.raises(git.InvalidGitRepositoryError):
+        Git(os.path.join(repo.working_dir, 'sql')).rev_parse('HEAD')
+    with pytest.raises(git.InvalidGitRepositoryError):
+        Git(os.path.join(repo.working_dir, 'sql')).object_id('HEAD:x')
+
+
+def test_clone(repo, tmp_path):
+    dest = str(tmp_path / 'clone')
+    clone(repo.working_dir, dest)
+    assert Git(dest).rev_parse('HEAD') == repo.head.commit.hexsha
+
+    with pytest.raises(git.GitCommandError, match='already exists'):
+        clone(repo.working_dir, dest)
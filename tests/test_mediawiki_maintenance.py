@@ -128,6 +128,18 @@ class TestMediawikiMaintenance(unittest.TestCase):
 
         self.assertEqual(['--lang', 'fr,zh'], params)
 
+    @mock.patch('subprocess.Popen')
+    def test_rebuildlocalisationcache_threads_parameter(self, mock_popen):
+        mock_popen.return_value.returncode = 0
+        quibble.mediawiki.maintenance.rebuildLocalisationCache(
+            lang=['fr', 'zh'], threads=2
+        )
+
+        (args, kwargs) = mock_popen.call_args
+        params = args[0][2:]
+
+        self.assertEqual(['--lang', 'fr,zh', '--threads', '2'], params)
+
     @mock.patch('subprocess.Popen')
     def test_rebuildlocalisationcache_raises_exception_on_bad_exit_code(
         self, mock_popen
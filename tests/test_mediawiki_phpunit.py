@@ -0,0 +1,196 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from quibble.mediawiki.phpunit import (
+    find_class_files,
+    junit_durations,
+    list_test_classes,
+    listed_class_files,
+    shard,
+    write_shard_config,
+)
+
+PHPUNIT9_LIST = '''<?xml version="1.0"?>
+<tests>
+ <testCaseClass name="FooTest">
+  <testCaseMethod name="testFoo" groups="Database,medium"/>
+ </testCaseClass>
+ <testCaseClass name="BarTest">
+  <testCaseMethod name="testBar" groups="default"/>
+ </testCaseClass>
+ <testCaseClass name="StandaloneTest">
+  <testCaseMethod name="testBaz" groups="Database,Standalone"/>
+ </testCaseClass>
+</tests>
+'''
+
+PHPUNIT10_LIST = '''<?xml version="1.0"?>
+<testSuite xmlns="https://xml.phpunit.de/testSuite">
+ <tests>
+  <testClass name="MediaWiki\\FooTest" file="FooTest.php">
+   <testMethod id="MediaWiki\\FooTest::testFoo" name="testFoo"/>
+  </testClass>
+  <testClass name="MediaWiki\\BarTest" file="BarTest.php">
+   <testMethod id="MediaWiki\\BarTest::testBar" name="testBar"/>
+  </testClass>
+ </tests>
+ <groups>
+  <group name="Database">
+   <test id="MediaWiki\\FooTest::testFoo"/>
+  </group>
+  <group name="default">
+   <test id="MediaWiki\\BarTest::testBar"/>
+  </group>
+ </groups>
+</testSuite>
+'''
+
+JUNIT = '''<?xml version="1.0"?>
+<testsuites>
+ <testsuite name="default">
+  <testcase name="testFoo" class="FooTest" time="2.5"/>
+  <testcase name="testFoo2" class="FooTest" time="0.5"/>
+  <testcase name="testBar" classname="MediaWiki.BarTest" time="1"/>
+ </testsuite>
+</testsuites>
+'''
+
+
+@pytest.fixture
+def phpunit9_list(tmp_path):
+    path = tmp_path / 'tests.xml'
+    path.write_text(PHPUNIT9_LIST)
+    return str(path)
+
+
+def test_list_test_classes(phpunit9_list):
+    assert list_test_classes(phpunit9_list) == [
+        'FooTest',
+        'BarTest',
+        'StandaloneTest',
+    ]
+
+
+@pytest.mark.parametrize(
+    'group,exclude_group,expected',
+    [
+        pytest.param(['Database'], ['Standalone'], ['FooTest'], id='db'),
+        pytest.param([], ['Database', 'Standalone'], ['BarTest'], id='dbless'),
+    ],
+)
+def test_list_test_classes_filters_groups(
+    phpunit9_list, group, exclude_group, expected
+):
+    assert list_test_classes(phpunit9_list, group, exclude_group) == expected
+
+
+def test_list_test_classes_phpunit10(tmp_path):
+    path = tmp_path / 'tests.xml'
+    path.write_text(PHPUNIT10_LIST)
+
+    assert list_test_classes(str(path), ['Database']) == ['MediaWiki\\FooTest']
+    assert list_test_classes(str(path), exclude_group=['Database']) == [
+        'MediaWiki\\BarTest'
+    ]
+
+
+def test_junit_durations(tmp_path):
+    (tmp_path / 'junit-db.xml').write_text(JUNIT)
+    (tmp_path / 'junit-invalid.xml').write_text('<testsuites')
+
+    assert junit_durations(str(tmp_path)) == {
+        'FooTest': 3.0,
+        'MediaWiki\\BarTest': 1.0,
+    }
+
+
+def test_shard_balances_durations():
+    durations = {'A': 10, 'B': 6, 'C': 5, 'D': 4}
+
+    assert shard(['A', 'B', 'C', 'D'], durations, 2) == [
+        (14, ['A', 'D']),
+        (11, ['B', 'C']),
+    ]
+
+
+def test_shard_assumes_median_duration_for_unknown_classes():
+    durations = {'A': 10, 'B': 2, 'C': 4}
+
+    assert shard(['A', 'B', 'C', 'New'], durations, 2) == [
+        (10, ['A']),
+        (10, ['C', 'New', 'B']),
+    ]
+
+
+def test_shard_drops_empty_shards():
+    assert shard(['A'], {}, 4) == [(1.0, ['A'])]
+
+
+def test_listed_class_files(tmp_path, phpunit9_list):
+    path = tmp_path / 'tests10.xml'
+    path.write_text(PHPUNIT10_LIST)
+
+    assert listed_class_files(str(path)) == {
+        'MediaWiki\\FooTest': 'FooTest.php',
+        'MediaWiki\\BarTest': 'BarTest.php',
+    }
+    assert listed_class_files(phpunit9_list) == {}
+
+
+def test_find_class_files(tmp_path):
+    def php_file(path, namespace=None):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        content = '<?php\n'
+        if namespace:
+            content += 'namespace %s;\n' % namespace
+        path.write_text(content)
+        return str(path)
+
+    foo = php_file('tests/phpunit/FooTest.php')
+    core_bar = php_file('tests/phpunit/BarTest.php', 'MediaWiki\\Tests')
+    ext_bar = php_file('extensions/Ext/tests/BarTest.php', 'Ext')
+    php_file('node_modules/pkg/FooTest.php')
+
+    assert find_class_files(
+        ['FooTest', 'MediaWiki\\Tests\\BarTest', 'Ext\\BarTest'],
+        str(tmp_path),
+    ) == {
+        'FooTest': foo,
+        'MediaWiki\\Tests\\BarTest': core_bar,
+        'Ext\\BarTest': ext_bar,
+    }
+
+    with pytest.raises(Exception, match='test classes: MissingTest$'):
+        find_class_files(['FooTest', 'MissingTest'], str(tmp_path))
+
+
+def test_write_shard_config(tmp_path):
+    base = tmp_path / 'phpunit.xml.dist'
+    base.write_text(
+        '<?xml version="1.0"?>\n'
+        '<phpunit xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+        ' bootstrap="tests/phpunit/bootstrap.php">\n'
+        ' <php><ini name="memory_limit" value="-1"/></php>\n'
+        ' <testsuites>\n'
+        '  <testsuite name="core"><directory>tests</directory></testsuite>\n'
+        ' </testsuites>\n'
+        ' <groups><exclude><group>Broken</group></exclude></groups>\n'
+        '</phpunit>\n'
+    )
+    shard_config = str(tmp_path / 'phpunit-shard-1.xml')
+
+    write_shard_config(
+        str(base),
+        shard_config,
+        'shard-1',
+        ['/src/ATest.php', '/src/BTest.php'],
+    )
+
+    root = ET.parse(shard_config).getroot()
+    assert root.get('bootstrap') == 'tests/phpunit/bootstrap.php'
+    assert [child.tag for child in root] == ['php', 'testsuites', 'groups']
+    suites = root.findall('testsuites/testsuite')
+    assert [suite.get('name') for suite in suites] == ['shard-1']
+    assert [f.text for f in suites[0]] == ['/src/ATest.php', '/src/BTest.php']
@@ -1,6 +1,7 @@
 import logging
 import os
 import quibble
+import threading
 import unittest
 from unittest import mock
 
@@ -53,6 +54,15 @@ class QuibbleTest(unittest.TestCase):
             'Use headless mode when DISPLAY is not set',
         )
 
+    @mock.patch.dict(os.environ, clear=True)
+    def test_use_headless__explicit_display(self):
+        self.assertEqual(
+            False,
+            quibble.use_headless(':42'),
+            'Do not use headless when a display is given',
+        )
+        self.assertNotIn('--headless', quibble.chromium_flags(':42'))
+
     @mock.patch('quibble.is_in_docker', return_value=True)
     def test_chrome_in_docker_does_not_use_sandbox(self, mock):
         self.assertIn('--no-sandbox', quibble.chromium_flags())
@@ -143,8 +153,45 @@ class QuibbleTest(unittest.TestCase):
             with quibble.Chronometer('other', mock.MagicMock()):
                 pass
 
+        ids = {
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'rusage': mock.ANY,
+        }
         assert quibble.DURATIONS == [
-            CommandTiming(command='command #0', seconds=3),
-            CommandTiming(command='command #1', seconds=2),
-            CommandTiming(command='other', seconds=1),
+            CommandTiming(
+                command='command #0', seconds=3, start=10, end=13, **ids
+            ),
+            CommandTiming(
+                command='command #1', seconds=2, start=20, end=22, **ids
+            ),
+            CommandTiming(command='other', seconds=1, start=30, end=31, **ids),
+        ]
+
+    @mock.patch('quibble.DURATIONS', new=[])
+    def test_chronometer_tracks_parent(self):
+        with quibble.Chronometer('outer', mock.MagicMock()):
+            with quibble.Chronometer('inner', mock.MagicMock()):
+                pass
+
+        assert [(t.command, t.parent) for t in quibble.DURATIONS] == [
+            ('inner', 'outer'),
+            ('outer', None),
         ]
+
+    @mock.patch('quibble.DURATIONS', new=[])
+    def test_chronometer_explicit_parent_in_thread(self):
+        def worker(parent):
+            with quibble.Chronometer('thread', mock.MagicMock(), parent):
+                pass
+
+        with quibble.Chronometer('outer', mock.MagicMock()):
+            thread = threading.Thread(
+                target=worker, args=(quibble.current_chronometer(),)
+            )
+            thread.start()
+            thread.join()
+
+        assert quibble.DURATIONS[0].command == 'thread'
+        assert quibble.DURATIONS[0].parent == 'outer'
+        assert quibble.DURATIONS[0].tid != quibble.DURATIONS[1].tid
@@ -0,0 +1,171 @@
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+import quibble
+import quibble.commands
+from quibble.scheduler import Scheduler, depends_on, dependencies, flatten
+
+broken_on_macos = pytest.mark.skipif(
+    sys.platform != 'linux', reason="Broken on MacOS, see T299840"
+)
+
+
+class Step:
+    def __init__(self, name, requires=(), provides=(), fail=False):
+        self.name = name
+        self.requires = frozenset(requires)
+        self.provides = frozenset(provides)
+        self.fail = fail
+
+    def execute(self):
+        print('%s ran' % self.name)
+        if self.fail:
+            raise subprocess.CalledProcessError(1, self.name)
+
+    def __str__(self):
+        return self.name
+
+
+class ParentStep(Step):
+    run_in_parent = True
+    executed = []
+
+    def execute(self):
+        ParentStep.executed.append(self.name)
+
+
+class BarrierStep:
+    def execute(self):
+        pass
+
+    def __str__(self):
+        return 'barrier'
+
+
+@pytest.mark.parametrize(
+    'command,other,expected',
+    [
+        pytest.param(
+            Step('b', requires={'x'}),
+            Step('a', provides={'x'}),
+            True,
+            id='requires what the other provides',
+        ),
+        pytest.param(
+            Step('b', provides={'x'}),
+            Step('a', provides={'x'}),
+            True,
+            id='both provide',
+        ),
+        pytest.param(
+            Step('b', provides={'x'}),
+            Step('a', requires={'x'}),
+            True,
+            id='provides what the other requires',
+        ),
+        pytest.param(
+            Step('b', requires={'x'}),
+            Step('a', requires={'x'}),
+            False,
+            id='both require',
+        ),
+        pytest.param(
+            Step('b', requires={'x'}, provides={'y'}),
+            Step('a', provides={'z'}),
+            False,
+            id='unrelated',
+        ),
+        pytest.param(Step('b'), BarrierStep(), True, id='after barrier'),
+        pytest.param(BarrierStep(), Step('a'), True, id='barrier'),
+    ],
+)
+def test_depends_on(command, other, expected):
+    assert depends_on(command, other) == expected
+
+
+def test_flatten_expands_parallel_steps():
+    a, b, c = Step('a'), Step('b'), Step('c')
+    plan = [a, quibble.commands.Parallel(steps=[b, c])]
+
+    assert flatten(plan) == [a, b, c]
+
+
+def test_dependencies():
+    plan = [
+        Step('clone', provides={'sources'}),
+        Step('db', provides={'database'}),
+        Step('install', requires={'sources', 'database'}, provides={'ls'}),
+        Step('npm', requires={'sources'}),
+        Step('phpunit', requires={'ls'}),
+    ]
+    assert dependencies(plan) == [set(), set(), {0, 1}, {0}, {2}]
+
+
+def test_str_only_shows_direct_dependencies():
+    scheduler = Scheduler(
+        [
+            Step('a', provides={'x'}),
+            Step('b', requires={'x'}, provides={'y'}),
+            Step('c', requires={'x', 'y'}),
+        ],
+        workers=1,
+    )
+    assert str(scheduler) == '\n'.join(
+        [
+            'Execution graph:',
+            '0. a',
+            '1. b (after 0)',
+            '2. c (after 1)',
+        ]
+    )
+
+
+@mock.patch('multiprocessing.Pool')
+def test_execute_runs_parent_commands_in_plan_order(mock_pool):
+    ParentStep.executed = []
+    Scheduler(
+        [
+            ParentStep('a', provides={'x'}),
+            BarrierStep(),
+            ParentStep('b', requires={'x'}),
+        ]
+    ).execute()
+
+    assert ParentStep.executed == ['a', 'b']
+    pool = mock_pool.return_value.__enter__.return_value
+    pool.apply_async.assert_not_called()
+
+
+@broken_on_macos
+@mock.patch('quibble.DURATIONS', new=[])
+@mock.patch('quibble.scheduler.log')
+def test_execute_records_duration_of_worker_commands(mock_log):
+    Scheduler(
+        [Step('a', provides={'x'}), Step('b', requires={'x'})], workers=2
+    ).execute()
+
+    captures = [c.args[0] for c in mock_log.info.call_args_list]
+    assert any('a ran\n' in capture for capture in captures)
+    assert any('b ran\n' in capture for capture in captures)
+    assert [timing.command for timing in quibble.DURATIONS] == ['a', 'b']
+
+
+@broken_on_macos
+@mock.patch('quibble.scheduler.log')
+def test_execute_raises_the_failure(mock_log):
+    failing = Step('failing', fail=True)
+    scheduler = Scheduler([failing, Step('other', requires={'x'})], workers=2)
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        scheduler.execute()
+
+    assert 'failing ran\n' in exc_info.value.output
+    assert str(scheduler.failed_command) == 'failing'
+
+
+@mock.patch('os.cpu_count', return_value=None)
+def test_workers_default_when_cpu_count_is_unknown(cpu_count):
+    assert Scheduler([Step('a')]).workers == 1
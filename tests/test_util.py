@@ -9,10 +9,44 @@ from quibble.util import (
     isCoreOrVendor,
     isExtOrSkin,
     move_item_to_head,
+    OutputCapture,
     strtobool,
 )
+import os
+import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+
+# quibble.util.clone_file
+
+
+@pytest.mark.parametrize(
+    'reflink',
+    [
+        pytest.param(True, id='reflink'),
+        pytest.param(False, id='copy'),
+    ],
+)
+def test_clone_file(tmp_path, reflink):
+    src = tmp_path / 'wikidb.sqlite'
+    src.write_bytes(b'data')
+    dest = tmp_path / 'wikidb_1.sqlite'
+    dest.write_bytes(b'previous content')
+
+    def ioctl(fd, request, arg):
+        assert request == quibble.util.FICLONE
+        if not reflink:
+            raise OSError(95, 'Operation not supported')
+        os.write(fd, os.pread(arg, 1024, 0))
+
+    with mock.patch('fcntl.ioctl', side_effect=ioctl) as mock_ioctl:
+        quibble.util.clone_file(str(src), str(dest))
+
+    mock_ioctl.assert_called_once()
+    assert dest.read_bytes() == b'data'
 
 
 # quibble.util.isCoreOrVendor
@@ -103,6 +137,154 @@ def test_redirect_all_streams():
         assert captured == "test out\ntest error\ntest log\n"
 
 
+def test_output_pump_relays_complete_lines():
+    read_fd, write_fd = os.pipe()
+    chunks = []
+    closed = threading.Event()
+
+    quibble.util.output_pump.register(read_fd, chunks.append, closed.set)
+    os.write(write_fd, b'first\nsec')
+    os.write(write_fd, b'ond\nno newline')
+    os.close(write_fd)
+
+    assert closed.wait(timeout=5)
+    os.close(read_fd)
+    assert b''.join(chunks) == b'first\nsecond\nno newline'
+    assert all(c.endswith(b'\n') for c in chunks[:-1])
+    assert chunks[-1] == b'no newline'
+
+
+def test_output_pump_detach_relays_pending_output():
+    read_fd, write_fd = os.pipe()
+    chunks = []
+    closed = threading.Event()
+
+    quibble.util.output_pump.register(read_fd, chunks.append, closed.set)
+    os.write(write_fd, b'line\npartial')
+    quibble.util.output_pump.detach(read_fd)
+
+    assert closed.wait(timeout=5)
+    os.close(read_fd)
+    os.close(write_fd)
+    assert b''.join(chunks) == b'line\npartial'
+
+
+def test_output_pump_survives_failing_callbacks(caplog):
+    failing_read, failing_write = os.pipe()
+    read_fd, write_fd = os.pipe()
+    failing_closed = threading.Event()
+    chunks = []
+    closed = threading.Event()
+
+    def fail(chunk):
+        raise BrokenPipeError(32, 'Broken pipe')
+
+    quibble.util.output_pump.register(failing_read, fail, failing_closed.set)
+    quibble.util.output_pump.register(read_fd, chunks.append, closed.set)
+    os.write(failing_write, b'lost\n')
+    assert failing_closed.wait(timeout=5)
+
+    os.write(write_fd, b'relayed\n')
+    os.close(write_fd)
+    assert closed.wait(timeout=5)
+    assert chunks == [b'relayed\n']
+    assert 'Relaying output of fd %s failed' % failing_read in caplog.text
+
+    for fd in (failing_read, failing_write, read_fd):
+        os.close(fd)
+
+
+def test_write_all_retries_partial_writes():
+    with mock.patch('os.write', side_effect=[2, 3]) as write:
+        quibble.util.write_all(1, b'hello')
+    assert [bytes(c.args[1]) for c in write.call_args_list] == [
+        b'hello',
+        b'llo',
+    ]
+
+
+def test_stream_prefixed_keeps_collecting_without_console():
+    read_console, console = os.pipe()
+    os.close(read_console)
+    with tempfile.TemporaryFile() as collector:
+        with quibble.util.stream_prefixed(
+            collector, console, b'[step] '
+        ) as writer:
+            writer.write(b'output\n')
+        collector.seek(0)
+        assert collector.read() == (
+            b'output\n'
+            b'Can not stream output to the console: [Errno 32] Broken pipe\n'
+        )
+    os.close(console)
+
+
+def test_stream_prefixed_does_not_wait_for_inheriting_processes(tmp_path):
+    console_path = str(tmp_path / 'console')
+    console = os.open(console_path, os.O_WRONLY | os.O_CREAT)
+    start = time.monotonic()
+    with tempfile.TemporaryFile() as collector:
+        with quibble.util.stream_prefixed(
+            collector, console, b'[step] '
+        ) as writer:
+            writer.write(b'hello\n')
+            # Outlives the step and keeps the pipe open
+            daemon = subprocess.Popen(['sleep', '30'], stdout=writer)
+        try:
+            assert time.monotonic() - start < 10
+            collector.seek(0)
+            assert collector.read() == b'hello\n'
+        finally:
+            daemon.kill()
+            daemon.wait()
+    os.close(console)
+    with open(console_path, 'rb') as f:
+        assert f.read() == b'[step] hello\n'
+
+
+def test_output_capture_keeps_small_output():
+    capture = OutputCapture(head_size=4, tail_size=8)
+    capture.write(b'abc\n')
+    capture.write(b'def\n')
+
+    assert capture.getvalue() == 'abc\ndef\n'
+    assert capture.spill_path is None
+
+
+def test_output_capture_truncates_the_middle():
+    capture = OutputCapture(head_size=4, tail_size=4)
+    for line in [b'head', b'lost', b'lost', b'tail']:
+        capture.write(line)
+
+    assert capture.getvalue() == 'head\n[... 8 bytes truncated ...]\ntail'
+    assert len(capture.tail) <= 2 * capture.tail_size
+
+
+def test_output_capture_spills_everything(tmp_path):
+    capture = OutputCapture(
+        name='chatty', spill_dir=str(tmp_path), head_size=4, tail_size=4
+    )
+    for line in [b'head', b'lost', b'lost', b'tail']:
+        capture.write(line)
+    capture.close()
+
+    assert capture.spill_path.startswith(str(tmp_path / 'chatty-'))
+    assert capture.getvalue() == (
+        'head\n[... 8 bytes truncated, full output in %s ...]\ntail'
+        % capture.spill_path
+    )
+    with open(capture.spill_path, 'rb') as f:
+        assert f.read() == b'headlostlosttail'
+
+
+def test_output_capture_close_can_delete_spill_file(tmp_path):
+    capture = OutputCapture(spill_dir=str(tmp_path), head_size=1, tail_size=1)
+    capture.write(b'abc')
+    capture.close(keep=False)
+
+    assert list(tmp_path.iterdir()) == []
+
+
 @mock.patch('quibble.util.FetchInfo.fetch')
 def test_FetchInfo_without_patchset(fetch):
     fetch.return_value = {
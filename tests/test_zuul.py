@@ -1,7 +1,13 @@
+import os
+import tempfile
 import unittest
 from unittest import mock
 
+import git
+
 import quibble.zuul
+from zuul.lib.cloner import Cloner
+from zuul.merger.merger import Repo
 
 
 class TestClone(unittest.TestCase):
@@ -174,6 +180,8 @@ class TestClone(unittest.TestCase):
                     mock.ANY,  # zuul_cloner
                     expected_repo,
                     mock.ANY,  # we don't care about the destination
+                    mock.ANY,  # parent chronometer
+                    stage=False,
                 )
             )
 
@@ -184,7 +192,7 @@ class TestClone(unittest.TestCase):
         mock_executor.assert_has_calls(expected_calls)
 
     @mock.patch('quibble.zuul.Cloner')
-    def test_mediawiki_core_cloned_first_when_running_in_parallel(
+    def test_mediawiki_core_cloned_along_others_when_running_in_parallel(
         self, mock_cloner
     ):
         repos_to_clone = [
@@ -192,29 +200,51 @@ class TestClone(unittest.TestCase):
             'mediawiki/skins/Vector',
             'mediawiki/core',
         ]
-        quibble.zuul.clone(
-            branch='master',
-            cache_dir='/tmp/cache',
-            project_branch=[],
-            # Clone without mediawiki/core
-            projects=repos_to_clone,
-            workers=2,
-            workspace='/tmp/src',
-            zuul_branch=None,
-            zuul_newrev=None,
-            zuul_project=None,
-            zuul_ref=None,
-            zuul_url=None,
-        )
-        self.maxDiff = None
 
-        assert mock_cloner.mock_calls[1] == mock.call().prepareRepo(
-            'mediawiki/core', mock.ANY
-        ), 'mediawiki/core is cloned first'
+        def prepareRepo(project, dest):
+            if project == 'mediawiki/core':
+                os.makedirs(os.path.join(dest, '.git'))
+                os.makedirs(os.path.join(dest, 'extensions'))
+                open(os.path.join(dest, 'extensions', 'README'), 'w').close()
+            else:
+                os.makedirs(dest)
+                open(os.path.join(dest, 'extension.json'), 'w').close()
+
+        mock_cloner().prepareRepo.side_effect = prepareRepo
+
+        with tempfile.TemporaryDirectory() as workspace:
+            quibble.zuul.clone(
+                branch='master',
+                cache_dir='/tmp/cache',
+                project_branch=[],
+                projects=repos_to_clone,
+                workers=2,
+                workspace=workspace,
+                zuul_branch=None,
+                zuul_newrev=None,
+                zuul_project=None,
+                zuul_ref=None,
+                zuul_url=None,
+            )
+
+            # mediawiki/core got prepared aside and moved in place
+            self.assertEqual(
+                ['.git', 'extensions', 'skins'], sorted(os.listdir(workspace))
+            )
+            self.assertEqual(
+                ['Bar', 'README'],
+                sorted(os.listdir(os.path.join(workspace, 'extensions'))),
+            )
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(workspace, 'skins/Vector/extension.json')
+                )
+            )
 
-        # Check other repositories got cloned
         mock_cloner.assert_has_calls(
             [
+                mock.call().log.getChild('mediawiki/core'),
+                mock.call().prepareRepo('mediawiki/core', mock.ANY),
                 mock.call().log.getChild('mediawiki/extensions/Bar'),
                 mock.call().prepareRepo('mediawiki/extensions/Bar', mock.ANY),
                 mock.call().log.getChild('mediawiki/skins/Vector'),
@@ -224,6 +254,60 @@ class TestClone(unittest.TestCase):
             any_order=True,
         )
 
+    @mock.patch('quibble.zuul._clone_worker')
+    def test_mediawiki_core_is_not_staged_once_cloned(self, mock_worker):
+        with tempfile.TemporaryDirectory() as workspace:
+            os.makedirs(os.path.join(workspace, '.git'))
+            quibble.zuul.clone(
+                branch='master',
+                cache_dir='/tmp/cache',
+                project_branch=[],
+                projects=['mediawiki/core', 'mediawiki/extensions/Bar'],
+                workers=2,
+                workspace=workspace,
+                zuul_branch=None,
+                zuul_newrev=None,
+                zuul_project=None,
+                zuul_ref=None,
+                zuul_url=None,
+            )
+
+        for call in mock_worker.call_args_list:
+            self.assertFalse(call.kwargs['stage'])
+
+
+class TestMoveInto(unittest.TestCase):
+    def test_merges_directories_created_concurrently(self):
+        replace = os.replace
+
+        def concurrent_clone(src, dst):
+            # Another repository got cloned in dst since it was checked
+            if os.path.basename(dst) == 'extensions' and not os.path.exists(
+                dst
+            ):
+                os.makedirs(os.path.join(dst, 'Bar'))
+            return replace(src, dst)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'staging')
+            dest = os.path.join(tmp, 'src')
+            os.makedirs(os.path.join(source, 'extensions'))
+            open(os.path.join(source, 'extensions', 'README'), 'w').close()
+            open(os.path.join(source, 'index.php'), 'w').close()
+            os.mkdir(dest)
+
+            with mock.patch('os.replace', side_effect=concurrent_clone):
+                quibble.zuul._move_into(source, dest)
+
+            self.assertEqual(
+                ['extensions', 'index.php'], sorted(os.listdir(dest))
+            )
+            self.assertEqual(
+                ['Bar', 'README'],
+                sorted(os.listdir(os.path.join(dest, 'extensions'))),
+            )
+            self.assertEqual([], os.listdir(source))
+
 
 class TestRepoDir(unittest.TestCase):
     def test_maps_mediawiki_core_to_current_directory(self):
@@ -270,3 +354,123 @@ class TestWorkingTrees(unittest.TestCase):
                 )
             ),
         )
+
+
+class ClonerTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.upstream = os.path.join(tmp.name, 'upstream')
+        self.dest = os.path.join(tmp.name, 'workspace', 'project')
+
+        self.origin = git.Repo.init(
+            os.path.join(self.upstream, 'project'), initial_branch='master'
+        )
+        self.commit('master')
+        self.origin.create_head('REL1_42')
+        self.origin.create_head('REL1_42_old')
+
+    def commit(self, content):
+        with open(os.path.join(self.origin.working_dir, 'README'), 'w') as f:
+            f.write(content)
+        self.origin.index.add(['README'])
+        return self.origin.index.commit(content).hexsha
+
+    def prepare(self, **kwargs):
+        cloner = Cloner(
+            git_base_url=kwargs.pop('git_base_url', self.upstream),
+            projects=['project'],
+            workspace=os.path.dirname(self.dest),
+            zuul_branch=None,
+            zuul_ref=None,
+            zuul_url=None,
+            branch='REL1_42',
+            narrow_fetch=True,
+            **kwargs,
+        )
+        with mock.patch.object(Repo, 'update') as update, mock.patch.object(
+            Repo, 'prune'
+        ) as prune:
+            cloner.prepareRepo('project', self.dest)
+        update.assert_not_called()
+        prune.assert_not_called()
+        return git.Repo(self.dest)
+
+
+class TestNarrowFetch(ClonerTestCase):
+    def test_fetches_indicated_branch_and_prunes(self):
+        self.assertEqual(
+            self.origin.heads['REL1_42'].commit, self.prepare().head.commit
+        )
+
+        self.origin.heads['REL1_42'].checkout()
+        new_commit = self.commit('REL1_42')
+        self.origin.delete_head('REL1_42_old', force=True)
+
+        repo = self.prepare()
+        self.assertEqual(new_commit, repo.head.commit.hexsha)
+        self.assertNotIn('REL1_42_old', repo.remotes.origin.refs)
+
+    def test_falls_back_to_master(self):
+        self.origin.delete_head('REL1_42', force=True)
+        self.assertEqual(
+            self.origin.heads['master'].commit, self.prepare().head.commit
+        )
+
+    def test_only_creates_needed_branches(self):
+        repo = self.prepare()
+        self.assertEqual(
+            ['REL1_42', 'master'], sorted(head.name for head in repo.heads)
+        )
+        self.assertIn('REL1_42_old', repo.remotes.origin.refs)
+
+    def test_has_branch(self):
+        self.prepare()
+        repo = Repo(remote=None, local=self.dest, email=None, username=None)
+        self.assertTrue(repo.hasBranch('REL1_42'))
+        self.assertTrue(repo.hasBranch('REL1_42_old'))
+        self.assertFalse(repo.hasBranch('REL1_4'))
+
+
+class TestCloneMode(ClonerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.origin.heads['REL1_42'].checkout()
+        self.rel_commit = self.commit('REL1_42')
+        self.origin.heads['master'].checkout()
+        self.commit('master 2')
+        self.origin.git.config('uploadpack.allowFilter', 'true')
+        self.url = 'file://%s' % self.upstream
+
+    def test_shallow(self):
+        repo = self.prepare(git_base_url=self.url, clone_mode='shallow')
+
+        self.assertEqual(self.rel_commit, repo.head.commit.hexsha)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.dest, '.git/shallow'))
+        )
+        self.assertEqual('1', repo.git.rev_list('--count', 'HEAD'))
+
+    def test_blobless(self):
+        repo = self.prepare(git_base_url=self.url, clone_mode='blobless')
+
+        self.assertEqual(self.rel_commit, repo.head.commit.hexsha)
+        self.assertEqual(
+            'blob:none', repo.git.config('remote.origin.partialclonefilter')
+        )
+
+    def test_full_clone_projects_keep_history(self):
+        repo = self.prepare(
+            git_base_url=self.url,
+            clone_mode='shallow',
+            full_clone_projects=['project'],
+        )
+
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dest, '.git/shallow'))
+        )
+        self.assertEqual('2', repo.git.rev_list('--count', 'HEAD'))
+
+    def test_unknown_mode(self):
+        with self.assertRaisesRegex(Exception, 'Unknown clone mode: sparse'):
+            self.prepare(clone_mode='sparse')
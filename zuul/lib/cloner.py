@@ -13,17 +13,26 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import git
 import logging
 import os
 import re
 import yaml
 
 from git import GitCommandError
+from quibble import gitplumbing
 from zuul import exceptions
 from zuul.lib.clonemapper import CloneMapper
 from zuul.merger.merger import Repo
 
+# git clone options of each clone mode, only applied to clones from upstream
+# since clones from the cache are hardlinked
+CLONE_MODES = {
+    'full': [],
+    # Blobs are fetched from upstream when checked out
+    'blobless': ['--filter=blob:none'],
+    'shallow': ['--depth=1'],
+}
+
 
 class Cloner(object):
     log = logging.getLogger("zuul.Cloner")
@@ -31,7 +40,9 @@ class Cloner(object):
     def __init__(self, git_base_url, projects, workspace, zuul_branch,
                  zuul_ref, zuul_url, branch=None, clone_map_file=None,
                  project_branches=None, cache_dir=None, zuul_newrev=None,
-                 zuul_project=None, cache_no_hardlinks=None):
+                 zuul_project=None, cache_no_hardlinks=None,
+                 narrow_fetch=False, clone_mode='full',
+                 full_clone_projects=()):
 
         self.clone_map = []
         self.dests = None
@@ -47,6 +58,13 @@ class Cloner(object):
         self.zuul_url = zuul_url
         self.project_branches = project_branches or {}
         self.project_revisions = {}
+        # Only fetch the branches needed to prepare the repositories
+        self.narrow_fetch = narrow_fetch
+        if clone_mode not in CLONE_MODES:
+            raise Exception("Unknown clone mode: %s" % clone_mode)
+        self.clone_mode = clone_mode
+        # Projects cloned with their whole history regardless of clone_mode
+        self.full_clone_projects = set(full_clone_projects)
 
         if zuul_newrev and zuul_project:
             self.project_revisions[zuul_project] = zuul_newrev
@@ -95,20 +113,26 @@ class Cloner(object):
 
                 self.log.info("Creating repo %s from cache %s",
                               project, repo_cache)
-                new_repo = git.Repo.clone_from(repo_cache, dest)
+                gitplumbing.clone(repo_cache, dest)
                 self.log.info("Updating origin remote in repo %s to %s",
                               project, git_upstream)
-                new_repo.remotes.origin.config_writer.set('url', git_upstream)
+                gitplumbing.Git(dest).run(
+                    'remote', 'set-url', 'origin', git_upstream)
+
+        clone_mode = self.clone_mode
+        if project in self.full_clone_projects:
+            clone_mode = 'full'
 
         if not repo_cache:
-            self.log.info("Creating repo %s from upstream %s",
-                          project, git_upstream)
+            self.log.info("Creating repo %s from upstream %s (%s clone)",
+                          project, git_upstream, clone_mode)
 
         repo = Repo(
             remote=git_upstream,
             local=dest,
             email=None,
-            username=None)
+            username=None,
+            clone_args=CLONE_MODES[clone_mode])
 
         if not repo.isInitialized():
             raise Exception("Error cloning %s to %s" % (git_upstream, dest))
@@ -153,18 +177,11 @@ class Cloner(object):
          A) The project-specific override branch (from project_branches arg)
          B) The user specified branch (from the branch arg)
          C) ZUUL_BRANCH (from the zuul_branch arg)
-        """
-
-        repo = self.cloneUpstream(project, dest)
 
-        # Ensure that we don't have stale remotes around
-        repo.prune()
-        # We must reset after pruning because reseting sets HEAD to point
-        # at refs/remotes/origin/master, but `git branch` which prune runs
-        # explodes if HEAD does not point at something in refs/heads.
-        # Later with repo.checkout() we set HEAD to something that
-        # `git branch` is happy with.
-        repo.reset()
+        With narrow_fetch, the indicated and master branches are updated with
+        a single `git fetch --prune` instead of pruning and fetching all the
+        remote branches and tags. They are the only local branches created.
+        """
 
         indicated_revision = None
         if project in self.project_revisions:
@@ -174,6 +191,27 @@ class Cloner(object):
         if project in self.project_branches:
             indicated_branch = self.project_branches[project]
 
+        repo = self.cloneUpstream(project, dest)
+
+        if self.narrow_fetch:
+            branches = sorted({indicated_branch or 'master', 'master'})
+            # A fresh clone from upstream is already up to date, unless it is
+            # shallow and thus lacks the other branches
+            if not repo.cloned:
+                repo.fetchBranches(branches)
+            elif repo.shallow and branches != ['master']:
+                repo.fetchBranches(branches, depth=1)
+            repo.reset(update=False, branches=branches)
+        else:
+            # Ensure that we don't have stale remotes around
+            repo.prune()
+            # We must reset after pruning because reseting sets HEAD to point
+            # at refs/remotes/origin/master, but `git branch` which prune runs
+            # explodes if HEAD does not point at something in refs/heads.
+            # Later with repo.checkout() we set HEAD to something that
+            # `git branch` is happy with.
+            repo.reset()
+
         if indicated_branch:
             override_zuul_ref = re.sub(self.zuul_branch, indicated_branch,
                                        self.zuul_ref)
@@ -217,8 +255,7 @@ class Cloner(object):
                fallback_zuul_ref != override_zuul_ref and
               self.fetchFromZuul(repo, project, fallback_zuul_ref))):
             # Work around a bug in GitPython which can not parse FETCH_HEAD
-            gitcmd = git.Git(dest)
-            fetch_head = gitcmd.rev_parse('FETCH_HEAD')
+            fetch_head = repo.plumbing.rev_parse('FETCH_HEAD')
             repo.checkout(fetch_head)
             self.log.info("Prepared %s repo with commit %s",
                           project, fetch_head)
@@ -19,15 +19,14 @@ import logging
 import shutil
 import time
 
+from quibble import gitplumbing
 
-def reset_repo_to_head(repo):
+
+def reset_repo_to_head(plumbing):
     # This lets us reset the repo even if there is a file in the root
-    # directory named 'HEAD'.  Currently, GitPython does not allow us
-    # to instruct it to always include the '--' to disambiguate.  This
-    # should no longer be necessary if this PR merges:
-    #   https://github.com/gitpython-developers/GitPython/pull/319
+    # directory named 'HEAD'.
     try:
-        repo.git.reset('--hard', 'HEAD', '--')
+        plumbing.run('reset', '--hard', 'HEAD', '--')
     except git.GitCommandError as e:
         # git nowadays may use 1 as status to indicate there are still unstaged
         # modifications after the reset
@@ -43,12 +42,21 @@ class ZuulReference(git.Reference):
 class Repo(object):
     log = logging.getLogger("zuul.Repo")
 
-    def __init__(self, remote, local, email, username):
+    def __init__(self, remote, local, email, username, clone_args=()):
         self.remote_url = remote
         self.local_path = local
         self.email = email
         self.username = username
+        # Extra options for git clone, such as --filter or --depth
+        self.clone_args = list(clone_args)
         self._initialized = False
+        # Whether the repository got cloned from the remote
+        self.cloned = False
+        # Whether it got cloned with a limited history, which only has the
+        # remote HEAD branch
+        self.shallow = False
+        # Runs git directly for the operations preparing the repository
+        self.plumbing = gitplumbing.Git(local)
         try:
             self._ensure_cloned()
         except Exception:
@@ -64,27 +72,16 @@ class Repo(object):
                                                       self.local_path))
             self._git_with_retry(
                 "Cloning from %s to %s" % (self.remote_url, self.local_path),
-                lambda: git.Repo.clone_from(self.remote_url, self.local_path),
+                lambda: gitplumbing.clone(self.remote_url, self.local_path,
+                                          *self.clone_args),
                 cleanup=self._cleanup_failed_clone)
-        repo = git.Repo(self.local_path)
+            self.cloned = True
+            self.shallow = any(arg.startswith('--depth')
+                               for arg in self.clone_args)
         if self.email:
-            repo.config_writer().set_value('user', 'email',
-                                           self.email)
+            self.plumbing.run('config', 'user.email', self.email)
         if self.username:
-            repo.config_writer().set_value('user', 'name',
-                                           self.username)
-        config_writer = repo.config_writer()
-        try:
-            # GitConfigParser.write() acquires a lock but does not release it.
-            # The lock is released in the object's __del__ method, which is
-            # invoked when the object is about to be dereferenced. This is not
-            # a reliable means of ensuring the lock is released, because it can
-            # break if there is a circular reference keeping the object alive,
-            # or if another GitConfigParser object for the same repository is
-            # initiated while a reference to the existing one is still held.
-            config_writer.write()
-        finally:
-            config_writer._lock._release_lock()
+            self.plumbing.run('config', 'user.name', self.username)
         self._initialized = True
 
     def _git_with_retry(self, action, func, cleanup=None):
@@ -134,24 +131,43 @@ class Repo(object):
                                self.local_path)
         return repo
 
-    def reset(self):
+    def reset(self, update=True, branches=None):
+        """Create local branches from the remote ones and reset to the remote
+        HEAD.
+
+        branches restricts the local branches to create, by default all the
+        remote branches are. The references are read and written with one
+        git command each.
+        """
         self.log.debug("Resetting repository %s" % self.local_path)
-        self.update()
-        repo = self.createRepoObject()
-        origin = repo.remotes.origin
-        for ref in origin.refs:
-            if ref.remote_head == 'HEAD':
+        if update:
+            self.update()
+        prefix = 'refs/remotes/origin/'
+        if branches is None:
+            remote_refs = self.plumbing.refs(prefix.rstrip('/'))
+        else:
+            remote_refs = self.plumbing.refs(
+                *[prefix + branch for branch in list(branches) + ['HEAD']])
+        updates = {}
+        for ref, sha in remote_refs.items():
+            branch = ref[len(prefix):]
+            if branch == 'HEAD':
+                continue
+            if branches is not None and branch not in branches:
                 continue
-            repo.create_head(ref.remote_head, ref, force=True)
+            updates['refs/heads/%s' % branch] = sha
 
         # try reset to remote HEAD (usually origin/master)
         # If it fails, pick the first reference
-        try:
-            repo.head.reference = origin.refs['HEAD']
-        except IndexError:
-            repo.head.reference = origin.refs[0]
-        reset_repo_to_head(repo)
-        repo.git.clean('-x', '-f', '-d')
+        if prefix + 'HEAD' in remote_refs:
+            self.plumbing.detach_head(remote_refs[prefix + 'HEAD'])
+        elif remote_refs:
+            self.plumbing.detach_head(remote_refs[sorted(remote_refs)[0]])
+        # HEAD is detached first, git refuses to update in one transaction a
+        # branch and HEAD pointing to it
+        self.plumbing.update_refs(updates)
+        reset_repo_to_head(self.plumbing)
+        self.plumbing.run('clean', '-x', '-f', '-d')
 
     def prune(self):
         repo = self.createRepoObject()
@@ -169,9 +185,8 @@ class Repo(object):
         return branch_head.commit
 
     def hasBranch(self, branch):
-        repo = self.createRepoObject()
-        origin = repo.remotes.origin
-        return branch in origin.refs
+        ref = 'refs/remotes/origin/%s' % branch
+        return ref in self.plumbing.refs(ref)
 
     def getCommitFromRef(self, refname):
         repo = self.createRepoObject()
@@ -181,11 +196,15 @@ class Repo(object):
         return ref.commit
 
     def checkout(self, ref):
-        repo = self.createRepoObject()
+        """Detach HEAD at the commit of ref and reset the working tree
+
+        Returns the commit id.
+        """
         self.log.debug("Checking out %s" % ref)
-        repo.head.reference = ref
-        reset_repo_to_head(repo)
-        return repo.head.commit
+        commit = self.plumbing.rev_parse('%s^{commit}' % ref)
+        self.plumbing.detach_head(commit)
+        reset_repo_to_head(self.plumbing)
+        return commit
 
     def cherryPick(self, ref):
         repo = self.createRepoObject()
@@ -220,11 +239,28 @@ class Repo(object):
         except AssertionError:
             origin.fetch(ref)
 
+    def fetchBranches(self, branches, depth=None):
+        """Update the remote branches matching the given names with a single
+        fetch, pruning the ones which got deleted.
+
+        The refspecs are patterns so that missing branches do not fail the
+        fetch. They also match branches starting with the same name.
+        """
+        options = ['--prune']
+        if depth is not None:
+            options.append('--depth=%d' % depth)
+        refspecs = ['+refs/heads/%s*:refs/remotes/origin/%s*' % (b, b)
+                    for b in branches]
+        self._git_with_retry(
+            "Fetching branches %s for %s" % (', '.join(branches),
+                                             self.local_path),
+            lambda: self.plumbing.run('fetch', *options, 'origin',
+                                      *refspecs))
+
     def fetchFrom(self, repository, refspec):
-        repo = self.createRepoObject()
         self._git_with_retry(
             "Fetching %s from %s" % (refspec, repository),
-            lambda: repo.git.fetch(repository, refspec))
+            lambda: self.plumbing.run('fetch', repository, refspec))
 
     def createZuulRef(self, ref, commit='HEAD'):
         repo = self.createRepoObject()